@@ -0,0 +1,272 @@
+"""
+Admission Control
+
+    in front of the RAG chain, to protect the LLM quota and the latency:
+    * a global limit of requests in flight, with a bounded wait queue
+      (queue full, or wait too long: 503, at once)
+    * requests on the same conversation are serialized
+      (they would race on the conversation history)
+    * a token bucket per conv_id (too many requests: 429)
+
+    The limits are per process (per uvicorn worker).
+    The time spent waiting is sent to APM, in the span of the request.
+"""
+
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict
+
+from app_metrics import API_REJECTED
+
+# reasons for a rejection, and the HTTP status
+RATE_LIMITED = "rate_limited"
+QUEUE_FULL = "queue_full"
+QUEUE_TIMEOUT = "queue_timeout"
+
+REJECT_STATUS = {RATE_LIMITED: 429, QUEUE_FULL: 503, QUEUE_TIMEOUT: 503}
+
+
+class AdmissionRejected(Exception):
+    """
+    the request can't be served now
+
+    retry_after_sec: a hint for the client (Retry-After)
+    """
+
+    def __init__(self, reason: str, retry_after_sec: float):
+        super().__init__(f"Request rejected: {reason}")
+        self.reason = reason
+        self.status_code = REJECT_STATUS[reason]
+        self.retry_after_sec = retry_after_sec
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        """
+        for the HTTP response (Retry-After in whole seconds)
+        """
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after_sec)))}
+
+
+class TokenBucket:
+    """
+    rate_per_sec tokens are added every sec., up to burst
+    """
+
+    def __init__(self, rate_per_sec: float, burst: float):
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last) * self.rate_per_sec
+        )
+        self._last = now
+
+    def try_take(self) -> bool:
+        self._refill()
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return True
+        return False
+
+    def wait_sec(self) -> float:
+        """
+        time until the next token
+        """
+        return (1.0 - self._tokens) / self.rate_per_sec
+
+
+@dataclass
+class _Conversation:
+    # requests holding or waiting for the lock
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    users: int = 0
+
+
+@dataclass
+class Admission:
+    """
+    a request admitted: to be released when done (once)
+    """
+
+    conv_id: str
+    queue_wait_ms: float = 0.0
+    in_flight: int = 0
+    queued: int = 0
+    released: bool = False
+
+    def set_attributes(self, span):
+        span.set_attribute("admission_queue_wait_ms", self.queue_wait_ms)
+        span.set_attribute("admission_in_flight", self.in_flight)
+        span.set_attribute("admission_queued", self.queued)
+
+
+class AdmissionController:
+    """
+    Admit, queue or reject the requests
+
+    max_concurrent: max requests in flight (in the chain)
+    max_queue: max requests waiting
+    queue_timeout_sec: max wait, then 503
+    rate_per_sec, burst: token bucket for every conv_id (0: no rate limit)
+    max_conversations: buckets kept (LRU)
+
+    to be used from the event loop (not thread safe)
+    """
+
+    def __init__(
+        self,
+        enable: bool = True,
+        max_concurrent: int = 32,
+        max_queue: int = 64,
+        queue_timeout_sec: float = 10.0,
+        rate_per_sec: float = 1.0,
+        burst: int = 5,
+        max_conversations: int = 10000,
+    ):
+        self.enable = enable
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout_sec = queue_timeout_sec
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self.max_conversations = max_conversations
+
+        self._in_flight = 0
+        self._queued = 0
+        # waiting for a slot, in order of arrival
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._conversations: Dict[str, _Conversation] = {}
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def _reject(self, reason: str, retry_after_sec: float):
+        API_REJECTED.add(1, {"reason": reason})
+        raise AdmissionRejected(reason, retry_after_sec)
+
+    def _check_rate(self, conv_id: str):
+        if self.rate_per_sec <= 0:
+            return
+
+        bucket = self._buckets.pop(conv_id, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate_per_sec, self.burst)
+        # most recent last
+        self._buckets[conv_id] = bucket
+
+        while len(self._buckets) > self.max_conversations:
+            self._buckets.popitem(last=False)
+
+        if not bucket.try_take():
+            self._reject(RATE_LIMITED, bucket.wait_sec())
+
+    def _dispatch(self):
+        """
+        hand the free slots to the requests waiting
+        """
+        while self._waiters and self._in_flight < self.max_concurrent:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+
+    async def _acquire_conversation(self, conv_id: str, timeout_sec: float):
+        conversation = self._conversations.setdefault(conv_id, _Conversation())
+        conversation.users += 1
+        try:
+            if not conversation.lock.locked():
+                # at once, without a task: the counters stay exact
+                await conversation.lock.acquire()
+            else:
+                await asyncio.wait_for(conversation.lock.acquire(), max(timeout_sec, 0))
+        except BaseException:
+            self._leave_conversation(conv_id)
+            raise
+
+    def _leave_conversation(self, conv_id: str):
+        conversation = self._conversations[conv_id]
+        conversation.users -= 1
+        if conversation.users == 0:
+            del self._conversations[conv_id]
+
+    async def _acquire_slot(self, timeout_sec: float):
+        if self._in_flight < self.max_concurrent and not self._waiters:
+            self._in_flight += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, max(timeout_sec, 0))
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was given while timing out: give it back
+                self._in_flight -= 1
+                self._dispatch()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    async def acquire(self, conv_id: str) -> Admission:
+        """
+        wait for the turn of the request, or raise AdmissionRejected
+        """
+        if not self.enable:
+            return Admission(conv_id, released=True)
+
+        self._check_rate(conv_id)
+
+        if self._in_flight >= self.max_concurrent and self._queued >= self.max_queue:
+            self._reject(QUEUE_FULL, self.queue_timeout_sec)
+
+        time_start = time.perf_counter()
+        queued = self._queued
+        self._queued += 1
+        try:
+            await self._acquire_conversation(conv_id, self.queue_timeout_sec)
+            try:
+                await self._acquire_slot(
+                    self.queue_timeout_sec - (time.perf_counter() - time_start)
+                )
+            except BaseException:
+                self._conversations[conv_id].lock.release()
+                self._leave_conversation(conv_id)
+                raise
+        except asyncio.TimeoutError:
+            self._reject(QUEUE_TIMEOUT, self.queue_timeout_sec)
+        finally:
+            self._queued -= 1
+
+        return Admission(
+            conv_id,
+            queue_wait_ms=(time.perf_counter() - time_start) * 1000.0,
+            in_flight=self._in_flight,
+            queued=queued,
+        )
+
+    def release(self, admission: Admission):
+        """
+        the request is done: the next one can go (safe to call twice)
+        """
+        if admission.released:
+            return
+        admission.released = True
+
+        self._conversations[admission.conv_id].lock.release()
+        self._leave_conversation(admission.conv_id)
+
+        self._in_flight -= 1
+        self._dispatch()
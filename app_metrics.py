@@ -0,0 +1,74 @@
+"""
+App Metrics
+
+    the metrics of the RAG application, recorded with the OpenTelemetry
+    metrics API (the MeterProvider is set up by TracerSingleton):
+    * latency histograms: LLM, embeddings, vector search, whole chain
+    * counters: tokens and chars per model (input and output),
+      requests rejected (admission control)
+
+    Unlike span attributes, the metrics are not affected by sampling.
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+from opentelemetry import metrics
+
+meter = metrics.get_meter("rag_metrics")
+
+LLM_LATENCY = meter.create_histogram(
+    "llm_latency", unit="ms", description="latency of the calls to the LLM"
+)
+EMBED_LATENCY = meter.create_histogram(
+    "embed_latency", unit="ms", description="latency of the embeddings"
+)
+VECTOR_SEARCH_LATENCY = meter.create_histogram(
+    "vector_search_latency", unit="ms", description="latency of the vector search"
+)
+CHAIN_LATENCY = meter.create_histogram(
+    "chain_latency", unit="ms", description="end-to-end time of the RAG chain"
+)
+
+API_REJECTED = meter.create_counter(
+    "api_rejected", unit="{request}", description="requests rejected by admission"
+)
+
+LLM_TOKENS = meter.create_counter(
+    "llm_tokens", unit="{token}", description="tokens sent to/received from the LLM"
+)
+LLM_CHARS = meter.create_counter(
+    "llm_chars", unit="{char}", description="chars sent to/received from the LLM"
+)
+
+
+@contextmanager
+def timed(histogram, attributes: Dict):
+    """
+    record in histogram the time spent in the block, in ms
+    """
+    time_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.record((time.perf_counter() - time_start) * 1000.0, attributes)
+
+
+def record_llm_usage(
+    model: str,
+    input_chars: int,
+    input_tokens: int,
+    output_chars: int,
+    output_tokens: int,
+):
+    """
+    count tokens and chars of a call to the LLM (tokens are estimated)
+    """
+    input_attributes = {"model": model, "direction": "input"}
+    output_attributes = {"model": model, "direction": "output"}
+
+    LLM_CHARS.add(input_chars, input_attributes)
+    LLM_TOKENS.add(input_tokens, input_attributes)
+    LLM_CHARS.add(output_chars, output_attributes)
+    LLM_TOKENS.add(output_tokens, output_attributes)
@@ -0,0 +1,225 @@
+"""
+Batch Runner
+
+    many questions through the RAG chain, with one call (offline evaluation,
+    bulk customers):
+    * the chain is the one already built (no rebuild per question)
+    * the questions are embedded together, in a single grouped call:
+      then every retrieval finds its embedding in the cache (only if the
+      embed model has a cache; if the call fails the questions go on)
+    * the questions run concurrently (at most max_concurrency at a time),
+      the results are returned as they are completed
+
+    Every question has its own span (batch.item), child of batch.run.
+    The questions are independent: no chat history.
+"""
+
+import time
+from typing import AsyncIterator, Dict, Iterator, List
+
+from langchain_core.runnables import RunnableLambda
+from opentelemetry import trace
+from opentelemetry.trace import Status, StatusCode
+
+from stream_tracing import atraced_iter, traced_iter
+from tracer_singleton import TracerSingleton, set_detailed_attribute
+from utils import get_console_logger
+
+TRACER = TracerSingleton.get_instance()
+
+logger = get_console_logger()
+
+
+class BatchRunner:
+    """
+    Run a list of questions through the chain
+
+    embed_model: to group the embeddings of the questions, the one of
+        the chain (not grouped if None or without a cache)
+    """
+
+    def __init__(self, chain, embed_model=None, max_concurrency: int = 8):
+        self.chain = chain
+        self.embed_model = embed_model
+        self.max_concurrency = max_concurrency
+
+        self._item_runnable = RunnableLambda(
+            self._run_item, afunc=self._arun_item, name="batch_item"
+        )
+
+    @staticmethod
+    def _inputs(queries: List[str]) -> List[Dict]:
+        return [
+            {"index": i, "input": query, "chat_history": []}
+            for i, query in enumerate(queries)
+        ]
+
+    @staticmethod
+    def _start_item_span(item: Dict):
+        span = TRACER.start_span("batch.item")
+        span.set_attribute("batch_index", item["index"])
+        set_detailed_attribute(span, "genai-chat-input", item["input"])
+        return span
+
+    @staticmethod
+    def _end_item_span(span, item: Dict, time_start: float, output=None, error=None):
+        """
+        end the span, and the result of the item (as sent to the client)
+        """
+        result = {
+            "index": item["index"],
+            "query": item["input"],
+            "latency_ms": round((time.perf_counter() - time_start) * 1000.0, 1),
+        }
+        if error is None:
+            result["answer"] = output["answer"]
+        else:
+            # the error is in the result, the other questions go on
+            result["error"] = str(error)
+            span.record_exception(error)
+            span.set_status(Status(StatusCode.ERROR, str(error)))
+
+        span.end()
+        return result
+
+    def _run_item(self, item: Dict, config) -> Dict:
+        time_start = time.perf_counter()
+        span = self._start_item_span(item)
+
+        with trace.use_span(span, end_on_exit=False):
+            try:
+                output = self.chain.invoke(
+                    {"input": item["input"], "chat_history": []}, config
+                )
+            except Exception as e:
+                return self._end_item_span(span, item, time_start, error=e)
+
+        return self._end_item_span(span, item, time_start, output)
+
+    async def _arun_item(self, item: Dict, config) -> Dict:
+        time_start = time.perf_counter()
+        span = self._start_item_span(item)
+
+        with trace.use_span(span, end_on_exit=False):
+            try:
+                output = await self.chain.ainvoke(
+                    {"input": item["input"], "chat_history": []}, config
+                )
+            except Exception as e:
+                return self._end_item_span(span, item, time_start, error=e)
+
+        return self._end_item_span(span, item, time_start, output)
+
+    def _start_span(self, queries: List[str]):
+        span = TRACER.start_span("batch.run")
+        span.set_attribute("batch_size", len(queries))
+        span.set_attribute("batch_max_concurrency", self.max_concurrency)
+        return span
+
+    @staticmethod
+    def _end_span(span, n_errors: int, time_start: float):
+        span.set_attribute("batch_errors", n_errors)
+        span.set_attribute(
+            "batch_elapsed_ms", (time.perf_counter() - time_start) * 1000.0
+        )
+        span.end()
+
+    def _can_group(self, queries: List[str]) -> bool:
+        # without a cache the questions would be embedded twice
+        return (
+            bool(queries) and getattr(self.embed_model, "embed_cache", None) is not None
+        )
+
+    def _group_embeddings(self, queries: List[str]):
+        """
+        one call for all the questions (split in batches by the embed model)
+
+        only an optimization: if it fails, every question is embedded
+        on its own, in the chain
+        """
+        if not self._can_group(queries):
+            return
+
+        try:
+            with TRACER.start_as_current_span("batch.embed"):
+                self.embed_model.embed_documents(list(dict.fromkeys(queries)))
+        except Exception as e:
+            logger.warning("Grouped embeddings of the batch failed: %s", e)
+
+    async def _agroup_embeddings(self, queries: List[str]):
+        if not self._can_group(queries):
+            return
+
+        try:
+            with TRACER.start_as_current_span("batch.embed"):
+                await self.embed_model.aembed_documents(list(dict.fromkeys(queries)))
+        except Exception as e:
+            logger.warning("Grouped embeddings of the batch failed: %s", e)
+
+    def run(self, queries: List[str]) -> Iterator[Dict]:
+        """
+        the results, in order of completion:
+        index, query, answer (or error), latency_ms
+        """
+        time_start = time.perf_counter()
+        span = self._start_span(queries)
+        n_errors = 0
+
+        try:
+            with trace.use_span(span, end_on_exit=False):
+                self._group_embeddings(queries)
+
+            results = self._item_runnable.batch_as_completed(
+                self._inputs(queries), {"max_concurrency": self.max_concurrency}
+            )
+            # the items run in the context of batch.run
+            for _, result in traced_iter(span, results):
+                n_errors += "error" in result
+                yield result
+        finally:
+            self._end_span(span, n_errors, time_start)
+
+    async def arun(self, queries: List[str]) -> AsyncIterator[Dict]:
+        """
+        async version of run
+        """
+        time_start = time.perf_counter()
+        span = self._start_span(queries)
+        n_errors = 0
+
+        try:
+            with trace.use_span(span, end_on_exit=False):
+                await self._agroup_embeddings(queries)
+
+            results = self._item_runnable.abatch_as_completed(
+                self._inputs(queries), {"max_concurrency": self.max_concurrency}
+            )
+            # the tasks are created in the context of batch.run
+            async for _, result in atraced_iter(span, results):
+                n_errors += "error" in result
+                yield result
+        finally:
+            self._end_span(span, n_errors, time_start)
+
+
+def run_batch(
+    queries: List[str], chain=None, embed_model=None, max_concurrency: int = 8
+) -> List[Dict]:
+    """
+    the results of the questions, in the same order
+
+    if the chain is not given it is built (see: factory.build_rag_chain),
+    with embed_model (default: from config)
+    """
+    if chain is None:
+        # imported here: the factory is needed only to build the chain
+        # pylint: disable=import-outside-toplevel
+        import factory
+
+        if embed_model is None:
+            embed_model = factory.get_embed_model()
+        chain = factory.build_rag_chain(embed_model=embed_model)
+
+    runner = BatchRunner(chain, embed_model, max_concurrency)
+
+    return sorted(runner.run(queries), key=lambda result: result["index"])
@@ -0,0 +1,107 @@
+"""
+Benchmark: sync vs async request path
+
+    runs N concurrent requests through handle_request (as FastAPI does for
+    a sync handler, in the threadpool) and through ahandle_request
+    (as FastAPI does for an async handler, in the event loop).
+
+    Models and DB are local fakes (see: fake_backends) with stubbed latencies.
+
+Usage:
+    python bench_async_invoke.py --requests 200 --llm_latency_ms 1000
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+import main_rag
+from main_rag import InvokeInput
+from chain_registry import ChainRegistry
+from fake_backends import build_fake_rag_chain_with_embeddings
+
+
+async def sample_threads(stats: dict, stop: asyncio.Event):
+    """
+    keep the max num. of threads seen while the requests run
+    """
+    while not stop.is_set():
+        stats["max_threads"] = max(stats["max_threads"], threading.active_count())
+        await asyncio.sleep(0.01)
+
+
+async def run_requests(mode: str, n_requests: int) -> dict:
+    """
+    run n_requests concurrently, in sync or async mode
+    """
+    stats = {"max_threads": threading.active_count()}
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_threads(stats, stop))
+
+    # every request has its own conversation
+    requests = [
+        (InvokeInput(query=f"Question n. {i}"), f"bench-{mode}-{i}")
+        for i in range(n_requests)
+    ]
+
+    time_start = time.perf_counter()
+
+    if mode == "sync":
+        await asyncio.gather(
+            *(
+                run_in_threadpool(main_rag.handle_request, request, conv_id)
+                for request, conv_id in requests
+            )
+        )
+    else:
+        await asyncio.gather(
+            *(
+                main_rag.ahandle_request(request, conv_id)
+                for request, conv_id in requests
+            )
+        )
+
+    elapsed = time.perf_counter() - time_start
+
+    stop.set()
+    await sampler
+
+    return {
+        "mode": mode,
+        "requests": n_requests,
+        "elapsed_sec": round(elapsed, 2),
+        "throughput_rps": round(n_requests / elapsed, 1),
+        "max_threads": stats["max_threads"],
+    }
+
+
+def main():
+    """
+    run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description="sync vs async /invoke/ path")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--llm_latency_ms", type=float, default=1000.0)
+    parser.add_argument("--embed_latency_ms", type=float, default=50.0)
+    parser.add_argument("--db_latency_ms", type=float, default=20.0)
+    args = parser.parse_args()
+
+    main_rag.chain_registry = ChainRegistry(
+        builder=lambda: build_fake_rag_chain_with_embeddings(
+            llm_latency_ms=args.llm_latency_ms,
+            embed_latency_ms=args.embed_latency_ms,
+            db_latency_ms=args.db_latency_ms,
+        )
+    )
+    main_rag.chain_registry.warm_up()
+
+    for mode in ["sync", "async"]:
+        result = asyncio.run(run_requests(mode, args.requests))
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark: conversation backends with many workers
+
+    starts N worker processes that write, concurrently, on the same
+    conversations in a SQLite backend (as N uvicorn workers would do),
+    then checks that the histories are consistent:
+    * every conversation has the expected num. of messages
+    * question and answer of every exchange are adjacent
+
+Usage:
+    python bench_conversation_backends.py --workers 4 --exchanges 200
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from conversation_backends import SQLiteBackend
+
+MAX_MESSAGES = 1000
+
+
+def worker(db_path: str, worker_id: int, n_exchanges: int, n_conversations: int):
+    """
+    write n_exchanges (question + answer) on the shared conversations
+    """
+    backend = SQLiteBackend(db_path, MAX_MESSAGES)
+
+    for i in range(n_exchanges):
+        conv_id = f"conv-{i % n_conversations}"
+        tag = f"{worker_id}-{i}"
+
+        # as the API does: read the history, then add the exchange
+        backend.get_messages(conv_id)
+        backend.append_messages(conv_id, [("human", f"q {tag}"), ("ai", f"a {tag}")])
+
+
+def check(db_path: str, n_workers: int, n_exchanges: int, n_conversations: int):
+    """
+    check the histories written by the workers, return the errors
+    """
+    backend = SQLiteBackend(db_path, MAX_MESSAGES)
+    errors = []
+
+    total = 0
+    for c in range(n_conversations):
+        messages = backend.get_messages(f"conv-{c}")
+        total += len(messages)
+
+        for question, answer in zip(messages[::2], messages[1::2]):
+            if question[0] != "human" or answer[0] != "ai":
+                errors.append(f"conv-{c}: wrong order {question}, {answer}")
+            elif question[1][2:] != answer[1][2:]:
+                errors.append(f"conv-{c}: exchange split {question}, {answer}")
+
+    expected = 2 * n_workers * n_exchanges
+    if total != expected:
+        errors.append(f"expected {expected} messages, found {total}")
+
+    return errors
+
+
+def main():
+    """
+    run the workers and check the result
+    """
+    parser = argparse.ArgumentParser(description="conversation backends, N workers")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--exchanges", type=int, default=200)
+    parser.add_argument("--conversations", type=int, default=10)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), "conversations.db")
+    # creates the tables, before the workers start
+    SQLiteBackend(db_path, MAX_MESSAGES)
+
+    time_start = time.perf_counter()
+
+    processes = [
+        multiprocessing.Process(
+            target=worker, args=(db_path, i, args.exchanges, args.conversations)
+        )
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    elapsed = time.perf_counter() - time_start
+    errors = check(db_path, args.workers, args.exchanges, args.conversations)
+
+    print(
+        {
+            "workers": args.workers,
+            "exchanges": args.workers * args.exchanges,
+            "elapsed_sec": round(elapsed, 2),
+            "exchanges_per_sec": round(args.workers * args.exchanges / elapsed, 1),
+            "consistent": not errors,
+        }
+    )
+    for error in errors[:10]:
+        print(error)
+
+
+if __name__ == "__main__":
+    main()
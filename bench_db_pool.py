@@ -0,0 +1,134 @@
+"""
+Benchmark: connection pool of the vector store
+
+    runs concurrent operations (search, async search, insert, delete,
+    collection version) of OracleVS4APM on a fake pool (see: fake_backends),
+    where a fraction of the statements fails, and checks that every
+    borrowed connection goes back to the pool, also on errors:
+    * acquired == released, no connection busy at the end
+    * never more than max connections open
+
+    It reports the operations done, failed and the pool counters.
+
+Usage:
+    python bench_db_pool.py --threads 16 --ops 200 --failure_rate 0.2
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+from fake_backends import FakeConnectionPool, FakeOCIGenAIEmbeddings4APM
+from oraclevs_4_apm import OracleVS4APM
+
+OPERATIONS = ["search", "asearch", "add_texts", "delete", "version"]
+
+# OracleVS logs every failure (with the stack): only the counts here
+logging.getLogger("langchain_community.vectorstores.oraclevs").setLevel(
+    logging.CRITICAL
+)
+
+
+def run_operation(v_store: OracleVS4APM, operation: str):
+    """
+    one DB operation, with a connection borrowed from the pool
+    """
+    if operation == "search":
+        v_store.similarity_search("What is a vector database?", k=4)
+    elif operation == "asearch":
+        asyncio.run(v_store.asimilarity_search("What is a vector database?", k=4))
+    elif operation == "add_texts":
+        v_store.add_texts(["A fake chunk."], metadatas=[{"source": "bench"}])
+    elif operation == "delete":
+        v_store.delete(ids=["fake-id"])
+    else:
+        v_store.get_collection_version()
+
+
+def run_worker(v_store: OracleVS4APM, n_ops: int, seed: int) -> dict:
+    """
+    n_ops random operations, the failed ones are counted
+    """
+    rnd = random.Random(seed)
+    stats = {"ops": 0, "failed": 0}
+
+    for _ in range(n_ops):
+        stats["ops"] += 1
+        try:
+            run_operation(v_store, rnd.choice(OPERATIONS))
+        except Exception:
+            stats["failed"] += 1
+
+    return stats
+
+
+def main():
+    """
+    run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description="connection pool release")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--ops", type=int, default=200)
+    parser.add_argument("--pool_max", type=int, default=4)
+    parser.add_argument("--failure_rate", type=float, default=0.2)
+    args = parser.parse_args()
+
+    pool = FakeConnectionPool(min=1, max=args.pool_max, increment=1)
+    embed_model = FakeOCIGenAIEmbeddings4APM(
+        client=object(), model_id="fake.embed", latency_ms=0.0, embed_dim=16
+    )
+    v_store = OracleVS4APM(
+        embedding_function=embed_model,
+        table_name="FAKE_BOOKS",
+        distance_strategy=DistanceStrategy.COSINE,
+        pool=pool,
+    )
+    # the table exists: the failures only from now on
+    pool.failure_rate = args.failure_rate
+
+    max_opened = pool.opened
+    time_start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        futures = [
+            executor.submit(run_worker, v_store, args.ops, seed)
+            for seed in range(args.threads)
+        ]
+        while not all(future.done() for future in futures):
+            max_opened = max(max_opened, pool.opened)
+            time.sleep(0.001)
+        results = [future.result() for future in futures]
+
+    elapsed = time.perf_counter() - time_start
+
+    errors = []
+    if pool.acquire_count != pool.release_count:
+        errors.append(f"acquired {pool.acquire_count}, released {pool.release_count}")
+    if pool.busy:
+        errors.append(f"{pool.busy} connections still busy")
+    if max_opened > args.pool_max:
+        errors.append(f"{max_opened} connections open, max {args.pool_max}")
+
+    print(
+        {
+            "threads": args.threads,
+            "ops": sum(result["ops"] for result in results),
+            "failed": sum(result["failed"] for result in results),
+            "acquired": pool.acquire_count,
+            "released": pool.release_count,
+            "busy": pool.busy,
+            "max_opened": max_opened,
+            "elapsed_sec": round(elapsed, 2),
+            "consistent": not errors,
+            "errors": errors[:5],
+        }
+    )
+
+
+if __name__ == "__main__":
+    main()
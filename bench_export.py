@@ -0,0 +1,104 @@
+"""
+Benchmark: export of the spans
+
+    sends spans, at a fixed rate, through the export pipeline
+    (see: tracer_singleton, span_export) to a local OTLP receiver
+    (see: otlp_receiver), that can be slow or fail.
+
+    For every combination of compression and collector delay it reports:
+    spans received, dropped, failed exports, export latency and the time
+    spent in the application thread for every span.
+
+Usage:
+    python bench_export.py --spans 20000 --rate 2000 --delay_ms 0 500
+"""
+
+import argparse
+import time
+
+from opentelemetry.sdk.trace import TracerProvider
+
+from otlp_receiver import OTLPReceiver
+from tracer_singleton import get_batch_span_processor, get_span_exporter
+
+# as the text of a request, when detailed_tracing is enabled
+PAYLOAD = "What is the best way to use a vector database? " * 40
+
+
+def run(args, compression: str, delay_ms: float) -> dict:
+    """
+    send the spans at the given rate, then wait for the export
+    """
+    receiver = OTLPReceiver(
+        args.port, delay_ms, args.failure_rate, args.protocol
+    ).start()
+
+    processor = get_batch_span_processor(
+        get_span_exporter(receiver.endpoint, args.protocol, compression)
+    )
+    # not the global provider: only the spans of the benchmark
+    provider = TracerProvider()
+    provider.add_span_processor(processor)
+    tracer = provider.get_tracer("bench_export")
+
+    interval = 1.0 / args.rate
+    span_ns = 0
+    time_start = time.perf_counter()
+
+    for i in range(args.spans):
+        # fixed rate: wait for the time of the next span
+        next_time = time_start + i * interval
+        now = time.perf_counter()
+        if next_time > now:
+            time.sleep(next_time - now)
+
+        time_span = time.perf_counter_ns()
+        with tracer.start_as_current_span("bench.span") as span:
+            span.set_attribute("genai-chat-input", PAYLOAD)
+            span.set_attribute("n", i)
+        span_ns += time.perf_counter_ns() - time_span
+
+    elapsed = time.perf_counter() - time_start
+    max_queue_depth = processor.stats.as_dict()["queue_depth"]
+
+    provider.shutdown()
+    receiver.stop()
+
+    stats = processor.stats.as_dict()
+    received = receiver.stats()
+
+    return {
+        "compression": compression,
+        "delay_ms": delay_ms,
+        "spans": args.spans,
+        "received": received["spans"],
+        "received_kb": round(received["bytes"] / 1024, 1),
+        "dropped": stats["dropped_spans"],
+        "export_failures": stats["export_failures"],
+        "avg_export_ms": round(stats["avg_export_ms"], 1),
+        "queue_depth_at_end": max_queue_depth,
+        "span_us": round(span_ns / args.spans / 1000, 1),
+        "rate_sent": round(args.spans / elapsed, 1),
+    }
+
+
+def main():
+    """
+    run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description="export of the spans")
+    parser.add_argument("--spans", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=2000.0)
+    parser.add_argument("--delay_ms", type=float, nargs="+", default=[0.0, 500.0])
+    parser.add_argument("--failure_rate", type=float, default=0.0)
+    parser.add_argument("--protocol", choices=("http", "grpc"), default="http")
+    parser.add_argument("--port", type=int, default=4318)
+    args = parser.parse_args()
+
+    for compression in ["none", "gzip"]:
+        for delay_ms in args.delay_ms:
+            print(run(args, compression, delay_ms))
+
+
+if __name__ == "__main__":
+    main()
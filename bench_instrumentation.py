@@ -0,0 +1,159 @@
+"""
+Benchmark: cost of the instrumentation on the hot paths
+
+    the cost, in ns per call, of a function instrumented as the LLM
+    calls are (a span, the model and the len of the input as attributes):
+    * otel: TRACER.start_as_current_span as decorator, len(str(input))
+    * otel_text_len: the same decorator, with the attributes of traced
+      (to split the cost of the span from the cost of the attributes)
+    * traced: the light layer (see: instrumentation), text_len(input),
+      attributes only if the span is recording
+
+    with tracing on (every span recorded, exported to nowhere),
+    off (no tracer provider) and sampled out (spans created, not recorded).
+    The baseline is the function without any span.
+
+Usage:
+    python bench_instrumentation.py --calls 2000 --messages 10
+"""
+
+import argparse
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.sampling import ALWAYS_OFF, ALWAYS_ON
+
+from instrumentation import text_len, traced
+from tracer_singleton import NoopSpanExporter, get_span_processor
+
+MODEL_ID = "cohere.command-r-08-2024"
+
+
+def build_messages(n_messages: int, chars: int):
+    """
+    a prompt as the one of the QA chain: system, history, question
+    """
+    text = ("The quick brown fox jumps over the lazy dog. " * chars)[:chars]
+    history = [
+        (HumanMessage if i % 2 == 0 else AIMessage)(content=text)
+        for i in range(n_messages - 2)
+    ]
+    return [SystemMessage(content=text), *history, HumanMessage(content=text)]
+
+
+def baseline(messages):
+    # the work done anyway: the len, for the metrics
+    return text_len(messages)
+
+
+def otel_body(messages):
+    current_span = trace.get_current_span()
+    current_span.set_attribute("llm_model", MODEL_ID)
+    input_len = len(str(messages))
+    current_span.set_attribute("llm_model_input_len", input_len)
+    return input_len
+
+
+def traced_body(messages):
+    current_span = trace.get_current_span()
+    input_len = text_len(messages)
+    if current_span.is_recording():
+        current_span.set_attribute("llm_model", MODEL_ID)
+        current_span.set_attribute("llm_model_input_len", input_len)
+    return input_len
+
+
+def get_tracers():
+    """
+    a tracer for every mode, with its provider (not the global one)
+    """
+    providers = {}
+    for mode, sampler in [("on", ALWAYS_ON), ("sampled_out", ALWAYS_OFF)]:
+        provider = TracerProvider(sampler=sampler)
+        # as in the app: batches, tail sampling (see: tracer_singleton)
+        provider.add_span_processor(get_span_processor(NoopSpanExporter()))
+        providers[mode] = provider
+
+    tracers = {"off": trace.NoOpTracer()}
+    tracers.update(
+        {mode: provider.get_tracer("bench") for mode, provider in providers.items()}
+    )
+    return tracers, providers
+
+
+def ns_per_call(func, messages, n_calls: int, repeats: int) -> float:
+    """
+    the best of repeats runs, in ns per call (after a warm-up)
+    """
+    for _ in range(min(n_calls, 100)):
+        func(messages)
+
+    best = None
+    for _ in range(repeats):
+        time_start = time.perf_counter_ns()
+        for _ in range(n_calls):
+            func(messages)
+        elapsed = (time.perf_counter_ns() - time_start) / n_calls
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    """
+    run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description="cost of the instrumentation")
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--chars", type=int, default=2000)
+    args = parser.parse_args()
+
+    messages = build_messages(args.messages, args.chars)
+
+    # much slower: fewer calls
+    n_calls = max(args.calls // 10, 1)
+    for name, func in [
+        ("len(str(input))", lambda m: len(str(m))),
+        ("text_len", text_len),
+    ]:
+        print(
+            {
+                "input_len": name,
+                "ns_per_call": round(
+                    ns_per_call(func, messages, n_calls, args.repeats)
+                ),
+            }
+        )
+
+    tracers, providers = get_tracers()
+
+    for mode, tracer in tracers.items():
+        # measured again for every mode, next to the variants
+        base_ns = ns_per_call(baseline, messages, args.calls, args.repeats)
+        print({"tracing": mode, "baseline_ns": round(base_ns)})
+
+        variants = {
+            "otel": tracer.start_as_current_span("bench.call")(otel_body),
+            "otel_text_len": tracer.start_as_current_span("bench.call")(traced_body),
+            "traced": traced("bench.call", tracer)(traced_body),
+        }
+        for name, func in variants.items():
+            total_ns = ns_per_call(func, messages, args.calls, args.repeats)
+            print(
+                {
+                    "tracing": mode,
+                    "instrumentation": name,
+                    "ns_per_call": round(total_ns),
+                    "overhead_ns": round(total_ns - base_ns),
+                }
+            )
+
+    for provider in providers.values():
+        provider.shutdown()
+
+
+if __name__ == "__main__":
+    main()
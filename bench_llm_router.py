@@ -0,0 +1,199 @@
+"""
+Benchmark: behaviour of the LLM router
+
+    checks the router (see: llm_router) with fake models
+    (see: fake_backends) that fail, are slow or hang:
+    * fallback: a model always failing, the answer from the next one
+    * circuit breaker: open after exactly breaker_failures failures,
+      then the model is skipped
+    * attempt timeout: a hung model is abandoned (invoke and stream),
+      counted once as a failure, also when it ends later
+    * hedging: after the p95 of the model running, the next model answers
+
+    For every check: ok, the time and the details.
+
+Usage:
+    python bench_llm_router.py --latency_ms 50
+"""
+
+import argparse
+import asyncio
+import time
+
+from fake_backends import FakeChatOCIGenAI4APM
+from llm_router import LLMRouter
+
+
+def fake(model_id: str, **kwargs) -> FakeChatOCIGenAI4APM:
+    return FakeChatOCIGenAI4APM(client=object(), model_id=model_id, **kwargs)
+
+
+def router(models, **kwargs) -> LLMRouter:
+    # short backoff: the checks are about the decisions, not the delays
+    params = {"backoff_base_ms": 10, "backoff_max_ms": 50, "hedge_enable": False}
+    params.update(kwargs)
+    return LLMRouter(models=models, **params)
+
+
+def check_fallback(args) -> dict:
+    """
+    a fails at every attempt: retries of a, then b answers
+    """
+    llm = router(
+        [fake("a", latency_ms=args.latency_ms, failure_rate=1.0), fake("b")],
+        max_retries=2,
+    )
+    llm.models[1].latency_ms = args.latency_ms
+
+    answers = [
+        llm.invoke("hi").content,
+        asyncio.run(llm.ainvoke("hi")).content,
+        "".join(chunk.content for chunk in llm.stream("hi")),
+    ]
+    expected = llm.models[1].answer
+
+    return {
+        "ok": all(answer.strip() == expected for answer in answers),
+        "breaker_a": llm.breaker(llm.models[0]).state,
+    }
+
+
+def check_breaker(args) -> dict:
+    """
+    no retries: one failure per call, the circuit opens at the n-th
+    """
+    n_failures = 3
+    llm = router(
+        [
+            fake("a", latency_ms=args.latency_ms, failure_rate=1.0),
+            fake("b", latency_ms=args.latency_ms),
+        ],
+        max_retries=0,
+        breaker_failures=n_failures,
+    )
+    breaker = llm.breaker(llm.models[0])
+
+    states = []
+    for _ in range(n_failures):
+        llm.invoke("hi")
+        states.append(breaker.state)
+
+    # the circuit is open: a is not called
+    time_start = time.perf_counter()
+    llm.invoke("hi")
+    skipped_ms = (time.perf_counter() - time_start) * 1000.0
+
+    return {
+        "ok": states == ["closed"] * (n_failures - 1) + ["open"],
+        "states": states,
+        "call_with_open_circuit_ms": round(skipped_ms, 1),
+    }
+
+
+def check_timeout(args) -> dict:
+    """
+    a hangs: abandoned after attempt_timeout_sec, b answers;
+    the failure of a is counted once, also after a ends
+
+    the answer of a is a single token: the stream hangs before the first one
+    """
+    hang_ms = 1000.0
+    timeout_sec = 0.2
+    checks = {}
+
+    for call in ["invoke", "stream"]:
+        llm = router(
+            [
+                fake("a", latency_ms=hang_ms, answer="hung"),
+                fake("b", latency_ms=args.latency_ms),
+            ],
+            attempt_timeout_sec=timeout_sec,
+            max_retries=0,
+            breaker_failures=2,
+        )
+        breaker = llm.breaker(llm.models[0])
+
+        time_start = time.perf_counter()
+        if call == "invoke":
+            answer = llm.invoke("hi").content
+        else:
+            answer = "".join(chunk.content for chunk in llm.stream("hi"))
+        elapsed_ms = (time.perf_counter() - time_start) * 1000.0
+
+        # the attempt of a ends, late
+        time.sleep(hang_ms / 1000.0)
+
+        checks[call] = {
+            "answer_b": answer.strip() == llm.models[1].answer,
+            "elapsed_ms": round(elapsed_ms, 1),
+            # pylint: disable=protected-access
+            "failures_a": breaker._failures,
+        }
+
+    return {
+        "ok": all(
+            result["answer_b"]
+            and result["failures_a"] == 1
+            and result["elapsed_ms"] < hang_ms
+            for result in checks.values()
+        ),
+        **checks,
+    }
+
+
+def check_hedge(args) -> dict:
+    """
+    a is slow this time: b is called after the p95 of a (not of b)
+    """
+    p95_a_ms = 100.0
+    llm = router(
+        [fake("a", latency_ms=2000.0), fake("b", latency_ms=args.latency_ms)],
+        hedge_enable=True,
+        hedge_after_ms=5000.0,
+    )
+    for _ in range(20):
+        llm.latencies(llm.models[0]).add(p95_a_ms)
+        llm.latencies(llm.models[1]).add(5000.0)
+
+    time_start = time.perf_counter()
+    answer = asyncio.run(llm.ainvoke("hi")).content
+    elapsed_ms = (time.perf_counter() - time_start) * 1000.0
+
+    return {
+        "ok": answer == llm.models[1].answer
+        and elapsed_ms < p95_a_ms + args.latency_ms + 200.0,
+        "elapsed_ms": round(elapsed_ms, 1),
+    }
+
+
+def main():
+    """
+    run the checks and print the results
+    """
+    parser = argparse.ArgumentParser(description="behaviour of the LLM router")
+    parser.add_argument("--latency_ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    results = []
+    for name, check in [
+        ("fallback", check_fallback),
+        ("breaker", check_breaker),
+        ("timeout", check_timeout),
+        ("hedge", check_hedge),
+    ]:
+        time_start = time.perf_counter()
+        result = check(args)
+        results.append(result["ok"])
+        print(
+            {
+                "check": name,
+                **result,
+                "elapsed_sec": round(time.perf_counter() - time_start, 2),
+            }
+        )
+
+    print({"all_ok": all(results)})
+
+
+if __name__ == "__main__":
+    main()
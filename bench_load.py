@@ -0,0 +1,310 @@
+"""
+Benchmark: load test of the RAG API
+
+    drives main_rag.app (in process, through the ASGI interface) at fixed
+    request rates, with local fakes (see: fake_backends) in place of
+    OCI GenAI and Oracle DB, latencies drawn from a distribution.
+
+    The load is open loop: requests are sent at their scheduled time,
+    whatever the time taken by the previous ones, and the latency is
+    measured from the scheduled time (no coordinated omission).
+
+    For every rate it reports: latency p50/p95/p99, throughput,
+    requests rejected (admission control) or failed, memory growth.
+
+    Every run is done with tracing on (spans exported to a local OTLP
+    receiver, see: otlp_receiver) and off, each in a new process
+    (the tracer is set up once per process). The results are saved
+    as JSON, to compare runs.
+
+Usage:
+    python bench_load.py --rates 5 10 20 --duration_sec 20 --dist lognormal
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# not the modules creating the tracer (fake_backends, main_rag...):
+# they're imported in the worker, after the tracing settings
+from config_reader import get_config
+
+# the line with the results of a worker process
+RESULT_PREFIX = "BENCH_RESULT "
+
+
+def rss_mb() -> float:
+    """
+    resident memory of the process (peak if /proc is not available)
+    """
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(latencies_ms) -> dict:
+    if not latencies_ms:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {
+        "p50_ms": round(float(p50), 1),
+        "p95_ms": round(float(p95), 1),
+        "p99_ms": round(float(p99), 1),
+    }
+
+
+async def send_request(client, args, i: int, conv_id: str) -> str:
+    """
+    one request, the outcome: ok, rejected or error
+    """
+    body = {"query": f"Question n. {i % args.distinct if args.distinct else i}"}
+
+    if args.endpoint == "stream":
+        async with client.stream(
+            "POST", f"/stream/?conv_id={conv_id}", json=body
+        ) as response:
+            text = "".join([chunk async for chunk in response.aiter_text()])
+        failed = "event: error" in text
+    else:
+        response = await client.post(f"/invoke/?conv_id={conv_id}", json=body)
+        failed = response.text.startswith("Error:")
+
+    if response.status_code in (429, 503):
+        return "rejected"
+    if response.status_code != 200 or failed:
+        return "error"
+    return "ok"
+
+
+async def run_rate(client, args, rate: float) -> dict:
+    """
+    send requests at a fixed rate, for duration_sec
+    """
+    n_requests = max(1, int(rate * args.duration_sec))
+    latencies_ms = []
+    outcomes = {"ok": 0, "rejected": 0, "error": 0}
+
+    async def _timed(i: int, scheduled: float):
+        try:
+            outcome = await send_request(client, args, i, f"load-{rate}-{i}")
+        except Exception:
+            outcome = "error"
+        outcomes[outcome] += 1
+        if outcome == "ok":
+            latencies_ms.append((time.perf_counter() - scheduled) * 1000.0)
+
+    rss_start = rss_mb()
+    tasks = []
+    time_start = time.perf_counter()
+
+    for i in range(n_requests):
+        scheduled = time_start + i / rate
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(_timed(i, scheduled)))
+
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - time_start
+
+    return {
+        "rate_rps": rate,
+        "sent": n_requests,
+        **outcomes,
+        **percentiles(latencies_ms),
+        "throughput_rps": round(outcomes["ok"] / elapsed, 2),
+        "rss_mb": round(rss_mb(), 1),
+        "rss_growth_mb": round(rss_mb() - rss_start, 1),
+    }
+
+
+async def run_rates(args) -> list:
+    """
+    all the rates, one after the other, on the same app
+    """
+    # imported here: after the tracing settings have been overridden
+    # pylint: disable=import-outside-toplevel
+    import httpx
+
+    import main_rag
+    from chain_registry import ChainRegistry
+    from fake_backends import build_fake_rag_chain_with_embeddings
+
+    main_rag.chain_registry = ChainRegistry(
+        builder=lambda: build_fake_rag_chain_with_embeddings(
+            llm_latency_ms=args.llm_latency_ms,
+            embed_latency_ms=args.embed_latency_ms,
+            db_latency_ms=args.db_latency_ms,
+            latency_dist=args.dist,
+        )
+    )
+
+    transport = httpx.ASGITransport(app=main_rag.app)
+    results = []
+
+    # the lifespan of the app is not run by the transport
+    async with main_rag.lifespan(main_rag.app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=None
+        ) as client:
+            # not measured: the first request pays for imports and caches
+            await send_request(client, args, -1, "load-warm-up")
+
+            rss_start = rss_mb()
+            for rate in args.rates:
+                result = await run_rate(client, args, rate)
+                result["rss_total_growth_mb"] = round(rss_mb() - rss_start, 1)
+                results.append(result)
+
+    return results
+
+
+def run_worker(args):
+    """
+    the benchmark in this process, with tracing on or off
+    """
+    receiver = None
+
+    # before the tracer is created (at the import of main_rag)
+    config_tracing = get_config("./config_tracing.toml")
+    # the settings read by the tracer (with find_key), in any section
+    config_tracing.override(
+        config_tracing.key_path("trace_enable") or "tracing.trace_enable",
+        args.tracing == "on",
+    )
+
+    if args.tracing == "on":
+        # pylint: disable=import-outside-toplevel
+        from otlp_receiver import OTLPReceiver
+
+        receiver = OTLPReceiver(args.port).start()
+        config_tracing.override(
+            config_tracing.key_path("apm_endpoint") or "tracing.apm_endpoint",
+            receiver.endpoint,
+        )
+
+    # the log of every request would be measured too
+    logging.getLogger("ConsoleLogger").setLevel(logging.WARNING)
+
+    results = asyncio.run(run_rates(args))
+
+    output = {"tracing": args.tracing, "results": results}
+    if receiver is not None:
+        # spans still in the queue of the exporter are not counted
+        output["spans_received"] = receiver.stats()["spans"]
+        receiver.stop()
+
+    print(RESULT_PREFIX + json.dumps(output), flush=True)
+
+
+def run_process(tracing: str) -> dict:
+    """
+    run the benchmark in a new process, with tracing on or off
+    """
+    argv = [arg for arg in sys.argv[1:] if arg != "--worker"]
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), *argv, "--worker"]
+        + ["--tracing", tracing],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX) :])
+
+    raise RuntimeError(f"Benchmark with tracing {tracing} failed:\n{completed.stderr}")
+
+
+def overhead_pct(on: dict, off: dict, key: str):
+    if not on[key] or not off[key]:
+        return None
+    return round((on[key] - off[key]) / off[key] * 100.0, 1)
+
+
+def compare(runs: dict) -> list:
+    """
+    cost of the tracing at every rate, in % (on vs off)
+    """
+    return [
+        {
+            "rate_rps": off["rate_rps"],
+            **{
+                f"{key}_pct": overhead_pct(on, off, key)
+                for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps")
+            },
+        }
+        for on, off in zip(runs["on"]["results"], runs["off"]["results"])
+    ]
+
+
+def main():
+    """
+    run the benchmark, print and save the results
+    """
+    parser = argparse.ArgumentParser(description="load test of the RAG API")
+    parser.add_argument("--rates", type=float, nargs="+", default=[5.0, 10.0, 20.0])
+    parser.add_argument("--duration_sec", type=float, default=20.0)
+    parser.add_argument("--endpoint", choices=("invoke", "stream"), default="invoke")
+    # num. of different questions (0: all different, no semantic cache hits)
+    parser.add_argument("--distinct", type=int, default=0)
+    # fixed, uniform, exponential, lognormal (see: fake_backends)
+    parser.add_argument("--dist", default="lognormal")
+    parser.add_argument("--llm_latency_ms", type=float, default=1000.0)
+    parser.add_argument("--embed_latency_ms", type=float, default=50.0)
+    parser.add_argument("--db_latency_ms", type=float, default=20.0)
+    parser.add_argument("--port", type=int, default=4319)
+    parser.add_argument("--output", default="")
+    # internal: the run in a worker process
+    parser.add_argument("--worker", action="store_true")
+    parser.add_argument("--tracing", choices=("on", "off"), default="off")
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    runs = {}
+    for tracing in ["off", "on"]:
+        runs[tracing] = run_process(tracing)
+        for result in runs[tracing]["results"]:
+            print({"tracing": tracing, **result})
+
+    overhead = compare(runs)
+    for row in overhead:
+        print({"tracing_overhead": True, **row})
+
+    output_file = args.output or time.strftime("bench_load_%Y%m%d_%H%M%S.json")
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "args": {
+                    k: v
+                    for k, v in vars(args).items()
+                    if k not in ("worker", "tracing")
+                },
+                "runs": runs,
+                "tracing_overhead": overhead,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results saved in {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Benchmark: local vector store, IVF index vs exact search
+
+    builds a local index with synthetic clustered embeddings (as the
+    chunks of a set of books), then for every value of n_probes compares
+    the IVF results with the exact top-k:
+    * recall@k (fraction of the exact top-k found)
+    * latency of a query (p50, p95), exact search included
+
+Usage:
+    python bench_local_vs.py --rows 100000 --dim 1024 --probes 4 8 16 32
+"""
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from local_vector_store import LocalVectorIndex
+
+
+class SyntheticSource:
+    """
+    rows around n_topics random directions (embeddings are never uniform)
+    """
+
+    def __init__(self, n_rows: int, dim: int, n_topics: int):
+        rng = np.random.default_rng(42)
+        topics = rng.standard_normal((n_topics, dim)).astype(np.float32)
+        self.topic_of = rng.integers(0, n_topics, n_rows)
+        self.vectors = topics[self.topic_of] + 1.5 * rng.standard_normal(
+            (n_rows, dim)
+        ).astype(np.float32)
+        self.topics = topics
+
+    def ids(self):
+        return [f"{i:016X}" for i in range(len(self.vectors))]
+
+    def rows(self, ids):
+        for id_ in ids:
+            i = int(id_, 16)
+            yield id_, f"chunk {i}", {"topic": int(self.topic_of[i])}, self.vectors[i]
+
+    def queries(self, n_queries: int) -> np.ndarray:
+        rng = np.random.default_rng(7)
+        picked = self.topics[rng.integers(0, len(self.topics), n_queries)]
+        return picked + 1.5 * rng.standard_normal(picked.shape).astype(np.float32)
+
+
+def percentiles(latencies_ms):
+    return {
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies_ms, 95)), 3),
+    }
+
+
+def run_queries(index: LocalVectorIndex, queries, k: int, exact: bool):
+    """
+    the rows found for every query, the latencies
+    """
+    results, latencies_ms = [], []
+
+    for query in queries:
+        time_start = time.perf_counter()
+        found = index.search(query, k=k, exact=exact)
+        latencies_ms.append((time.perf_counter() - time_start) * 1000.0)
+        results.append({row for row, _ in found})
+
+    return results, latencies_ms
+
+
+def main():
+    """
+    run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description="local vector store, IVF vs exact")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--topics", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top_k", type=int, default=6)
+    parser.add_argument("--lists", type=int, default=0)
+    parser.add_argument("--probes", type=int, nargs="+", default=[8, 16, 32, 64])
+    # 0: the IVF index at any size (the store uses exact search below min_rows)
+    parser.add_argument("--min_rows", type=int, default=0)
+    args = parser.parse_args()
+
+    source = SyntheticSource(args.rows, args.dim, args.topics)
+    queries = source.queries(args.queries)
+
+    index = LocalVectorIndex(
+        tempfile.mkdtemp(),
+        "BENCH",
+        index_type="ivf",
+        ivf_lists=args.lists,
+        ivf_min_rows=args.min_rows,
+    )
+    time_start = time.perf_counter()
+    index.refresh(source)
+    print(
+        {
+            "rows": args.rows,
+            "dim": args.dim,
+            "load_sec": round(time.perf_counter() - time_start, 2),
+        }
+    )
+
+    exact_results, latencies_ms = run_queries(index, queries, args.top_k, exact=True)
+    print({"index": "exact", "recall": 1.0, **percentiles(latencies_ms)})
+
+    for n_probes in args.probes:
+        index.ivf_probes = n_probes
+        results, latencies_ms = run_queries(index, queries, args.top_k, exact=False)
+
+        recall = np.mean(
+            [
+                len(found & expected) / len(expected)
+                for found, expected in zip(results, exact_results)
+            ]
+        )
+        print(
+            {
+                "index": "ivf",
+                "probes": n_probes,
+                "recall": round(float(recall), 3),
+                **percentiles(latencies_ms),
+            }
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Benchmark: tail sampling
+
+    checks the decisions of the tail sampling (see: tail_sampling)
+    on generated traces (a root span, a child and a child ending after
+    the root), with an in-memory exporter:
+    * the traces with errors are always kept
+    * the slow traces are always kept
+    * the others are kept for about sample_rate %, of the traces recorded
+      by the head sampler (the two decisions are independent)
+    * the spans of a kept trace are all exported, none of a dropped one
+
+    The checks are repeated for every head sampling rate.
+
+    It reports the traces kept by kind and the time spent in the
+    application thread for every span.
+
+Usage:
+    python bench_tail_sampling.py --traces 10000 --sample_rate 10 --head_rates 100 50
+"""
+
+import argparse
+import time
+from collections import Counter, defaultdict
+
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+    InMemorySpanExporter,
+)
+from opentelemetry.sdk.trace.sampling import TraceIdRatioBased
+from opentelemetry.trace import Status, StatusCode
+
+from tail_sampling import TailSamplingSpanProcessor
+
+SPANS_PER_TRACE = 3
+
+
+def trace_kind(i: int) -> str:
+    """
+    one trace in ten with an error, one in ten slow
+    """
+    if i % 10 == 0:
+        return "error"
+    if i % 10 == 1:
+        return "slow"
+    return "normal"
+
+
+def record_trace(tracer, kind: str, slow_ms: float) -> int | None:
+    """
+    record a trace of the given kind, return its trace_id
+    (None if not recorded by the head sampler)
+    """
+    start_ns = time.time_ns()
+    # the duration of the root: the threshold for the slow traces
+    duration_ns = int((2 * slow_ms if kind == "slow" else slow_ms / 10) * 1e6)
+
+    root = tracer.start_span("bench.root", start_time=start_ns)
+    context = trace.set_span_in_context(root)
+
+    child = tracer.start_span("bench.child", context=context, start_time=start_ns)
+    if kind == "error":
+        child.set_status(Status(StatusCode.ERROR))
+    child.end(end_time=start_ns + duration_ns // 2)
+
+    late = tracer.start_span("bench.late", context=context, start_time=start_ns)
+    root.end(end_time=start_ns + duration_ns)
+    # after the decision on the trace
+    late.end(end_time=start_ns + duration_ns + 1)
+
+    if not root.get_span_context().trace_flags.sampled:
+        return None
+    return root.get_span_context().trace_id
+
+
+def run(args, head_rate: float) -> dict:
+    """
+    record the traces, compare the exported spans with the expected decisions
+
+    head_rate: % of the traces recorded by the head sampler
+    """
+    exporter = InMemorySpanExporter()
+    processor = TailSamplingSpanProcessor(
+        SimpleSpanProcessor(exporter),
+        slow_ms=args.slow_ms,
+        sample_rate=args.sample_rate / 100.0,
+    )
+    # not the global provider: only the spans of the benchmark
+    provider = TracerProvider(sampler=TraceIdRatioBased(head_rate / 100.0))
+    provider.add_span_processor(processor)
+    tracer = provider.get_tracer("bench_tail_sampling")
+
+    kinds = {}
+    time_start = time.perf_counter()
+    for i in range(args.traces):
+        kind = trace_kind(i)
+        trace_id = record_trace(tracer, kind, args.slow_ms)
+        if trace_id is not None:
+            kinds[trace_id] = kind
+    elapsed = time.perf_counter() - time_start
+
+    exported = defaultdict(int)
+    for span in exporter.get_finished_spans():
+        exported[span.context.trace_id] += 1
+
+    errors = []
+    total = Counter(kinds.values())
+    kept = Counter(kinds[trace_id] for trace_id in exported)
+
+    for kind in ["error", "slow"]:
+        if kept[kind] != total[kind]:
+            errors.append(f"{kind}: kept {kept[kind]} of {total[kind]}")
+
+    incomplete = [n for n in exported.values() if n != SPANS_PER_TRACE]
+    if incomplete:
+        errors.append(f"{len(incomplete)} traces exported with missing spans")
+
+    # the sampling is on the random trace_id: a tolerance of 2 points
+    # (of the traces recorded: not correlated with the head decision)
+    normal_rate = 100.0 * kept["normal"] / max(total["normal"], 1)
+    if abs(normal_rate - args.sample_rate) > 2.0:
+        errors.append(f"normal: kept {normal_rate:.1f}%, not {args.sample_rate}%")
+
+    provider.shutdown()
+
+    return {
+        "traces": args.traces,
+        "head_rate_pct": head_rate,
+        "recorded": len(kinds),
+        "kept_error": f"{kept['error']}/{total['error']}",
+        "kept_slow": f"{kept['slow']}/{total['slow']}",
+        "kept_normal_pct": round(normal_rate, 1),
+        "sample_rate_pct": args.sample_rate,
+        "span_us": round(elapsed / (args.traces * SPANS_PER_TRACE) * 1e6, 1),
+        "consistent": not errors,
+        "errors": errors[:5],
+    }
+
+
+def main():
+    """
+    run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description="decisions of the tail sampling")
+    parser.add_argument("--traces", type=int, default=10000)
+    parser.add_argument("--sample_rate", type=float, default=10.0)
+    parser.add_argument("--slow_ms", type=float, default=5000.0)
+    parser.add_argument("--head_rates", type=float, nargs="+", default=[100.0, 50.0])
+    args = parser.parse_args()
+
+    for head_rate in args.head_rates:
+        print(run(args, head_rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Chain Registry
+
+    to build the RAG chain once per process and hand the ready
+    chain to every request, instead of rebuilding it on each call
+
+    The chain is rebuilt only for errors that a rebuild can fix
+    (configuration, credentials), not for timeouts or throttling.
+    In the async API the build runs in a thread, not in the event loop.
+"""
+
+import threading
+import time
+
+from langchain_core.runnables.config import run_in_executor
+from oci.exceptions import ConfigFileNotFound, InvalidConfig
+from opentelemetry import trace
+
+import factory
+from tracer_singleton import TracerSingleton
+from utils import get_console_logger
+
+logger = get_console_logger()
+
+# for APM integration
+TRACER = TracerSingleton.get_instance()
+
+
+# as in oci.exceptions.ServiceError: not authorized, model or compartment
+# not found. Timeouts, throttling (429) and 5xx go away without a rebuild
+CONFIG_ERROR_STATUSES = (401, 403, 404)
+
+
+def is_config_error(error: BaseException) -> bool:
+    """
+    true for the errors that a rebuild of the chain (with the config
+    reloaded) can fix
+    """
+    status = getattr(error, "status", None)
+    if isinstance(status, int):
+        return status in CONFIG_ERROR_STATUSES
+
+    return isinstance(error, (ConfigFileNotFound, InvalidConfig))
+
+
+def build_chain():
+    """
+    the default builder: the RAG chain (see: factory) and its embed model
+    """
+    embed_model = factory.get_embed_model()
+
+    return factory.build_rag_chain(embed_model=embed_model), embed_model
+
+
+class ChainRegistry:
+    """
+    Keep a single, ready to use, RAG chain.
+
+    The chain is rebuilt only when:
+    * config.toml has been reloaded with different values
+    * a component has been marked unhealthy (see mark_unhealthy, report_error)
+    """
+
+    def __init__(self, builder=None):
+        """
+        builder: callable returning a new chain and its embed model
+            (default: build_chain)
+        """
+        self._builder = builder if builder is not None else build_chain
+        self._lock = threading.Lock()
+
+        self._chain = None
+        self._embed_model = None
+        self._config_version = factory.config.version
+        self._unhealthy = set()
+
+        # stats, sent to APM as span attributes
+        self._build_count = 0
+        self._reuse_hits = 0
+        self._last_build_time_ms = 0.0
+
+    def _config_changed(self) -> bool:
+        """
+        check if config.toml has been reloaded since the last build
+
+        only the version is compared: the file is checked and reloaded
+        by the watcher thread of the shared config (see: config_reader.watch)
+        """
+        return factory.config.version != self._config_version
+
+    def _needs_rebuild(self) -> bool:
+        return self._chain is None or bool(self._unhealthy) or self._config_changed()
+
+    def _build(self):
+        """
+        build the chain and record the time spent
+        """
+        if self._unhealthy:
+            logger.info("Rebuilding RAG chain, unhealthy: %s", sorted(self._unhealthy))
+
+        time_start = time.perf_counter()
+        # build_rag_chain mark a span (see: factory)
+        chain, embed_model = self._builder()
+        self._last_build_time_ms = (time.perf_counter() - time_start) * 1000.0
+
+        self._chain = chain
+        self._embed_model = embed_model
+        self._config_version = factory.config.version
+        self._unhealthy.clear()
+        self._build_count += 1
+
+        logger.info("RAG chain built in %.1f ms", self._last_build_time_ms)
+
+    def get_chain(self):
+        """
+        return the ready chain, (re)building it only if needed
+        """
+        chain, _ = self.get_chain_with_embeddings()
+
+        return chain
+
+    def get_chain_with_embeddings(self):
+        """
+        the ready chain and the embed model it uses (for example,
+        to embed in advance the questions of a batch)
+        """
+        reused = True
+
+        with self._lock:
+            if self._needs_rebuild():
+                self._build()
+                reused = False
+            else:
+                self._reuse_hits += 1
+
+            chain, embed_model = self._chain, self._embed_model
+
+        self._set_attributes(reused)
+
+        return chain, embed_model
+
+    async def aget_chain(self):
+        """
+        async version of get_chain
+        """
+        chain, _ = await self.aget_chain_with_embeddings()
+
+        return chain
+
+    async def aget_chain_with_embeddings(self):
+        """
+        async version of get_chain_with_embeddings
+
+        the ready chain is returned at once; the build (blocking), or the
+        wait for the build started by another request, runs in a thread
+        """
+        # never wait for the lock in the event loop
+        if self._lock.acquire(blocking=False):
+            try:
+                ready = not self._needs_rebuild()
+                if ready:
+                    self._reuse_hits += 1
+                    chain, embed_model = self._chain, self._embed_model
+            finally:
+                self._lock.release()
+
+            if ready:
+                self._set_attributes(True)
+                return chain, embed_model
+
+        # the context is copied: the attributes go to the current span
+        return await run_in_executor(None, self.get_chain_with_embeddings)
+
+    def _set_attributes(self, reused: bool):
+        # here we send to APM how the chain has been obtained
+        current_span = trace.get_current_span()
+        current_span.set_attribute("chain_reused", reused)
+        current_span.set_attribute("chain_reuse_hits", self._reuse_hits)
+        current_span.set_attribute("chain_build_count", self._build_count)
+        current_span.set_attribute("chain_build_time_ms", self._last_build_time_ms)
+
+    def warm_up(self):
+        """
+        build the chain at startup, so that the first request doesn't pay for it
+        """
+        try:
+            self.get_chain()
+        except Exception as e:
+            # the chain will be built again at the first request
+            logger.error("Error building the RAG chain at startup: %s", e)
+
+    def mark_unhealthy(self, component: str):
+        """
+        signal that a component of the chain (LLM, vector store...) is not healthy
+
+        the chain will be rebuilt at the next request
+        """
+        logger.info("Component %s marked unhealthy", component)
+
+        with self._lock:
+            self._unhealthy.add(component)
+
+    def report_error(self, component: str, error: BaseException):
+        """
+        an error in a request: the component is marked unhealthy only if
+        a rebuild can fix it (see: is_config_error)
+        """
+        if is_config_error(error):
+            self.mark_unhealthy(component)
@@ -2,16 +2,19 @@
 For integration with APM
 """
 
-from typing import Any, List
+from typing import Any, AsyncIterator, Iterator, List
 
 from langchain_core.runnables.config import RunnableConfig
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import BaseMessage, BaseMessageChunk
 from langchain_core.language_models import LanguageModelInput
 from langchain_community.chat_models import ChatOCIGenAI
 from opentelemetry import trace
 
 from tracer_singleton import TracerSingleton
-
+from instrumentation import text_len, traced
+from stream_tracing import StreamStats, traced_iter, atraced_iter
+from token_budget import count_messages_tokens, count_tokens
+from app_metrics import LLM_LATENCY, record_llm_usage, timed
 
 TRACER = TracerSingleton.get_instance()
 
@@ -21,7 +24,7 @@ class ChatOCIGenAI4APM(ChatOCIGenAI):
     Extension for integration with Application Performance Monitoring (APM).
     """
 
-    @TRACER.start_as_current_span("ChatOCIGenAI.invoke")
+    @traced("ChatOCIGenAI.invoke")
     def invoke(
         self,
         input: LanguageModelInput,
@@ -45,20 +48,106 @@ class ChatOCIGenAI4APM(ChatOCIGenAI):
 
         # here we show how to send to SPM a value
         current_span = trace.get_current_span()
-        current_span.set_attribute("llm_model", self.model_id)
+        if current_span.is_recording():
+            current_span.set_attribute("llm_model", self.model_id)
+
+        with timed(LLM_LATENCY, {"model": self.model_id, "call": "invoke"}):
+            output = super().invoke(input, config=config, stop=stop, **kwargs)
+
+        self._set_len_attributes(current_span, input, output)
+
+        return output
+
+    @traced("ChatOCIGenAI.invoke")
+    async def ainvoke(
+        self,
+        input: LanguageModelInput,
+        config: RunnableConfig | None = None,
+        *,
+        stop: List[str] | None = None,
+        **kwargs: Any
+    ) -> BaseMessage:
+        """
+        Async version of invoke, with the same APM integration.
+
+        Args:
+            input (LanguageModelInput): The input for the language model.
+            config (RunnableConfig, optional): Configuration for the run. Defaults to None.
+            stop (List[str], optional): List of stop words. Defaults to None.
+            **kwargs: Additional keyword arguments.
 
-        output = super().invoke(input, config=config, stop=stop, **kwargs)
+        Returns:
+            BaseMessage: The output from the language model.
+        """
+        current_span = trace.get_current_span()
+        if current_span.is_recording():
+            current_span.set_attribute("llm_model", self.model_id)
 
-        # len in chars of input, output
-        llm_model_input_len = len(str(input))
-        llm_model_output_len = len(str(output.content))
+        with timed(LLM_LATENCY, {"model": self.model_id, "call": "invoke"}):
+            output = await super().ainvoke(input, config=config, stop=stop, **kwargs)
 
-        current_span.set_attribute("llm_model_input_len", llm_model_input_len)
-        current_span.set_attribute("llm_model_output_len", llm_model_output_len)
+        self._set_len_attributes(current_span, input, output)
 
         return output
 
-    @TRACER.start_as_current_span("stream")
+    def _input_len(self, input):
+        """
+        len in chars and num. of tokens (estimated locally) of the input
+
+        the chars of the text only, counted without building a string
+        """
+        # pylint: disable=redefined-builtin
+        llm_model_input_len = text_len(input)
+        # estimated locally (see: token_budget)
+        llm_model_input_tokens = count_messages_tokens(
+            self._convert_input(input).to_messages()
+        )
+        return llm_model_input_len, llm_model_input_tokens
+
+    def _set_len_attributes(self, current_span, input, output):
+        """
+        send to APM len in chars of input, output and num. of input tokens
+
+        the same values are recorded as metrics (see: app_metrics),
+        also if the span is not recording
+        """
+        # pylint: disable=redefined-builtin
+        llm_model_input_len, llm_model_input_tokens = self._input_len(input)
+        output_text = str(output.content)
+        llm_model_output_len = len(output_text)
+
+        if current_span.is_recording():
+            current_span.set_attribute("llm_model_input_len", llm_model_input_len)
+            current_span.set_attribute("llm_model_output_len", llm_model_output_len)
+            current_span.set_attribute("llm_model_input_tokens", llm_model_input_tokens)
+
+        record_llm_usage(
+            self.model_id,
+            llm_model_input_len,
+            llm_model_input_tokens,
+            llm_model_output_len,
+            count_tokens(output_text),
+        )
+
+    def _record_stream_usage(self, span, input, stats: StreamStats):
+        """
+        send to APM the size of the input, record the usage of the stream
+        """
+        # pylint: disable=redefined-builtin
+        llm_model_input_len, llm_model_input_tokens = self._input_len(input)
+
+        if span.is_recording():
+            span.set_attribute("llm_model_input_len", llm_model_input_len)
+            span.set_attribute("llm_model_input_tokens", llm_model_input_tokens)
+
+        record_llm_usage(
+            self.model_id,
+            llm_model_input_len,
+            llm_model_input_tokens,
+            stats.n_chars,
+            stats.n_tokens,
+        )
+
     def stream(
         self,
         input: LanguageModelInput,
@@ -66,9 +155,11 @@ class ChatOCIGenAI4APM(ChatOCIGenAI):
         *,
         stop: List[str] | None = None,
         **kwargs: Any
-    ):
+    ) -> Iterator[BaseMessageChunk]:
         """
-        Invokes the ChatOCIGenAI model with APM integration.
+        Stream from the ChatOCIGenAI model with APM integration.
+
+        The span stays open until the last token has been received.
 
         Args:
             input (LanguageModelInput): The input for the language model.
@@ -79,9 +170,48 @@ class ChatOCIGenAI4APM(ChatOCIGenAI):
         Returns:
             stream generator
         """
-        current_span = trace.get_current_span()
-        current_span.set_attribute("llm_model", self.model_id)
-
-        generator = super().stream(input, config=config, stop=stop, **kwargs)
+        span = TRACER.start_span("ChatOCIGenAI.stream")
+        span.set_attribute("llm_model", self.model_id)
+        stats = StreamStats()
+
+        try:
+            with timed(LLM_LATENCY, {"model": self.model_id, "call": "stream"}):
+                generator = super().stream(input, config=config, stop=stop, **kwargs)
+
+                for chunk in traced_iter(span, generator):
+                    stats.add_token(chunk.content)
+                    yield chunk
+        finally:
+            stats.set_attributes(span)
+            self._record_stream_usage(span, input, stats)
+            span.end()
+
+    async def astream(
+        self,
+        input: LanguageModelInput,
+        config: RunnableConfig | None = None,
+        *,
+        stop: List[str] | None = None,
+        **kwargs: Any
+    ) -> AsyncIterator[BaseMessageChunk]:
+        """
+        Async version of stream, with the same APM integration.
 
-        return generator
+        Returns:
+            async stream generator
+        """
+        span = TRACER.start_span("ChatOCIGenAI.stream")
+        span.set_attribute("llm_model", self.model_id)
+        stats = StreamStats()
+
+        try:
+            with timed(LLM_LATENCY, {"model": self.model_id, "call": "stream"}):
+                generator = super().astream(input, config=config, stop=stop, **kwargs)
+
+                async for chunk in atraced_iter(span, generator):
+                    stats.add_token(chunk.content)
+                    yield chunk
+        finally:
+            stats.set_attributes(span)
+            self._record_stream_usage(span, input, stats)
+            span.end()
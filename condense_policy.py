@@ -0,0 +1,188 @@
+"""
+Condense Policy
+
+    to decide when the question must be reformulated (condensed) by the LLM
+    as a standalone question, using the chat history
+
+    modes:
+    * always: the LLM is always called
+    * never: the question is used as is
+    * history_only: the LLM is called only if the history has at least
+      min_history_msgs messages
+    * heuristic: as history_only, but the LLM is not called if the question
+      doesn't contain pronouns or references to the history
+
+    condensed questions are cached per (conv_id, history, question)
+"""
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import RunnableLambda
+from opentelemetry import trace
+
+CONDENSE_MODES = ("always", "never", "history_only", "heuristic")
+
+# words that make a question depend on the history
+REFERENCES = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|him|his|she|her|"
+    r"former|latter|above|previous|same|there|else|other|another|more|also|"
+    r"again|then|why|how about|what about)\b",
+    re.IGNORECASE,
+)
+# questions shorter than this are considered follow-ups
+MIN_STANDALONE_WORDS = 4
+
+# weight of the last measure in the average latency of the LLM call
+EWMA_ALPHA = 0.2
+
+
+class CondensePolicy:
+    """
+    Condensation of the question, according to the configured mode
+    """
+
+    def __init__(
+        self,
+        mode: str = "history_only",
+        min_history_msgs: int = 1,
+        cache_max_entries: int = 1000,
+    ):
+        if mode not in CONDENSE_MODES:
+            raise ValueError(
+                f"Invalid condense mode: {mode}, must be one of {CONDENSE_MODES}"
+            )
+
+        self.mode = mode
+        self.min_history_msgs = min_history_msgs
+        self.cache_max_entries = cache_max_entries
+
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        # average latency of the LLM call, used to estimate the time saved
+        self._avg_condense_ms: Optional[float] = None
+
+    @staticmethod
+    def needs_history(question: str) -> bool:
+        """
+        heuristic: true if the question seems to refer to the chat history
+        """
+        if len(question.split()) < MIN_STANDALONE_WORDS:
+            return True
+        return REFERENCES.search(question) is not None
+
+    def skip_reason(self, question: str, chat_history: List[BaseMessage]) -> str:
+        """
+        why the LLM call can be skipped, empty string if it can't
+        """
+        if self.mode == "always":
+            return ""
+        if self.mode == "never":
+            return "never"
+        if len(chat_history) < self.min_history_msgs:
+            return "short_history"
+        if self.mode == "heuristic" and not self.needs_history(question):
+            return "no_references"
+        return ""
+
+    @staticmethod
+    def _cache_key(conv_id: str, chat_history: List[BaseMessage], question: str):
+        digest = hashlib.sha256(conv_id.encode("utf-8"))
+        for msg in chat_history:
+            digest.update(f"\x00{msg.type}\x00{msg.content}".encode("utf-8"))
+        digest.update(f"\x01{question}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _cache_get(self, key: str) -> Optional[str]:
+        with self._lock:
+            standalone_question = self._cache.get(key)
+            if standalone_question is not None:
+                self._cache.move_to_end(key)
+            return standalone_question
+
+    def _cache_put(self, key: str, standalone_question: str, condense_ms: float):
+        with self._lock:
+            self._cache[key] = standalone_question
+            while len(self._cache) > self.cache_max_entries:
+                self._cache.popitem(last=False)
+
+            if self._avg_condense_ms is None:
+                self._avg_condense_ms = condense_ms
+            else:
+                self._avg_condense_ms += EWMA_ALPHA * (
+                    condense_ms - self._avg_condense_ms
+                )
+
+    def _set_attributes(self, path: str, condense_ms: float = 0.0):
+        """
+        send to APM the path taken and the time spent, or saved
+        """
+        current_span = trace.get_current_span()
+        current_span.set_attribute("condense_mode", self.mode)
+        current_span.set_attribute("condense_path", path)
+
+        if path == "llm":
+            current_span.set_attribute("condense_ms", condense_ms)
+        elif self._avg_condense_ms is not None:
+            current_span.set_attribute("condense_saved_ms", self._avg_condense_ms)
+
+    def _before_llm(self, inputs: Dict):
+        """
+        return: the standalone question if the LLM is not needed, the cache key
+        """
+        question = inputs["input"]
+        chat_history = inputs.get("chat_history") or []
+
+        reason = self.skip_reason(question, chat_history)
+        if reason:
+            self._set_attributes(f"skipped_{reason}")
+            return question, None
+
+        key = self._cache_key(inputs.get("conv_id", ""), chat_history, question)
+        standalone_question = self._cache_get(key)
+        if standalone_question is not None:
+            self._set_attributes("cache")
+
+        return standalone_question, key
+
+    def as_runnable(self, condense_chain):
+        """
+        wrap condense_chain (the call to the LLM) with the policy
+
+        the runnable input has: input, chat_history, conv_id (optional)
+        """
+
+        def _condense(inputs: Dict, config) -> str:
+            standalone_question, key = self._before_llm(inputs)
+            if standalone_question is not None:
+                return standalone_question
+
+            time_start = time.perf_counter()
+            standalone_question = condense_chain.invoke(inputs, config)
+            condense_ms = (time.perf_counter() - time_start) * 1000.0
+
+            self._set_attributes("llm", condense_ms)
+            self._cache_put(key, standalone_question, condense_ms)
+
+            return standalone_question
+
+        async def _acondense(inputs: Dict, config) -> str:
+            standalone_question, key = self._before_llm(inputs)
+            if standalone_question is not None:
+                return standalone_question
+
+            time_start = time.perf_counter()
+            standalone_question = await condense_chain.ainvoke(inputs, config)
+            condense_ms = (time.perf_counter() - time_start) * 1000.0
+
+            self._set_attributes("llm", condense_ms)
+            self._cache_put(key, standalone_question, condense_ms)
+
+            return standalone_question
+
+        return RunnableLambda(_condense, afunc=_acondense, name="condense_question")
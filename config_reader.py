@@ -9,10 +9,10 @@ Description:
     read from a toml file
 
 Inspired by:
-   
+
 
 Usage:
-    Import this module into other scripts to use its functions. 
+    Import this module into other scripts to use its functions.
     Example:
 
 
@@ -25,58 +25,306 @@ Warnings:
     This module is in development, may change in future versions.
 """
 
+import copy
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
 import toml
+
+from config_schema import SCHEMAS
 from utils import get_console_logger
 
+DEFAULT_CONFIG_FILE = "./config.toml"
+
+# one ConfigReader per file, shared by all the modules of the process
+_CONFIGS: Dict[str, "ConfigReader"] = {}
+_CONFIGS_LOCK = threading.Lock()
+
+
+def get_config(file_path: str = DEFAULT_CONFIG_FILE) -> "ConfigReader":
+    """
+    the config read from file_path, parsed only once per process
+
+    the file is validated with the schema registered for its name (if any)
+    """
+    key = os.path.abspath(file_path)
+
+    with _CONFIGS_LOCK:
+        if key not in _CONFIGS:
+            schema = SCHEMAS.get(os.path.basename(file_path))
+            _CONFIGS[key] = ConfigReader(file_path, schema=schema)
+
+    return _CONFIGS[key]
+
+
+def flatten(data: Dict, prefix: str = "") -> Dict[str, Any]:
+    """
+    the settings as a flat dict, keyed by dotted path (section.key)
+    """
+    settings = {}
+
+    for k, v in data.items():
+        path = f"{prefix}{k}"
+        if isinstance(v, dict):
+            settings.update(flatten(v, f"{path}."))
+        else:
+            settings[path] = v
+
+    return settings
+
+
+def _type_name(expected) -> str:
+    if isinstance(expected, tuple):
+        return " or ".join(t.__name__ for t in expected)
+    return expected.__name__
+
+
+def _type_ok(value, expected) -> bool:
+    types = expected if isinstance(expected, tuple) else (expected,)
+    # bool is a subclass of int, but true is not a valid int setting
+    if isinstance(value, bool) and bool not in types:
+        return False
+    return isinstance(value, types)
+
+
+def validate(settings: Dict[str, Any], schema: Dict) -> List[str]:
+    """
+    check the settings against the schema, return the errors found
+    """
+    errors = []
+
+    for path, setting in schema.items():
+        if path not in settings:
+            if setting.required:
+                errors.append(f"{path}: missing")
+            continue
+
+        value = settings[path]
+        if not _type_ok(value, setting.type):
+            errors.append(
+                f"{path}: expected {_type_name(setting.type)}, "
+                f"found {type(value).__name__} ({value!r})"
+            )
+        elif setting.choices and value not in setting.choices:
+            errors.append(f"{path}: {value!r} not in {setting.choices}")
+
+    return errors
+
 
 class ConfigReader:
     """
     Read the configuration from a toml file
+
+    The file is compiled in a flat dict (dotted path -> value), so that
+    every lookup is O(1). The file can be reloaded when it changes on disk:
+    the new values are sent to the functions registered with subscribe.
     """
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, schema: Dict | None = None):
         """
         Initializes the TOML reader and loads the file into memory.
         :param file_path: Path to the TOML file
+        :param schema: the expected settings (see: config_schema), optional
         """
         self.file_path = file_path
+        self.schema = schema
         self.data = None
         self.logger = get_console_logger()
+
+        # dotted path -> value, key name -> dotted paths having that name
+        self.settings: Dict[str, Any] = {}
+        self._paths_by_name: Dict[str, List[str]] = {}
+        # incremented at every reload that changes the settings
+        self.version = 0
+
+        self._lock = threading.Lock()
+        self._listeners: List[Callable] = []
+        self._mtime = None
+        self._watcher = None
+
         self.load_file()
 
-    def load_file(self):
+        if self.schema is not None:
+            errors = validate(self.settings, self.schema)
+            if errors:
+                raise ValueError(
+                    f"Invalid configuration in {self.file_path}: " + "; ".join(errors)
+                )
+
+    def _read(self) -> Dict:
         """
-        Reads the TOML file and stores it in a dictionary.
+        read and parse the file, an empty dict if it can't be read
         """
         try:
+            self._mtime = os.stat(self.file_path).st_mtime
             with open(self.file_path, "r", encoding="utf-8") as f:
-                self.data = toml.load(f)
+                return toml.load(f)
         except FileNotFoundError:
             self.logger.error("Error: The file %s does not exist.", self.file_path)
-            self.data = {}
         except Exception as e:
             self.logger.error("Error while reading the TOML file: %s", e)
-            self.data = {}
+        return {}
+
+    def _compile(self, data: Dict):
+        """
+        set data and the flat settings, check for ambiguous names
+        """
+        settings = flatten(data)
+
+        paths_by_name = {}
+        for path in settings:
+            paths_by_name.setdefault(path.rsplit(".", 1)[-1], []).append(path)
+
+        for name, paths in paths_by_name.items():
+            # logged only once, not at every reload
+            if len(paths) > 1 and paths != self._paths_by_name.get(name):
+                self.logger.warning(
+                    "Config key %s is ambiguous (%s): find_key returns %s, "
+                    "use get() with the dotted path",
+                    name,
+                    ", ".join(paths),
+                    paths[0],
+                )
+
+        if self.schema is not None:
+            for path in settings:
+                if path not in self.schema:
+                    self.logger.warning("Config key %s is not in the schema", path)
+
+        self.data = data
+        self.settings = settings
+        self._paths_by_name = paths_by_name
+
+    def load_file(self):
+        """
+        Reads the TOML file and stores it in a dictionary.
+        """
+        self._compile(self._read())
+
+    def get(self, path: str, default: Any = None) -> Any:
+        """
+        the value of a setting, by dotted path (for example: retriever.top_k)
+        """
+        return self.settings.get(path, default)
 
     def find_key(self, key_name):
         """
         Finds the value of a key in the TOML dictionary.
         :param key_name: Name of the key to search for
         :return: The value associated with the key if found, otherwise None
+
+        if the name is used in more sections, the first in the file is returned
         """
+        path = self.key_path(key_name)
 
-        def recursive_search(dictionary, target_key):
-            for k, v in dictionary.items():
-                if k == target_key:
-                    return v
-                if isinstance(v, dict):
-                    result = recursive_search(v, target_key)
-                    if result is not None:
-                        return result
+        if path is None:
             return None
+        return self.settings[path]
 
-        # Search for the key in the already loaded file
-        if self.data is None:
-            self.logger.error("Error: No TOML file loaded.")
+    def key_path(self, key_name) -> str | None:
+        """
+        the dotted path of the setting returned by find_key, None if not found
+        """
+        paths = self._paths_by_name.get(key_name)
+
+        if paths is None:
             return None
-        return recursive_search(self.data, key_name)
+        return paths[0]
+
+    def override(self, path: str, value: Any):
+        """
+        set a setting in memory only, not in the file (benchmarks, tests)
+
+        it lasts until the next reload of the file
+        """
+        with self._lock:
+            data = copy.deepcopy(self.data)
+
+            *sections, name = path.split(".")
+            section = data
+            for key in sections:
+                section = section.setdefault(key, {})
+            section[name] = value
+
+            self._compile(data)
+            self.version += 1
+
+    def subscribe(self, callback: Callable[["ConfigReader"], None]):
+        """
+        callback is called with this config after every reload changing values
+        """
+        with self._lock:
+            self._listeners.append(callback)
+
+    def reload(self) -> bool:
+        """
+        read again the file, return True if the settings have changed
+
+        if the new file is not valid the current settings are kept
+        """
+        with self._lock:
+            data = self._read()
+            settings = flatten(data)
+
+            if settings == self.settings:
+                return False
+
+            errors = validate(settings, self.schema) if self.schema else []
+            if errors or not data:
+                self.logger.error(
+                    "Config %s not reloaded, invalid: %s",
+                    self.file_path,
+                    "; ".join(errors) or "empty",
+                )
+                return False
+
+            changed = sorted(
+                path
+                for path in set(settings) | set(self.settings)
+                if settings.get(path) != self.settings.get(path)
+            )
+            self._compile(data)
+            self.version += 1
+            listeners = list(self._listeners)
+
+        self.logger.info("Config %s reloaded, changed: %s", self.file_path, changed)
+
+        for callback in listeners:
+            try:
+                callback(self)
+            except Exception as e:
+                self.logger.error("Error applying the new config: %s", e)
+
+        return True
+
+    def check_reload(self) -> bool:
+        """
+        reload the file only if it has been modified on disk
+        """
+        try:
+            mtime = os.stat(self.file_path).st_mtime
+        except OSError:
+            return False
+
+        if mtime == self._mtime:
+            return False
+        return self.reload()
+
+    def watch(self, interval_sec: float):
+        """
+        check the file for changes every interval_sec, in a daemon thread
+        """
+        if self._watcher is not None or not interval_sec:
+            return
+
+        def _loop():
+            while True:
+                time.sleep(interval_sec)
+                self.check_reload()
+
+        self._watcher = threading.Thread(
+            target=_loop, name="config-watcher", daemon=True
+        )
+        self._watcher.start()
@@ -0,0 +1,150 @@
+"""
+Config Schema
+
+    the settings expected in config.toml, by dotted path (section.key),
+    with type, if required, and the allowed values.
+
+    Checked at startup (and at every reload) by ConfigReader.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Tuple
+
+from condense_policy import CONDENSE_MODES
+
+# ints are accepted where a float is expected
+NUMBER = (int, float)
+
+VECTOR_STORE_TYPES = ("oracle", "local")
+RETRIEVER_MODES = ("dense", "hybrid")
+# index of the local vector store
+LOCAL_VS_INDEX_TYPES = ("exact", "ivf")
+
+
+@dataclass(frozen=True)
+class Setting:
+    """
+    the definition of a single setting
+    """
+
+    type: Any
+    required: bool = True
+    choices: Tuple = ()
+
+
+CONFIG_SCHEMA = {
+    # general
+    "general.verbose": Setting(bool),
+    "general.api_host": Setting(str, required=False),
+    "general.api_port": Setting(int),
+    "general.auth_type": Setting(str, required=False),
+    "general.config_reload_sec": Setting(NUMBER, required=False),
+    "general.conv_max_msgs": Setting(int),
+    "general.history_max_tokens": Setting(int),
+    "general.history_summary_enable": Setting(bool),
+    "general.conv_max_conversations": Setting(int),
+    "general.conv_ttl_sec": Setting(NUMBER),
+    "general.conv_backend": Setting(str, choices=("memory", "sqlite", "oracle")),
+    "general.conv_sqlite_path": Setting(str),
+    "general.conv_oracle_batch_size": Setting(int),
+    "general.conv_oracle_flush_sec": Setting(NUMBER),
+    "general.io_workers": Setting(int),
+    # admission
+    "admission.admission_enable": Setting(bool),
+    "admission.admission_max_concurrent": Setting(int),
+    "admission.admission_max_queue": Setting(int),
+    "admission.admission_queue_timeout_sec": Setting(NUMBER),
+    "admission.admission_rate_per_sec": Setting(NUMBER),
+    "admission.admission_burst": Setting(int),
+    # batch
+    "batch.batch_max_concurrency": Setting(int),
+    "batch.batch_max_queries": Setting(int),
+    "batch.batch_group_embeddings": Setting(bool),
+    # tracing
+    "apm_tracing.enable_tracing": Setting(bool),
+    "apm_tracing.base_url": Setting(str),
+    "apm_tracing.apm_content_type": Setting(str),
+    "apm_tracing.detailed_tracing": Setting(bool),
+    "apm_tracing.sample_rate": Setting(NUMBER),
+    "apm_tracing.tail_sampling_enable": Setting(bool),
+    "apm_tracing.tail_sample_rate": Setting(NUMBER),
+    "apm_tracing.tail_slow_ms": Setting(NUMBER),
+    "apm_tracing.tail_max_traces": Setting(int),
+    # metrics
+    "metrics.metrics_enable": Setting(bool),
+    # embeddings
+    "embeddings.oci.embed_endpoint": Setting(str),
+    "embeddings.oci.embed_model": Setting(str),
+    "embeddings.oci.embed_cache_enable": Setting(bool),
+    "embeddings.oci.embed_cache_max_entries": Setting(int),
+    "embeddings.oci.embed_cache_dir": Setting(str),
+    "embeddings.oci.embed_cache_max_disk_entries": Setting(int),
+    "embeddings.oci.embed_batcher_enable": Setting(bool),
+    "embeddings.oci.embed_batch_size": Setting(int),
+    "embeddings.oci.embed_max_workers": Setting(int),
+    "embeddings.oci.embed_coalesce_ms": Setting(NUMBER),
+    # vector store
+    "vector_store.collection_name": Setting(str),
+    "vector_store.db_pool_enable": Setting(bool),
+    "vector_store.db_pool_min": Setting(int),
+    "vector_store.db_pool_max": Setting(int),
+    "vector_store.db_pool_increment": Setting(int),
+    "vector_store.vector_store_type": Setting(str, choices=VECTOR_STORE_TYPES),
+    "vector_store.local_vs_dir": Setting(str),
+    "vector_store.local_vs_index": Setting(str, choices=LOCAL_VS_INDEX_TYPES),
+    "vector_store.local_vs_ivf_lists": Setting(int),
+    "vector_store.local_vs_ivf_probes": Setting(int),
+    "vector_store.local_vs_ivf_min_rows": Setting(int),
+    "vector_store.local_vs_refresh_sec": Setting(NUMBER),
+    # ingestion
+    "ingestion.ingest_chunk_size": Setting(int),
+    "ingestion.ingest_chunk_overlap": Setting(int),
+    "ingestion.ingest_batch_size": Setting(int),
+    "ingestion.ingest_workers": Setting(int),
+    "ingestion.ingest_checkpoint_file": Setting(str),
+    "ingestion.ingest_sqlite_path": Setting(str),
+    # condense
+    "condense.condense_mode": Setting(str, choices=CONDENSE_MODES),
+    "condense.condense_min_history_msgs": Setting(int),
+    "condense.condense_cache_max_entries": Setting(int),
+    # semantic cache
+    "semantic_cache.semantic_cache_enable": Setting(bool),
+    "semantic_cache.semantic_cache_threshold": Setting(NUMBER),
+    "semantic_cache.semantic_cache_ttl_sec": Setting(NUMBER),
+    "semantic_cache.semantic_cache_max_entries": Setting(int),
+    "semantic_cache.semantic_cache_check_sec": Setting(NUMBER),
+    # retriever
+    "retriever.top_k": Setting(int),
+    "retriever.retriever_mode": Setting(str, choices=RETRIEVER_MODES),
+    "retriever.retriever_fetch_k": Setting(int),
+    "retriever.retriever_lexical_weight": Setting(NUMBER),
+    "retriever.retriever_mmr_lambda": Setting(NUMBER),
+    "retriever.speculative_retrieval_enable": Setting(bool),
+    "retriever.speculative_min_similarity": Setting(NUMBER),
+    # context
+    "context.context_compression_enable": Setting(bool),
+    "context.context_max_tokens": Setting(int),
+    "context.context_min_similarity": Setting(NUMBER),
+    # llm
+    "llm.max_tokens": Setting(int),
+    "llm.model_type": Setting(str),
+    "llm.temperature": Setting(NUMBER),
+    "llm.top_k": Setting(int),
+    "llm.top_p": Setting(NUMBER),
+    "llm.llm_router_enable": Setting(bool),
+    "llm.llm_deadline_sec": Setting(NUMBER),
+    "llm.llm_attempt_timeout_sec": Setting(NUMBER),
+    "llm.llm_max_retries": Setting(int),
+    "llm.llm_backoff_base_ms": Setting(NUMBER),
+    "llm.llm_backoff_max_ms": Setting(NUMBER),
+    "llm.llm_hedge_enable": Setting(bool),
+    "llm.llm_hedge_after_ms": Setting(NUMBER),
+    "llm.llm_breaker_failures": Setting(int),
+    "llm.llm_breaker_open_sec": Setting(NUMBER),
+    "llm.oci.endpoint": Setting(str),
+    "llm.oci.llm_model": Setting(str),
+    "llm.oci.llm_fallback_models": Setting(list),
+}
+
+# schema to use, by name of the config file
+SCHEMAS = {"config.toml": CONFIG_SCHEMA}
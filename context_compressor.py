@@ -0,0 +1,223 @@
+"""
+Context Compressor
+
+    to shrink the context stuffed in the QA prompt (the prompt size
+    drives the latency of the LLM), between retrieval and answer:
+    * duplicated sentences are removed (chunks overlap)
+    * optionally, sentences with low similarity to the question are removed
+      (the sentences are embedded: a remote call in the critical path,
+      off by default)
+    * the context is cut to a budget of tokens, the least relevant
+      sentences are removed first
+
+    Sizes before and after are sent to APM, in the span.
+"""
+
+import re
+from typing import Dict, List, Tuple
+
+import numpy as np
+from langchain_core.documents.base import Document
+from langchain_core.runnables import RunnableLambda
+from opentelemetry import trace
+
+from token_budget import count_tokens
+from tracer_singleton import TracerSingleton
+
+TRACER = TracerSingleton.get_instance()
+
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+
+# shorter sentences are deduplicated only if identical
+MIN_CONTAINED_CHARS = 20
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    the sentences of the text
+    """
+    return [
+        sentence.strip()
+        for sentence in _SENTENCE_END_RE.split(text)
+        if sentence.strip()
+    ]
+
+
+def _normalize(sentence: str) -> str:
+    return " ".join(sentence.lower().split())
+
+
+class ContextCompressor:
+    """
+    Compress the docs retrieved, before the QA prompt
+
+    max_tokens: budget for the whole context (0: no budget)
+    min_similarity: sentences less similar to the question are dropped
+        (0: no filter, no embeddings computed)
+    """
+
+    def __init__(
+        self, embed_model, max_tokens: int = 1500, min_similarity: float = 0.0
+    ):
+        self.embed_model = embed_model
+        self.max_tokens = max_tokens
+        self.min_similarity = min_similarity
+
+    @staticmethod
+    def _dedup(docs: List[Document]) -> Tuple[List[Tuple[int, str]], int]:
+        """
+        the sentences of the docs, (doc position, sentence), without duplicates:
+        sentences equal to or contained in a sentence already seen
+        """
+        sentences = []
+        seen = set()
+        seen_text = ""
+        n_duplicates = 0
+
+        for i, doc in enumerate(docs):
+            for sentence in split_sentences(doc.page_content):
+                normalized = _normalize(sentence)
+
+                if normalized in seen or (
+                    len(normalized) >= MIN_CONTAINED_CHARS and normalized in seen_text
+                ):
+                    n_duplicates += 1
+                    continue
+
+                seen.add(normalized)
+                seen_text += normalized + "\n"
+                sentences.append((i, sentence))
+
+        return sentences, n_duplicates
+
+    @staticmethod
+    def _similarities(query_embedding, sentence_embeddings) -> np.ndarray:
+        matrix = np.asarray(sentence_embeddings, dtype=np.float32)
+        query = np.asarray(query_embedding, dtype=np.float32)
+
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+        return matrix @ query / np.maximum(norms, 1e-12)
+
+    def _select(
+        self, docs: List[Document], sentences, scores: np.ndarray
+    ) -> Tuple[List[Document], Dict]:
+        """
+        keep the sentences with the highest scores, within the budget,
+        rebuild the docs (sentences in the original order)
+        """
+        stats = {"dropped_low_similarity": 0, "dropped_budget": 0}
+
+        keep = np.ones(len(sentences), dtype=bool)
+        if self.min_similarity > 0:
+            above = scores >= self.min_similarity
+            # if nothing is similar enough, only the budget is applied
+            if above.any():
+                keep = above
+                stats["dropped_low_similarity"] = int((~above).sum())
+
+        if self.max_tokens:
+            used = 0
+            for i in np.argsort(-scores, kind="stable"):
+                if not keep[i]:
+                    continue
+                tokens = count_tokens(sentences[i][1])
+                if used + tokens > self.max_tokens:
+                    keep[i] = False
+                    stats["dropped_budget"] += 1
+                else:
+                    used += tokens
+
+        kept_by_doc: Dict[int, List[str]] = {}
+        for (doc_pos, sentence), kept in zip(sentences, keep):
+            if kept:
+                kept_by_doc.setdefault(doc_pos, []).append(sentence)
+
+        compressed = [
+            Document(page_content=" ".join(kept_by_doc[i]), metadata=doc.metadata)
+            for i, doc in enumerate(docs)
+            if i in kept_by_doc
+        ]
+        return compressed, stats
+
+    @staticmethod
+    def _set_attributes(docs_in: List[Document], docs_out: List[Document], stats):
+        current_span = trace.get_current_span()
+
+        chars_in = sum(len(doc.page_content) for doc in docs_in)
+        chars_out = sum(len(doc.page_content) for doc in docs_out)
+        tokens_in = sum(count_tokens(doc.page_content) for doc in docs_in)
+        tokens_out = sum(count_tokens(doc.page_content) for doc in docs_out)
+
+        current_span.set_attribute("context_docs_in", len(docs_in))
+        current_span.set_attribute("context_docs_out", len(docs_out))
+        current_span.set_attribute("context_chars_in", chars_in)
+        current_span.set_attribute("context_chars_out", chars_out)
+        current_span.set_attribute("context_tokens_in", tokens_in)
+        current_span.set_attribute("context_tokens_out", tokens_out)
+        current_span.set_attribute(
+            "context_compression_ratio", chars_out / chars_in if chars_in else 1.0
+        )
+        for key, value in stats.items():
+            current_span.set_attribute(f"context_{key}", value)
+
+    @staticmethod
+    def _positional_scores(sentences) -> np.ndarray:
+        # docs are in order of relevance: earlier sentences first
+        return -np.arange(len(sentences), dtype=np.float32)
+
+    @TRACER.start_as_current_span("ContextCompressor.compress")
+    def compress(self, question: str, docs: List[Document]) -> List[Document]:
+        """
+        the docs, compressed
+        """
+        sentences, n_duplicates = self._dedup(docs)
+
+        if self.min_similarity > 0 and sentences:
+            scores = self._similarities(
+                self.embed_model.embed_query(question),
+                self.embed_model.embed_documents([s for _, s in sentences]),
+            )
+        else:
+            scores = self._positional_scores(sentences)
+
+        compressed, stats = self._select(docs, sentences, scores)
+        self._set_attributes(docs, compressed, {"duplicates": n_duplicates, **stats})
+
+        return compressed
+
+    @TRACER.start_as_current_span("ContextCompressor.compress")
+    async def acompress(self, question: str, docs: List[Document]) -> List[Document]:
+        """
+        async version of compress (the embeddings with the async API)
+        """
+        sentences, n_duplicates = self._dedup(docs)
+
+        if self.min_similarity > 0 and sentences:
+            scores = self._similarities(
+                await self.embed_model.aembed_query(question),
+                await self.embed_model.aembed_documents([s for _, s in sentences]),
+            )
+        else:
+            scores = self._positional_scores(sentences)
+
+        compressed, stats = self._select(docs, sentences, scores)
+        self._set_attributes(docs, compressed, {"duplicates": n_duplicates, **stats})
+
+        return compressed
+
+    def wrap(self, retriever):
+        """
+        a runnable: the docs of retriever, compressed
+
+        input: the (standalone) question
+        """
+
+        def _retrieve(question: str, config) -> List[Document]:
+            docs = retriever.invoke(question, config)
+            return self.compress(question, docs)
+
+        async def _aretrieve(question: str, config) -> List[Document]:
+            docs = await retriever.ainvoke(question, config)
+            return await self.acompress(question, docs)
+
+        return RunnableLambda(_retrieve, afunc=_aretrieve, name="compressed_retriever")
@@ -0,0 +1,665 @@
+"""
+Conversation Backends
+
+    where the ConversationManager keeps the histories.
+    Messages are in the compact form (type, content).
+
+    * InMemoryBackend: in the process (a single worker)
+    * SQLiteBackend: a SQLite file in WAL mode, shared by the workers
+      (processes) on the same host
+    * OracleBackend: a table in the Oracle DB, shared by all the nodes;
+      writes are batched and flushed by a background thread
+
+    All the backends keep at most max_messages for every conversation
+    and evict conversations idle for more than ttl_sec, and the least
+    recently used over max_conversations.
+
+    The calls of the DB backends are blocking (blocking = True): the async
+    API runs them in a thread (see: ConversationManager). Their gauges
+    are computed periodically, not at every request.
+"""
+
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import List, Tuple
+
+from utils import get_console_logger
+
+logger = get_console_logger()
+
+# approx. overhead (bytes) of a message and of a conversation in the store
+MSG_OVERHEAD_BYTES = 64
+CONV_OVERHEAD_BYTES = 512
+
+
+def compact_size(compact: Tuple[str, str]) -> int:
+    """
+    approx. size in bytes of a message in the store
+    """
+    return sys.getsizeof(compact[1]) + MSG_OVERHEAD_BYTES
+
+
+class ConversationBackend(ABC):
+    """
+    Interface of the store of the conversations
+    """
+
+    # if true, the calls do I/O: not to be made in the event loop
+    blocking = True
+
+    def __init__(
+        self, max_messages: int = 20, max_conversations: int = 10000, ttl_sec=3600
+    ):
+        self.max_messages = max_messages
+        self.max_conversations = max_conversations
+        self.ttl_sec = ttl_sec
+
+    def set_max_messages(self, max_messages: int):
+        """
+        change the limit of messages (at a reload of the config)
+
+        applied to the next reads and writes
+        """
+        self.max_messages = max_messages
+
+    @abstractmethod
+    def get_messages(self, conv_id: str) -> List[Tuple[str, str]]:
+        """the last max_messages of the conversation, oldest first"""
+
+    @abstractmethod
+    def append_messages(self, conv_id: str, messages: List[Tuple[str, str]]):
+        """add messages at the end of the conversation"""
+
+    @abstractmethod
+    def clear(self, conv_id: str):
+        """remove the conversation"""
+
+    @property
+    @abstractmethod
+    def num_conversations(self) -> int:
+        """gauge: num. of conversations in the store"""
+
+    @property
+    @abstractmethod
+    def approx_bytes(self) -> int:
+        """gauge: approx. num. of bytes held by the store"""
+
+
+class _Conversation:
+    """
+    the history of a single conversation, in memory
+    """
+
+    __slots__ = ("messages", "last_access", "n_bytes")
+
+    def __init__(self, max_messages: int):
+        self.messages = deque(maxlen=max_messages)
+        self.last_access = time.monotonic()
+        self.n_bytes = CONV_OVERHEAD_BYTES
+
+
+class InMemoryBackend(ConversationBackend):
+    """
+    Conversations in a dict of deques, in LRU order. All operations are O(1)
+    """
+
+    blocking = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # conversations, in order of last access (LRU first), key is conv_id
+        self._conversations: OrderedDict[str, _Conversation] = OrderedDict()
+        self._lock = threading.Lock()
+        self._n_bytes = 0
+
+    def _evict(self, now: float):
+        """
+        remove the idle conversations, and the LRU ones over the limit
+        """
+        while self._conversations:
+            conv_id, conv = next(iter(self._conversations.items()))
+
+            if (
+                now - conv.last_access <= self.ttl_sec
+                and len(self._conversations) <= self.max_conversations
+            ):
+                break
+
+            del self._conversations[conv_id]
+            self._n_bytes -= conv.n_bytes
+
+    def _touch(self, conv_id: str, now: float) -> _Conversation:
+        """
+        mark the conversation as just used
+        """
+        conv = self._conversations[conv_id]
+        conv.last_access = now
+        self._conversations.move_to_end(conv_id)
+
+        return conv
+
+    def get_messages(self, conv_id: str) -> List[Tuple[str, str]]:
+        now = time.monotonic()
+
+        with self._lock:
+            self._evict(now)
+
+            if conv_id not in self._conversations:
+                return []
+            return list(self._touch(conv_id, now).messages)
+
+    def append_messages(self, conv_id: str, messages: List[Tuple[str, str]]):
+        now = time.monotonic()
+
+        with self._lock:
+            if conv_id not in self._conversations:
+                self._conversations[conv_id] = _Conversation(self.max_messages)
+                self._n_bytes += CONV_OVERHEAD_BYTES
+            conv = self._touch(conv_id, now)
+
+            for compact in messages:
+                # the deque removes the oldest message if the limit is exceeded
+                if len(conv.messages) == conv.messages.maxlen:
+                    removed = compact_size(conv.messages[0])
+                    conv.n_bytes -= removed
+                    self._n_bytes -= removed
+
+                size = compact_size(compact)
+                conv.messages.append(compact)
+                conv.n_bytes += size
+                self._n_bytes += size
+
+            self._evict(now)
+
+    def clear(self, conv_id: str):
+        with self._lock:
+            conv = self._conversations.pop(conv_id, None)
+            if conv is not None:
+                self._n_bytes -= conv.n_bytes
+
+    def set_max_messages(self, max_messages: int):
+        """
+        the deques of the conversations already in memory get the new limit
+        (if lower, the oldest messages are removed now)
+        """
+        with self._lock:
+            if max_messages == self.max_messages:
+                return
+            self.max_messages = max_messages
+
+            for conv in self._conversations.values():
+                n_removed = max(len(conv.messages) - max_messages, 0)
+                removed = sum(
+                    compact_size(compact)
+                    for compact in islice(conv.messages, n_removed)
+                )
+                conv.messages = deque(conv.messages, maxlen=max_messages)
+                conv.n_bytes -= removed
+                self._n_bytes -= removed
+
+    @property
+    def num_conversations(self) -> int:
+        return len(self._conversations)
+
+    @property
+    def approx_bytes(self) -> int:
+        return self._n_bytes
+
+
+class SQLiteBackend(ConversationBackend):
+    """
+    Conversations in a SQLite file (WAL mode), shared between processes
+
+    every thread has its own connection
+    """
+
+    # how often (sec.) the idle conversations are removed
+    # and the gauges computed
+    EVICT_INTERVAL_SEC = 10
+
+    def __init__(self, db_path: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.db_path = db_path
+        self._local = threading.local()
+        self._last_evict = 0.0
+
+        # gauges, updated with the eviction
+        self._num_conversations = 0
+        self._n_bytes = 0
+
+        conn = self._get_connection()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                conv_id TEXT PRIMARY KEY,
+                last_access REAL NOT NULL,
+                n_bytes INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                msg_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conv_id TEXT NOT NULL,
+                msg_type TEXT NOT NULL,
+                content TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_conv_idx ON messages (conv_id, msg_id);
+            CREATE INDEX IF NOT EXISTS conversations_access_idx
+                ON conversations (last_access);
+            """)
+        self._update_gauges(conn)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+            # autocommit: transactions are explicit (BEGIN IMMEDIATE)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+
+        return conn
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        """
+        remove the idle conversations, and the LRU ones over the limit,
+        then compute the gauges
+        """
+        if now - self._last_evict < self.EVICT_INTERVAL_SEC:
+            return
+        self._last_evict = now
+
+        conn.execute(
+            """
+            DELETE FROM conversations WHERE last_access < ? OR conv_id IN (
+                SELECT conv_id FROM conversations ORDER BY last_access DESC
+                LIMIT -1 OFFSET ?)
+            """,
+            (now - self.ttl_sec, self.max_conversations),
+        )
+        conn.execute(
+            "DELETE FROM messages WHERE conv_id NOT IN (SELECT conv_id FROM conversations)"
+        )
+        self._update_gauges(conn)
+
+    def _update_gauges(self, conn: sqlite3.Connection):
+        self._num_conversations, self._n_bytes = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(n_bytes), 0) FROM conversations"
+        ).fetchone()
+
+    def get_messages(self, conv_id: str) -> List[Tuple[str, str]]:
+        conn = self._get_connection()
+
+        rows = conn.execute(
+            """
+            SELECT msg_type, content FROM messages WHERE conv_id = ?
+            ORDER BY msg_id DESC LIMIT ?
+            """,
+            (conv_id, self.max_messages),
+        ).fetchall()
+        conn.execute(
+            "UPDATE conversations SET last_access = ? WHERE conv_id = ?",
+            (time.time(), conv_id),
+        )
+
+        return [(msg_type, content) for msg_type, content in reversed(rows)]
+
+    def append_messages(self, conv_id: str, messages: List[Tuple[str, str]]):
+        conn = self._get_connection()
+        now = time.time()
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO messages (conv_id, msg_type, content) VALUES (?, ?, ?)",
+                [(conv_id, msg_type, content) for msg_type, content in messages],
+            )
+            # keep only the last max_messages
+            conn.execute(
+                """
+                DELETE FROM messages WHERE conv_id = ? AND msg_id NOT IN (
+                    SELECT msg_id FROM messages WHERE conv_id = ?
+                    ORDER BY msg_id DESC LIMIT ?)
+                """,
+                (conv_id, conv_id, self.max_messages),
+            )
+            conn.execute(
+                """
+                INSERT INTO conversations (conv_id, last_access, n_bytes)
+                VALUES (?, ?, ?) ON CONFLICT (conv_id) DO UPDATE SET
+                    last_access = excluded.last_access,
+                    n_bytes = excluded.n_bytes
+                """,
+                (conv_id, now, self._conv_bytes(conn, conv_id)),
+            )
+            self._evict(conn, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _conv_bytes(conn: sqlite3.Connection, conv_id: str) -> int:
+        n_msgs, n_chars = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(content)), 0) "
+            "FROM messages WHERE conv_id = ?",
+            (conv_id,),
+        ).fetchone()
+        return CONV_OVERHEAD_BYTES + n_msgs * MSG_OVERHEAD_BYTES + n_chars
+
+    def clear(self, conv_id: str):
+        conn = self._get_connection()
+
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM messages WHERE conv_id = ?", (conv_id,))
+        conn.execute("DELETE FROM conversations WHERE conv_id = ?", (conv_id,))
+        conn.execute("COMMIT")
+
+    @property
+    def num_conversations(self) -> int:
+        return self._num_conversations
+
+    @property
+    def approx_bytes(self) -> int:
+        return self._n_bytes
+
+
+class OracleBackend(ConversationBackend):
+    """
+    Conversations in a table of the Oracle DB, shared by all the nodes
+
+    writes are buffered and flushed in batch (executemany) every
+    flush_interval_sec, or when batch_size messages are pending.
+    Reads see the pending messages of the node (also the ones being
+    written, until the commit), the messages written by other nodes
+    are visible after their flush. A batch not written is queued again.
+
+    The last access of every conversation (read or write) is kept in
+    ACCESS_TABLE_NAME, updated with the flush. Idle conversations are
+    removed, and the gauges computed, every EVICT_INTERVAL_SEC.
+    """
+
+    TABLE_NAME = "CONVERSATION_MESSAGES"
+    ACCESS_TABLE_NAME = "CONVERSATION_ACCESS"
+
+    EVICT_INTERVAL_SEC = 60
+
+    def __init__(
+        self,
+        pool,
+        *args,
+        batch_size: int = 100,
+        flush_interval_sec: float = 1.0,
+        **kwargs,
+    ):
+        """
+        pool: pool of connections to the DB (see: factory_vector_store.get_db_pool)
+        """
+        super().__init__(*args, **kwargs)
+
+        self._pool = pool
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+
+        self._lock = threading.Lock()
+        # messages not yet written: (conv_id, msg_type, content)
+        self._pending: List[Tuple[str, str, str]] = []
+        # messages being written, not yet committed
+        self._in_flight: List[Tuple[str, str, str]] = []
+        # incremented at every commit of the messages in flight
+        self._flush_seq = 0
+        # conversations read or written since the last flush
+        self._accessed = set()
+        self._flush_needed = threading.Event()
+        self._last_evict = 0.0
+
+        # gauges, updated with the eviction
+        self._num_conversations = 0
+        self._n_bytes = 0
+
+        self._create_table()
+
+        self._flusher = threading.Thread(
+            target=self._flush_loop, name="conv_flusher", daemon=True
+        )
+        self._flusher.start()
+
+    def _create_table(self):
+        with self._pool.acquire() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT COUNT(*) FROM user_tables WHERE table_name = :1",
+                    [self.TABLE_NAME],
+                )
+                if cursor.fetchone()[0] == 0:
+                    cursor.execute(f"""
+                        CREATE TABLE {self.TABLE_NAME} (
+                            msg_id NUMBER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                            conv_id VARCHAR2(128) NOT NULL,
+                            msg_type VARCHAR2(16) NOT NULL,
+                            content CLOB,
+                            created_at TIMESTAMP DEFAULT SYSTIMESTAMP NOT NULL
+                        )""")
+                    cursor.execute(
+                        f"CREATE INDEX {self.TABLE_NAME}_IDX "
+                        f"ON {self.TABLE_NAME} (conv_id, msg_id)"
+                    )
+
+                cursor.execute(
+                    "SELECT COUNT(*) FROM user_tables WHERE table_name = :1",
+                    [self.ACCESS_TABLE_NAME],
+                )
+                if cursor.fetchone()[0] == 0:
+                    cursor.execute(f"""
+                        CREATE TABLE {self.ACCESS_TABLE_NAME} (
+                            conv_id VARCHAR2(128) PRIMARY KEY,
+                            last_access TIMESTAMP NOT NULL
+                        )""")
+                    cursor.execute(
+                        f"CREATE INDEX {self.ACCESS_TABLE_NAME}_IDX "
+                        f"ON {self.ACCESS_TABLE_NAME} (last_access)"
+                    )
+                    # the conversations already there: last access unknown
+                    cursor.execute(f"""
+                        INSERT INTO {self.ACCESS_TABLE_NAME} (conv_id, last_access)
+                        SELECT conv_id, MAX(created_at) FROM {self.TABLE_NAME}
+                        GROUP BY conv_id""")
+            conn.commit()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_needed.wait(self.flush_interval_sec)
+            self._flush_needed.clear()
+
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Error writing conversations to DB: %s", e)
+
+    def flush(self):
+        """
+        write the pending messages and the last accesses, in a single batch
+
+        every EVICT_INTERVAL_SEC remove the idle conversations
+        """
+        with self._lock:
+            # still visible to the reads until the commit
+            pending = self._in_flight = self._pending
+            self._pending = []
+            accessed, self._accessed = self._accessed, set()
+
+        now = time.monotonic()
+        evict = now - self._last_evict >= self.EVICT_INTERVAL_SEC
+
+        if not pending and not accessed and not evict:
+            return
+
+        try:
+            with self._pool.acquire() as conn:
+                with conn.cursor() as cursor:
+                    if pending:
+                        self._write_pending(cursor, pending)
+                    if accessed:
+                        self._write_accessed(cursor, accessed)
+                    if evict:
+                        self._evict(cursor)
+                conn.commit()
+        except Exception:
+            # not written: queued again, before the messages added meanwhile
+            with self._lock:
+                self._pending = self._in_flight + self._pending
+                self._in_flight = []
+                self._accessed |= accessed
+            raise
+
+        with self._lock:
+            self._in_flight = []
+            if pending:
+                self._flush_seq += 1
+
+        if evict:
+            self._last_evict = now
+
+    def _write_pending(self, cursor, pending: List[Tuple[str, str, str]]):
+        cursor.executemany(
+            f"INSERT INTO {self.TABLE_NAME} (conv_id, msg_type, content) "
+            "VALUES (:1, :2, :3)",
+            pending,
+        )
+        # keep only the last max_messages of the conversations written
+        cursor.executemany(
+            f"""
+            DELETE FROM {self.TABLE_NAME} WHERE conv_id = :conv_id
+            AND msg_id NOT IN (
+                SELECT msg_id FROM {self.TABLE_NAME} WHERE conv_id = :conv_id
+                ORDER BY msg_id DESC FETCH FIRST :n ROWS ONLY)
+            """,
+            [
+                {"conv_id": conv_id, "n": self.max_messages}
+                for conv_id in {msg[0] for msg in pending}
+            ],
+        )
+
+    def _write_accessed(self, cursor, accessed):
+        cursor.executemany(
+            f"""
+            MERGE INTO {self.ACCESS_TABLE_NAME} a
+            USING (SELECT :1 AS conv_id FROM dual) s ON (a.conv_id = s.conv_id)
+            WHEN MATCHED THEN UPDATE SET a.last_access = SYSTIMESTAMP
+            WHEN NOT MATCHED THEN
+                INSERT (conv_id, last_access) VALUES (s.conv_id, SYSTIMESTAMP)
+            """,
+            [[conv_id] for conv_id in accessed],
+        )
+
+    def _evict(self, cursor):
+        """
+        remove the idle conversations (by last access), and the LRU ones
+        over the limit, then compute the gauges
+        """
+        cursor.execute(
+            f"""
+            DELETE FROM {self.ACCESS_TABLE_NAME} WHERE
+                last_access < SYSTIMESTAMP - NUMTODSINTERVAL(:ttl, 'SECOND')
+            OR conv_id IN (
+                SELECT conv_id FROM {self.ACCESS_TABLE_NAME}
+                ORDER BY last_access DESC OFFSET :max_convs ROWS)
+            """,
+            {"ttl": self.ttl_sec, "max_convs": self.max_conversations},
+        )
+        cursor.execute(
+            f"DELETE FROM {self.TABLE_NAME} WHERE conv_id NOT IN "
+            f"(SELECT conv_id FROM {self.ACCESS_TABLE_NAME})"
+        )
+        cursor.execute(
+            f"SELECT COUNT(DISTINCT conv_id), "
+            f"COALESCE(SUM(DBMS_LOB.GETLENGTH(content)), 0) "
+            f"FROM {self.TABLE_NAME}"
+        )
+        n_convs, n_chars = cursor.fetchone()
+
+        self._num_conversations = n_convs
+        self._n_bytes = n_convs * CONV_OVERHEAD_BYTES + n_chars
+
+    def _read_messages(self, conv_id: str) -> List[Tuple[str, str]]:
+        """
+        the messages of the conversation in the table, oldest first
+        """
+        with self._pool.acquire() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    SELECT msg_type, content FROM {self.TABLE_NAME}
+                    WHERE conv_id = :1 ORDER BY msg_id DESC
+                    FETCH FIRST :2 ROWS ONLY
+                    """,
+                    [conv_id, self.max_messages],
+                )
+                rows = [
+                    (msg_type, content.read() if content is not None else "")
+                    for msg_type, content in cursor
+                ]
+
+        rows.reverse()
+        return rows
+
+    def get_messages(self, conv_id: str) -> List[Tuple[str, str]]:
+        while True:
+            with self._lock:
+                flush_seq = self._flush_seq
+
+            rows = self._read_messages(conv_id)
+
+            with self._lock:
+                # a batch committed during the read: in the rows or not,
+                # read again
+                if flush_seq != self._flush_seq:
+                    continue
+
+                self._accessed.add(conv_id)
+                rows.extend(
+                    (msg_type, content)
+                    for pending_id, msg_type, content in self._in_flight + self._pending
+                    if pending_id == conv_id
+                )
+
+            return rows[-self.max_messages :]
+
+    def append_messages(self, conv_id: str, messages: List[Tuple[str, str]]):
+        with self._lock:
+            self._pending.extend(
+                (conv_id, msg_type, content) for msg_type, content in messages
+            )
+            self._accessed.add(conv_id)
+            if len(self._pending) >= self.batch_size:
+                self._flush_needed.set()
+
+    def clear(self, conv_id: str):
+        with self._lock:
+            self._pending = [msg for msg in self._pending if msg[0] != conv_id]
+            self._in_flight = [msg for msg in self._in_flight if msg[0] != conv_id]
+            self._accessed.discard(conv_id)
+
+        with self._pool.acquire() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {self.TABLE_NAME} WHERE conv_id = :1", [conv_id]
+                )
+                cursor.execute(
+                    f"DELETE FROM {self.ACCESS_TABLE_NAME} WHERE conv_id = :1",
+                    [conv_id],
+                )
+            conn.commit()
+
+    @property
+    def num_conversations(self) -> int:
+        return self._num_conversations
+
+    @property
+    def approx_bytes(self) -> int:
+        return self._n_bytes
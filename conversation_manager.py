@@ -1,9 +1,51 @@
 """
 Conversation Manager
+
+    the histories are kept in a pluggable backend (see: conversation_backends):
+    in memory (default), SQLite (many workers on one host),
+    Oracle DB (many nodes).
+
+    Messages are stored in the compact form (type, content)
+    and rebuilt as BaseMessage on read.
+
+    The async methods run the calls of a blocking backend (SQLite, Oracle)
+    in a thread, not in the event loop.
 """
 
-from typing import List, Dict
-from langchain_core.messages import BaseMessage
+from typing import List, Tuple
+
+from langchain_core.runnables.config import run_in_executor
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    ChatMessage,
+    HumanMessage,
+    SystemMessage,
+)
+
+from conversation_backends import ConversationBackend, InMemoryBackend
+
+# to rebuild messages from the compact representation
+MESSAGE_CLASSES = {"human": HumanMessage, "ai": AIMessage, "system": SystemMessage}
+
+
+def to_compact(message: BaseMessage) -> Tuple[str, str]:
+    """
+    the compact representation of a message: (type, content)
+    """
+    return message.type, message.content
+
+
+def from_compact(compact: Tuple[str, str]) -> BaseMessage:
+    """
+    rebuild the message from the compact representation
+    """
+    msg_type, content = compact
+    msg_class = MESSAGE_CLASSES.get(msg_type)
+
+    if msg_class is None:
+        return ChatMessage(role=msg_type, content=content)
+    return msg_class(content=content)
 
 
 class ConversationManager:
@@ -11,26 +53,62 @@ class ConversationManager:
     To handle the conversation history
     """
 
-    def __init__(self, max_messages: int = 20):
-        # Dictionary to store conversation history, where key is conv_id
-        self._conversations: Dict[str, List[BaseMessage]] = {}
-        self._max_messages = max_messages
+    def __init__(
+        self,
+        max_messages: int = 20,
+        max_conversations: int = 10000,
+        ttl_sec: float = 3600,
+        backend: ConversationBackend | None = None,
+    ):
+        """
+        backend: where the conversations are kept (default: in memory)
+        """
+        if backend is None:
+            backend = InMemoryBackend(max_messages, max_conversations, ttl_sec)
+        self._backend = backend
 
     def get_conversation(self, conv_id: str) -> List[BaseMessage]:
         """Retrieve the conversation history for a given conversation ID."""
-        return self._conversations.get(conv_id, [])
+        return [
+            from_compact(compact) for compact in self._backend.get_messages(conv_id)
+        ]
+
+    async def aget_conversation(self, conv_id: str) -> List[BaseMessage]:
+        """async version of get_conversation."""
+        if not self._backend.blocking:
+            return self.get_conversation(conv_id)
+        return await run_in_executor(None, self.get_conversation, conv_id)
 
     def add_message(self, conv_id: str, message: BaseMessage):
         """Add a message to the conversation history for a given conversation ID."""
-        if conv_id not in self._conversations:
-            self._conversations[conv_id] = []
-        self._conversations[conv_id].append(message)
+        self._backend.append_messages(conv_id, [to_compact(message)])
+
+    def add_messages(self, conv_id: str, messages: List[BaseMessage]):
+        """Add many messages (in a single write to the backend)."""
+        self._backend.append_messages(conv_id, [to_compact(msg) for msg in messages])
 
-        # Remove oldest messages if the limit is exceeded
-        while len(self._conversations[conv_id]) > self._max_messages:
-            self._conversations[conv_id].pop(0)
+    async def aadd_messages(self, conv_id: str, messages: List[BaseMessage]):
+        """async version of add_messages."""
+        if not self._backend.blocking:
+            self.add_messages(conv_id, messages)
+            return
+        await run_in_executor(None, self.add_messages, conv_id, messages)
 
     def clear_conversation(self, conv_id: str):
         """Clear the conversation history for a given conversation ID."""
-        if conv_id in self._conversations:
-            del self._conversations[conv_id]
+        self._backend.clear(conv_id)
+
+    @property
+    def backend(self) -> ConversationBackend:
+        """the backend where the conversations are kept"""
+        return self._backend
+
+    @property
+    def num_conversations(self) -> int:
+        """gauge: num. of conversations in the store"""
+        return self._backend.num_conversations
+
+    @property
+    def approx_bytes(self) -> int:
+        """gauge: approx. num. of bytes held by the store"""
+        return self._backend.approx_bytes
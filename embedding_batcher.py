@@ -0,0 +1,180 @@
+"""
+Embedding Batcher
+
+    to compute embeddings with higher throughput:
+    * the texts are split in batches, sent concurrently by a bounded
+      pool of workers (instead of one batch after the other)
+    * single queries arriving at the same time (from different requests)
+      are coalesced, within coalesce_ms, in a single remote call
+
+    Every batch has a span, with its size and the time waited in queue.
+"""
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List
+
+from opentelemetry import context as otel_context
+from opentelemetry import trace
+
+from tracer_singleton import TracerSingleton
+
+TRACER = TracerSingleton.get_instance()
+
+# embed_fn: computes the embeddings of a batch with a single remote call
+EmbedFn = Callable[[List[str]], List[List[float]]]
+
+
+class _PendingQueries:
+    """
+    single queries waiting to be sent together
+    """
+
+    def __init__(self):
+        self.texts: List[str] = []
+        self.futures: List[Future] = []
+        self.contexts = []
+        self.time_start = time.perf_counter()
+
+
+class EmbeddingBatcher:
+    """
+    Send embedding requests in concurrent batches, coalesce single queries
+
+    shared in the process: the pool bounds the concurrent remote calls
+    """
+
+    def __init__(
+        self, batch_size: int = 96, max_workers: int = 4, coalesce_ms: float = 5.0
+    ):
+        """
+        coalesce_ms: max time a single query waits for others (0: no wait)
+        """
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.coalesce_ms = coalesce_ms
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="embed"
+        )
+        self._lock = threading.Lock()
+        # model_id -> queries waiting (one group for every model)
+        self._pending = {}
+
+    def _run_batch(self, embed_fn: EmbedFn, texts, contexts, time_start: float):
+        """
+        the remote call for a batch, in a worker of the pool
+
+        the span is a child of the (first) request, linked to all of them
+        """
+        queue_wait_ms = (time.perf_counter() - time_start) * 1000.0
+        links = [
+            trace.Link(trace.get_current_span(ctx).get_span_context())
+            for ctx in contexts
+        ]
+
+        with TRACER.start_as_current_span(
+            "OCIGenAIEmbeddings.batch", context=contexts[0], links=links
+        ) as span:
+            span.set_attribute("embed_batch_size", len(texts))
+            span.set_attribute("embed_queue_wait_ms", queue_wait_ms)
+            span.set_attribute("embed_coalesced_requests", len(contexts))
+
+            return embed_fn(texts)
+
+    def submit(self, embed_fn: EmbedFn, texts: List[str]) -> List[Future]:
+        """
+        split texts in batches and send them concurrently
+
+        return: a future for every batch, in order
+        """
+        contexts = [otel_context.get_current()]
+        time_start = time.perf_counter()
+
+        return [
+            self._executor.submit(
+                self._run_batch,
+                embed_fn,
+                texts[i : i + self.batch_size],
+                contexts,
+                time_start,
+            )
+            for i in range(0, len(texts), self.batch_size)
+        ]
+
+    def embed(
+        self, embed_fn: EmbedFn, texts: List[str], model_id: str
+    ) -> List[List[float]]:
+        """
+        the embeddings of texts, waiting for all the batches
+        """
+        if len(texts) == 1 and self.coalesce_ms > 0:
+            return [self.submit_query(embed_fn, texts[0], model_id).result()]
+
+        return [
+            embedding
+            for future in self.submit(embed_fn, texts)
+            for embedding in future.result()
+        ]
+
+    def submit_query(self, embed_fn: EmbedFn, text: str, model_id: str) -> Future:
+        """
+        the embedding of a single query, sent with the other queries
+        for the same model arriving within coalesce_ms
+        (or as soon as a batch is full)
+        """
+        future = Future()
+
+        with self._lock:
+            pending = self._pending.get(model_id)
+            first = pending is None
+
+            if first:
+                pending = self._pending[model_id] = _PendingQueries()
+
+            pending.texts.append(text)
+            pending.futures.append(future)
+            pending.contexts.append(otel_context.get_current())
+            full = len(pending.texts) >= self.batch_size
+
+        if full:
+            self._flush(embed_fn, model_id, pending)
+        elif first:
+            timer = threading.Timer(
+                self.coalesce_ms / 1000.0,
+                self._flush,
+                args=(embed_fn, model_id, pending),
+            )
+            timer.daemon = True
+            timer.start()
+
+        return future
+
+    def _flush(self, embed_fn: EmbedFn, model_id: str, pending: _PendingQueries):
+        """
+        send the queries waiting, as one batch
+        """
+        with self._lock:
+            # already sent (the batch was full before the timer)
+            if self._pending.get(model_id) is not pending:
+                return
+            del self._pending[model_id]
+
+        batch_future = self._executor.submit(
+            self._run_batch,
+            embed_fn,
+            pending.texts,
+            pending.contexts,
+            pending.time_start,
+        )
+
+        def _set_results(done: Future):
+            error = done.exception()
+            for i, future in enumerate(pending.futures):
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(done.result()[i])
+
+        batch_future.add_done_callback(_set_results)
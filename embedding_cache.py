@@ -0,0 +1,220 @@
+"""
+Embedding Cache
+
+    to avoid remote calls to the embeddings model for repeated texts
+
+    two tiers:
+    * in memory, bounded, with LRU eviction
+    * on disk (optional), a memory-mapped float32 file (one per model)
+      with an index (key -> row)
+"""
+
+import hashlib
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils import get_console_logger
+
+logger = get_console_logger()
+
+
+def normalize_text(text: str) -> str:
+    """
+    normalize the text used as key: unicode NFC, whitespaces collapsed
+    """
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def make_key(model_id: str, text: str) -> str:
+    """
+    the key of the cache: hash of model id + normalized text
+    """
+    key = f"{model_id}\x00{normalize_text(text)}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class DiskTier:
+    """
+    Embeddings persisted on disk, for a single model
+
+    * <name>.f32: rows of float32, memory-mapped for reading
+    * <name>.idx: the index, first line the dimension,
+      then one line for every row: key
+    """
+
+    def __init__(self, cache_dir: str, model_id: str, max_entries: int):
+        name = re.sub(r"[^a-zA-Z0-9._\-]", "_", model_id)
+
+        self.vectors_path = os.path.join(cache_dir, f"{name}.f32")
+        self.index_path = os.path.join(cache_dir, f"{name}.idx")
+        self.max_entries = max_entries
+
+        self._index: Dict[str, int] = {}
+        self._dim = None
+        self._matrix = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            lines = f.read().split()
+
+        if lines:
+            self._dim = int(lines[0])
+            keys = lines[1:]
+            # rows are written before keys: every key has its row
+            self._index = {key: row for row, key in enumerate(keys)}
+
+            logger.info("Loaded %d embeddings from %s", len(keys), self.vectors_path)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        the embedding for key, None if not found
+        """
+        row = self._index.get(key)
+        if row is None:
+            return None
+
+        if self._matrix is None or row >= self._matrix.shape[0]:
+            # the file has grown: map it again
+            self._matrix = np.memmap(
+                self.vectors_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(len(self._index), self._dim),
+            )
+        return np.array(self._matrix[row])
+
+    def put(self, key: str, vector: np.ndarray):
+        """
+        append the embedding to the file (if there is room)
+        """
+        if key in self._index or len(self._index) >= self.max_entries:
+            return
+        if self._dim is None:
+            self._dim = vector.shape[0]
+            with open(self.index_path, "w", encoding="utf-8") as f:
+                f.write(f"{self._dim}\n")
+            # remove any leftover of a previous file
+            open(self.vectors_path, "wb").close()
+
+        with open(self.vectors_path, "ab") as f:
+            f.write(vector.astype(np.float32).tobytes())
+        with open(self.index_path, "a", encoding="utf-8") as f:
+            f.write(key + "\n")
+
+        self._index[key] = len(self._index)
+
+
+class EmbeddingCache:
+    """
+    Cache of embeddings, keyed on model id + normalized text
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        cache_dir: str | None = None,
+        max_disk_entries: int = 100000,
+    ):
+        """
+        max_entries: max num. of embeddings kept in memory
+        cache_dir: if given, embeddings are persisted in this dir
+        """
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._disk: Dict[str, DiskTier] = {}
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_disk_tier(self, model_id: str) -> Optional[DiskTier]:
+        if not self.cache_dir:
+            return None
+        if model_id not in self._disk:
+            self._disk[model_id] = DiskTier(
+                self.cache_dir, model_id, self.max_disk_entries
+            )
+        return self._disk[model_id]
+
+    def _put_memory(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def lookup(
+        self, model_id: str, texts: List[str]
+    ) -> Tuple[List[Optional[List[float]]], List[int]]:
+        """
+        look for the embeddings of texts
+
+        return: the embeddings (None if not found), the indexes of the missing
+        """
+        results = []
+        missing = []
+
+        with self._lock:
+            disk = self._get_disk_tier(model_id)
+
+            for i, text in enumerate(texts):
+                key = make_key(model_id, text)
+                vector = self._memory.get(key)
+
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                elif disk is not None:
+                    vector = disk.get(key)
+                    if vector is not None:
+                        # promoted to the memory tier
+                        self._put_memory(key, vector)
+
+                if vector is None:
+                    self.misses += 1
+                    missing.append(i)
+                    results.append(None)
+                else:
+                    self.hits += 1
+                    results.append(vector.tolist())
+
+        return results, missing
+
+    def store(self, model_id: str, texts: List[str], embeddings: List[List[float]]):
+        """
+        add the embeddings of texts to the cache
+        """
+        with self._lock:
+            disk = self._get_disk_tier(model_id)
+
+            for text, embedding in zip(texts, embeddings):
+                key = make_key(model_id, text)
+                vector = np.asarray(embedding, dtype=np.float32)
+
+                self._put_memory(key, vector)
+                if disk is not None:
+                    disk.put(key, vector)
+
+    def __len__(self) -> int:
+        return len(self._memory)
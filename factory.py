@@ -4,31 +4,95 @@ factory.py
 integrated with APM tracing
 """
 
-from langchain.chains import create_history_aware_retriever
+from operator import itemgetter
+
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnablePassthrough
 
 # these are the extension to add APM tracing
 from oci_embeddings_4_apm import OCIGenAIEmbeddings4APM
 from chatocigenai_4_apm import ChatOCIGenAI4APM
+from llm_router import LLMRouter
 from factory_vector_store import get_vector_store
+from embedding_cache import EmbeddingCache
+from embedding_batcher import EmbeddingBatcher
+from semantic_cache import SemanticCache
+from speculative_retrieval import SpeculativeRetrieval
+from condense_policy import CondensePolicy
+from context_compressor import ContextCompressor
+from hybrid_retriever import HybridRetriever
 from prompts_library import CONTEXT_Q_PROMPT, QA_PROMPT
 from tracer_singleton import TracerSingleton
-from config_reader import ConfigReader
+from config_reader import get_config
 from utils import get_console_logger
 
 from config_private import COMPARTMENT_ID
 
-
-config = ConfigReader("./config.toml")
-VERBOSE = config.find_key("verbose")
-AUTH_TYPE = config.find_key("auth_type")
+# shared by all the modules, values can change when the file is reloaded
+config = get_config()
 
 logger = get_console_logger()
 
 # for APM integration
 TRACER = TracerSingleton.get_instance()
 
+# the caches are shared by all the chains built in the process
+_EMBED_CACHE = None
+_EMBED_BATCHER = None
+_SEMANTIC_CACHE = None
+_CONDENSE_POLICY = None
+
+
+def get_embed_cache():
+    """
+    get the cache of embeddings (None if disabled in config)
+    """
+    global _EMBED_CACHE
+
+    if _EMBED_CACHE is None and config.get("embeddings.oci.embed_cache_enable"):
+        _EMBED_CACHE = EmbeddingCache(
+            max_entries=config.get("embeddings.oci.embed_cache_max_entries"),
+            cache_dir=config.get("embeddings.oci.embed_cache_dir"),
+            max_disk_entries=config.get("embeddings.oci.embed_cache_max_disk_entries"),
+        )
+
+    return _EMBED_CACHE
+
+
+def get_embed_batcher():
+    """
+    get the batcher of the remote embedding calls (None if disabled in config)
+    """
+    global _EMBED_BATCHER
+
+    if _EMBED_BATCHER is None and config.get("embeddings.oci.embed_batcher_enable"):
+        _EMBED_BATCHER = EmbeddingBatcher(
+            batch_size=config.get("embeddings.oci.embed_batch_size"),
+            max_workers=config.get("embeddings.oci.embed_max_workers"),
+            coalesce_ms=config.get("embeddings.oci.embed_coalesce_ms"),
+        )
+
+    return _EMBED_BATCHER
+
+
+def get_semantic_cache():
+    """
+    get the cache of answers (None if disabled in config)
+    """
+    global _SEMANTIC_CACHE
+
+    if _SEMANTIC_CACHE is None and config.get("semantic_cache.semantic_cache_enable"):
+        _SEMANTIC_CACHE = SemanticCache(
+            threshold=config.get("semantic_cache.semantic_cache_threshold"),
+            ttl_sec=config.get("semantic_cache.semantic_cache_ttl_sec"),
+            max_entries=config.get("semantic_cache.semantic_cache_max_entries"),
+            check_sec=config.get("semantic_cache.semantic_cache_check_sec"),
+        )
+
+    return _SEMANTIC_CACHE
+
 
 def get_embed_model():
     """
@@ -36,31 +100,28 @@ def get_embed_model():
     """
 
     embed_model = OCIGenAIEmbeddings4APM(
-        auth_type=AUTH_TYPE,
-        model_id=config.find_key("embed_model"),
-        service_endpoint=config.find_key("embed_endpoint"),
+        auth_type=config.get("general.auth_type"),
+        model_id=config.get("embeddings.oci.embed_model"),
+        service_endpoint=config.get("embeddings.oci.embed_endpoint"),
         compartment_id=COMPARTMENT_ID,
+        embed_cache=get_embed_cache(),
+        embed_batcher=get_embed_batcher(),
     )
 
     return embed_model
 
 
-def get_llm():
+def get_oci_llm(model_id: str):
     """
-    Build and return the LLM client
+    Build the client for one OCI model
     """
+    max_tokens = config.get("llm.max_tokens")
+    temperature = config.get("llm.temperature")
+    service_endpoint = config.get("llm.oci.endpoint")
 
-    model_id = config.find_key("llm_model")
-    max_tokens = config.find_key("max_tokens")
-    temperature = config.find_key("temperature")
-    service_endpoint = config.find_key("endpoint")
-
-    if VERBOSE:
-        logger.info("%s as ChatModel...", model_id)
-
-    llm = ChatOCIGenAI4APM(
+    return ChatOCIGenAI4APM(
         # this example uses api_key
-        auth_type=AUTH_TYPE,
+        auth_type=config.get("general.auth_type"),
         model_id=model_id,
         service_endpoint=service_endpoint,
         compartment_id=COMPARTMENT_ID,
@@ -68,32 +129,196 @@ def get_llm():
         model_kwargs={"temperature": temperature, "max_tokens": max_tokens},
     )
 
-    return llm
+
+def get_llm():
+    """
+    Build and return the LLM client
+
+    with the router: llm_model and the fallback models
+    """
+
+    model_id = config.get("llm.oci.llm_model")
+
+    if config.get("general.verbose"):
+        logger.info("%s as ChatModel...", model_id)
+
+    if not config.get("llm.llm_router_enable"):
+        return get_oci_llm(model_id)
+
+    model_ids = [model_id] + [
+        fallback_id
+        for fallback_id in config.get("llm.oci.llm_fallback_models")
+        if fallback_id != model_id
+    ]
+
+    return LLMRouter(
+        models=[get_oci_llm(fallback_id) for fallback_id in model_ids],
+        deadline_sec=config.get("llm.llm_deadline_sec"),
+        attempt_timeout_sec=config.get("llm.llm_attempt_timeout_sec"),
+        max_retries=config.get("llm.llm_max_retries"),
+        backoff_base_ms=config.get("llm.llm_backoff_base_ms"),
+        backoff_max_ms=config.get("llm.llm_backoff_max_ms"),
+        hedge_enable=config.get("llm.llm_hedge_enable"),
+        hedge_after_ms=config.get("llm.llm_hedge_after_ms"),
+        breaker_failures=config.get("llm.llm_breaker_failures"),
+        breaker_open_sec=config.get("llm.llm_breaker_open_sec"),
+    )
+
+
+def get_condense_policy():
+    """
+    get the policy deciding when the question is reformulated by the LLM
+    """
+    global _CONDENSE_POLICY
+
+    if _CONDENSE_POLICY is None:
+        _CONDENSE_POLICY = CondensePolicy(
+            mode=config.get("condense.condense_mode"),
+            min_history_msgs=config.get("condense.condense_min_history_msgs"),
+            cache_max_entries=config.get("condense.condense_cache_max_entries"),
+        )
+
+    return _CONDENSE_POLICY
+
+
+def apply_config(new_config):
+    """
+    send the reloaded values to the live caches and policy
+
+    the other values (LLM, retriever...) are used when the chain is rebuilt
+    """
+    if _SEMANTIC_CACHE is not None:
+        _SEMANTIC_CACHE.threshold = new_config.get(
+            "semantic_cache.semantic_cache_threshold"
+        )
+        _SEMANTIC_CACHE.ttl_sec = new_config.get(
+            "semantic_cache.semantic_cache_ttl_sec"
+        )
+        _SEMANTIC_CACHE.check_sec = new_config.get(
+            "semantic_cache.semantic_cache_check_sec"
+        )
+
+    if _EMBED_CACHE is not None:
+        _EMBED_CACHE.max_entries = new_config.get(
+            "embeddings.oci.embed_cache_max_entries"
+        )
+
+    if _EMBED_BATCHER is not None:
+        _EMBED_BATCHER.batch_size = new_config.get("embeddings.oci.embed_batch_size")
+        _EMBED_BATCHER.coalesce_ms = new_config.get("embeddings.oci.embed_coalesce_ms")
+
+    if _CONDENSE_POLICY is not None:
+        _CONDENSE_POLICY.mode = new_config.get("condense.condense_mode")
+        _CONDENSE_POLICY.min_history_msgs = new_config.get(
+            "condense.condense_min_history_msgs"
+        )
+        _CONDENSE_POLICY.cache_max_entries = new_config.get(
+            "condense.condense_cache_max_entries"
+        )
+
+
+config.subscribe(apply_config)
+
+
+def build_condense_chain(chat_model):
+    """
+    the chain giving the standalone question (as in create_history_aware_retriever)
+
+    the question is reformulated by the LLM according to the condense policy
+    """
+    condense_llm_chain = CONTEXT_Q_PROMPT | chat_model | StrOutputParser()
+
+    return get_condense_policy().as_runnable(condense_llm_chain)
+
+
+def get_retriever(v_store):
+    """
+    the retriever on the vector store, as in config (retriever_mode)
+    """
+    # num of docs given to the LLM
+    top_k = config.get("retriever.top_k")
+
+    if config.get("retriever.retriever_mode") == "hybrid":
+        return HybridRetriever(
+            vector_store=v_store,
+            k=top_k,
+            fetch_k=max(top_k, config.get("retriever.retriever_fetch_k")),
+            lexical_weight=config.get("retriever.retriever_lexical_weight"),
+            mmr_lambda=config.get("retriever.retriever_mmr_lambda"),
+        )
+
+    return v_store.as_retriever(search_kwargs={"k": top_k})
 
 
 @TRACER.start_as_current_span("build_rag_chain")
-def build_rag_chain():
+def build_rag_chain(embed_model=None, v_store=None, chat_model=None):
     """
     build the entire rag chain with Langchain LCEL
+
+    the components can be given (for example local fakes),
+    otherwise they're built from config
     """
-    embed_model = get_embed_model()
+    if v_store is None:
+        if embed_model is None:
+            embed_model = get_embed_model()
 
-    v_store = get_vector_store(embed_model=embed_model)
+        v_store = get_vector_store(embed_model=embed_model)
 
-    # num of docs returned from semantic search
-    top_k = config.find_key("top_k")
+    retriever = get_retriever(v_store)
 
-    retriever = v_store.as_retriever(search_kwargs={"k": top_k})
+    if config.get("context.context_compression_enable"):
+        # the docs are compressed before the QA prompt
+        retriever = ContextCompressor(
+            v_store.embeddings,
+            max_tokens=config.get("context.context_max_tokens"),
+            min_similarity=config.get("context.context_min_similarity"),
+        ).wrap(retriever)
 
-    chat_model = get_llm()
+    if chat_model is None:
+        chat_model = get_llm()
 
     # using prompt defined in prompt_library
     # 3/07 modified for chat interface
-    history_aware_retriever = create_history_aware_retriever(
-        chat_model, retriever, CONTEXT_Q_PROMPT
-    )
+    condense_chain = build_condense_chain(chat_model)
     question_answer_chain = create_stuff_documents_chain(chat_model, QA_PROMPT)
 
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
+    speculative_retrieval = None
+    if config.get("retriever.speculative_retrieval_enable"):
+        speculative_retrieval = SpeculativeRetrieval(
+            v_store.embeddings,
+            min_similarity=config.get("retriever.speculative_min_similarity"),
+        )
+
+    if speculative_retrieval is not None:
+        # the docs are retrieved while the question is condensed,
+        # awaited only here (after the semantic cache)
+        answer_chain = speculative_retrieval.answer_runnable(
+            retriever, question_answer_chain
+        )
+    else:
+        # retrieval and answer, based on the standalone question
+        answer_chain = create_retrieval_chain(
+            itemgetter("standalone_question") | retriever, question_answer_chain
+        )
+
+    semantic_cache = get_semantic_cache()
+    if semantic_cache is not None:
+        answer_chain = semantic_cache.wrap(
+            answer_chain,
+            v_store.embeddings,
+            v_store.get_collection_version,
+            # on a hit the speculative retrieval is not needed
+            on_hit=speculative_retrieval.cancel if speculative_retrieval else None,
+        )
+
+    if speculative_retrieval is not None:
+        rag_chain = (
+            speculative_retrieval.as_runnable(condense_chain, retriever) | answer_chain
+        )
+    else:
+        rag_chain = (
+            RunnablePassthrough.assign(standalone_question=condense_chain)
+            | answer_chain
+        )
 
     return rag_chain
@@ -4,19 +4,22 @@ Date created: 2024-05-20
 Date last modified: 2024-05-23
 
 Usage:
-    This module handles the creation of the Vector Store 
+    This module handles the creation of the Vector Store
     used in the RAG chain, based on config
 
 Python Version: 3.11
 """
 
+import threading
+
 import oracledb
 
 from langchain_community.vectorstores.utils import DistanceStrategy
 
-from config_reader import ConfigReader
+from config_reader import get_config
 from tracer_singleton import TracerSingleton
 from oraclevs_4_apm import OracleVS4APM
+from local_vector_store import LocalVectorIndex, LocalVS4APM, OracleSource
 from utils import get_console_logger
 
 from config_private import DB_USER, DB_PWD, DSN, TNS_ADMIN, WALLET_PWD
@@ -24,8 +27,7 @@ from config_private import DB_USER, DB_PWD, DSN, TNS_ADMIN, WALLET_PWD
 #
 # Configs
 #
-config = ConfigReader("./config.toml")
-VERBOSE = config.find_key("verbose")
+config = get_config()
 SERVICE_NAME = "Factory Vector Store"
 
 # for APM integration
@@ -33,16 +35,18 @@ TRACER = TracerSingleton.get_instance()
 
 logger = get_console_logger()
 
+# the pool is created only once and shared in the process
+_DB_POOL = None
+_DB_POOL_LOCK = threading.Lock()
+# the local store in use: its refresh thread is stopped when replaced
+_LOCAL_VS = None
 
-@TRACER.start_as_current_span("get_db_connection")
-def get_db_connection():
-    """
-    get a connection to db
 
-    this function works if the DB is ADB
+def get_conn_parms():
     """
-
-    conn_parms = {
+    the parameters to connect to ADB (with wallet)
+    """
+    return {
         "user": DB_USER,
         "password": DB_PWD,
         "dsn": DSN,
@@ -52,7 +56,18 @@ def get_db_connection():
         "wallet_password": WALLET_PWD,
     }
 
-    if VERBOSE:
+
+@TRACER.start_as_current_span("get_db_connection")
+def get_db_connection():
+    """
+    get a connection to db
+
+    this function works if the DB is ADB
+    """
+
+    conn_parms = get_conn_parms()
+
+    if config.get("general.verbose"):
         logger.info("")
         logger.info("Connecting as USER: %s to DSN: %s", DB_USER, DSN)
 
@@ -63,6 +78,77 @@ def get_db_connection():
         raise
 
 
+@TRACER.start_as_current_span("get_db_pool")
+def get_db_pool():
+    """
+    get the pool of connections to db, created at the first call
+
+    min, max and increment are read from config.toml
+    """
+    global _DB_POOL
+
+    with _DB_POOL_LOCK:
+        if _DB_POOL is None:
+            pool_parms = {
+                "min": config.get("vector_store.db_pool_min"),
+                "max": config.get("vector_store.db_pool_max"),
+                "increment": config.get("vector_store.db_pool_increment"),
+                "getmode": oracledb.POOL_GETMODE_WAIT,
+            }
+
+            if config.get("general.verbose"):
+                logger.info("")
+                logger.info("Creating pool as USER: %s to DSN: %s", DB_USER, DSN)
+
+            try:
+                _DB_POOL = oracledb.create_pool(**get_conn_parms(), **pool_parms)
+            except oracledb.Error as e:
+                logger.error("Database pool creation failed: %s", str(e))
+                raise
+
+    return _DB_POOL
+
+
+def get_local_vector_store(embed_model):
+    """
+    the local index of the collection, refreshed from the DB
+    (at start and then every local_vs_refresh_sec)
+
+    the store built before (by a previous chain) stops its refresh
+    """
+    global _LOCAL_VS
+
+    table_name = config.get("vector_store.collection_name")
+
+    if config.get("vector_store.db_pool_enable"):
+        pool = get_db_pool()
+        source = OracleSource(table_name, pool.acquire, pool.release)
+    else:
+        db_conn = get_db_connection()
+        source = OracleSource(table_name, lambda: db_conn)
+
+    index = LocalVectorIndex(
+        config.get("vector_store.local_vs_dir"),
+        table_name,
+        index_type=config.get("vector_store.local_vs_index"),
+        ivf_lists=config.get("vector_store.local_vs_ivf_lists"),
+        ivf_probes=config.get("vector_store.local_vs_ivf_probes"),
+        ivf_min_rows=config.get("vector_store.local_vs_ivf_min_rows"),
+    )
+    v_store = LocalVS4APM(index, embed_model, table_name, source=source)
+
+    stats = v_store.refresh()
+    logger.info("Local vector store loaded: %s", stats)
+
+    if _LOCAL_VS is not None:
+        _LOCAL_VS.stop_refresh()
+    _LOCAL_VS = v_store
+
+    v_store.start_refresh(config.get("vector_store.local_vs_refresh_sec"))
+
+    return v_store
+
+
 @TRACER.start_as_current_span("get_vector_store")
 def get_vector_store(embed_model):
     """
@@ -73,14 +159,26 @@ def get_vector_store(embed_model):
     v_store = None
 
     try:
-        db_conn = get_db_connection()
-
-        v_store = OracleVS4APM(
-            client=db_conn,
-            table_name=config.find_key("collection_name"),
-            distance_strategy=DistanceStrategy.COSINE,
-            embedding_function=embed_model,
-        )
+        if config.get("vector_store.vector_store_type") == "local":
+            # searches in process, on a local copy of the embeddings
+            v_store = get_local_vector_store(embed_model)
+        elif config.get("vector_store.db_pool_enable"):
+            # connections are borrowed from the pool for every query
+            v_store = OracleVS4APM(
+                pool=get_db_pool(),
+                table_name=config.get("vector_store.collection_name"),
+                distance_strategy=DistanceStrategy.COSINE,
+                embedding_function=embed_model,
+            )
+        else:
+            db_conn = get_db_connection()
+
+            v_store = OracleVS4APM(
+                client=db_conn,
+                table_name=config.get("vector_store.collection_name"),
+                distance_strategy=DistanceStrategy.COSINE,
+                embedding_function=embed_model,
+            )
     except oracledb.Error as e:
         err_msg = "A DB error occurred in get_vector_store: " + str(e)
         logger.error(err_msg)
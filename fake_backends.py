@@ -0,0 +1,446 @@
+"""
+Fake backends
+
+    local, in-memory, stand-ins for OCI GenAI and Oracle DB,
+    to check the behaviour of the components without cloud resources
+"""
+
+import asyncio
+import hashlib
+import math
+import random
+import threading
+import time
+from typing import List, Tuple
+
+import numpy as np
+import oracledb
+
+from langchain_core.documents.base import Document
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+from chatocigenai_4_apm import ChatOCIGenAI4APM
+from oci_embeddings_4_apm import OCIGenAIEmbeddings4APM
+from oraclevs_4_apm import OracleVS4APM
+from factory import build_rag_chain, get_embed_batcher
+
+
+class FakeCursor:
+    """
+    A fake DB cursor: the statements are counted, the DB is empty
+
+    (SELECT COUNT(*) gives 0, a query gives no rows)
+    a fraction (failure_rate of the pool) of the statements fails,
+    as a DB error
+    """
+
+    def __init__(self, connection: "FakeConnection"):
+        self.connection = connection
+        self._rows: List[tuple] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self, statement: str):
+        if self.connection.closed:
+            raise oracledb.InterfaceError("DPY-1001: not connected to database")
+        pool = self.connection.pool
+        if pool is not None and random.random() < pool.failure_rate:
+            raise oracledb.DatabaseError("fake: statement failed")
+
+        self.connection.executed += 1
+        is_count = statement.lstrip().upper().startswith("SELECT COUNT(*)")
+        self._rows = [(0,)] if is_count else []
+
+    def execute(self, statement: str, parameters=None, **kwargs):
+        """
+        run a statement
+        """
+        self._run(statement)
+
+    def executemany(self, statement: str, parameters):
+        """
+        run a statement for every set of parameters
+        """
+        self._run(statement)
+
+    def fetchone(self):
+        """
+        the next row, None if there are no more rows
+        """
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self) -> List[tuple]:
+        """
+        the remaining rows
+        """
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        """
+        close the cursor
+        """
+        self._rows = []
+
+
+class FakeConnection(oracledb.Connection):
+    """
+    A fake DB connection, returned by FakeConnectionPool
+
+    an oracledb.Connection (OracleVS checks the type) never connected
+    """
+
+    # as a connection in thin mode (no client libraries needed)
+    thin = True
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, conn_id: int, pool: "FakeConnectionPool" = None):
+        # no DB behind: the methods of oracledb.Connection are not used
+        self._impl = None
+        self.conn_id = conn_id
+        self.pool = pool
+        self.closed = False
+        # num. of statements run
+        self.executed = 0
+
+    def cursor(self, *args, **kwargs) -> FakeCursor:
+        """
+        a cursor on the fake DB
+        """
+        return FakeCursor(self)
+
+    def commit(self):
+        """
+        nothing to commit
+        """
+
+    def close(self):
+        """
+        close the connection
+        """
+        self.closed = True
+
+
+class FakeConnectionPool:
+    """
+    In-memory stand-in for oracledb.ConnectionPool
+
+    tracks how many connections have been opened, are busy
+    and how many times they have been acquired/released
+
+    failure_rate: fraction of the statements failing (see: FakeCursor),
+        can be changed at any time
+    """
+
+    def __init__(
+        self,
+        min: int = 1,
+        max: int = 4,
+        increment: int = 1,
+        failure_rate: float = 0.0,
+    ):
+        # pylint: disable=redefined-builtin
+        self.min = min
+        self.max = max
+        self.increment = increment
+        self.failure_rate = failure_rate
+
+        self._cond = threading.Condition()
+        self._idle = [FakeConnection(i, self) for i in range(min)]
+        self._busy = set()
+        self._next_id = min
+
+        self.acquire_count = 0
+        self.release_count = 0
+
+    @property
+    def opened(self) -> int:
+        """
+        num. of connections open (idle + busy)
+        """
+        return len(self._idle) + len(self._busy)
+
+    @property
+    def busy(self) -> int:
+        """
+        num. of connections in use
+        """
+        return len(self._busy)
+
+    def acquire(self) -> FakeConnection:
+        """
+        get a connection, waiting if the pool is exhausted
+        """
+        with self._cond:
+            while not self._idle and self.opened >= self.max:
+                self._cond.wait()
+
+            if not self._idle:
+                n_new = min(self.increment, self.max - self.opened)
+                self._idle.extend(
+                    FakeConnection(self._next_id + i, self) for i in range(n_new)
+                )
+                self._next_id += n_new
+
+            connection = self._idle.pop()
+            self._busy.add(connection)
+            self.acquire_count += 1
+
+            return connection
+
+    def release(self, connection: FakeConnection):
+        """
+        give back a connection to the pool
+        """
+        with self._cond:
+            self._busy.remove(connection)
+            self._idle.append(connection)
+            self.release_count += 1
+            self._cond.notify()
+
+    def close(self, force: bool = False):
+        """
+        close all the connections
+        """
+        with self._cond:
+            if self._busy and not force:
+                raise RuntimeError("Pool has busy connections")
+
+            for connection in self._idle + list(self._busy):
+                connection.close()
+            self._idle = []
+            self._busy = set()
+
+
+#
+# fake models and vector store, with configurable latency
+# they extend the APM classes, so spans are the same as in production
+#
+# the latency of every call is drawn from a distribution, with mean latency_ms
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+# lognormal: the spread (a long tail, as real services)
+LOGNORMAL_SIGMA = 0.5
+
+
+def sample_latency_ms(latency_ms: float, distribution: str = "fixed") -> float:
+    """
+    a latency, from the distribution, with mean latency_ms
+    """
+    if latency_ms <= 0 or distribution == "fixed":
+        return latency_ms
+    if distribution == "uniform":
+        return random.uniform(0.0, 2.0 * latency_ms)
+    if distribution == "exponential":
+        return random.expovariate(1.0 / latency_ms)
+    if distribution == "lognormal":
+        mu = math.log(latency_ms) - LOGNORMAL_SIGMA**2 / 2.0
+        return random.lognormvariate(mu, LOGNORMAL_SIGMA)
+
+    raise ValueError(f"Unknown latency distribution: {distribution}")
+
+
+class FakeServiceError(Exception):
+    """
+    a failure of the fake LLM, with an HTTP status (as oci ServiceError)
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class FakeChatOCIGenAI4APM(ChatOCIGenAI4APM):
+    """
+    ChatOCIGenAI4APM with no call to OCI: returns a fixed answer after latency_ms
+    (drawn from latency_dist)
+
+    latency injection: a fraction (slow_rate) of the calls takes
+    slow_latency_ms more, a fraction (failure_rate) fails (503)
+    """
+
+    latency_ms: float = 1000.0
+    latency_dist: str = "fixed"
+    answer: str = "This is an answer from a fake LLM, used only for local tests."
+    slow_rate: float = 0.0
+    slow_latency_ms: float = 0.0
+    failure_rate: float = 0.0
+
+    def _result(self) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(self.answer))])
+
+    def _latency_sec(self) -> float:
+        """
+        the latency of a call, raises if the call fails
+        """
+        if random.random() < self.failure_rate:
+            raise FakeServiceError(503, f"{self.model_id}: service unavailable")
+
+        latency_ms = sample_latency_ms(self.latency_ms, self.latency_dist)
+        if random.random() < self.slow_rate:
+            latency_ms += self.slow_latency_ms
+        return latency_ms / 1000.0
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self._latency_sec())
+        return self._result()
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self._latency_sec())
+        return self._result()
+
+    def _tokens(self) -> List[str]:
+        # one token for every word
+        return [word + " " for word in self.answer.split()]
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self._tokens()
+        latency_sec = self._latency_sec()
+        for token in tokens:
+            time.sleep(latency_sec / len(tokens))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self._tokens()
+        latency_sec = self._latency_sec()
+        for token in tokens:
+            await asyncio.sleep(latency_sec / len(tokens))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+class FakeOCIGenAIEmbeddings4APM(OCIGenAIEmbeddings4APM):
+    """
+    OCIGenAIEmbeddings4APM with no call to OCI
+
+    vectors are deterministic (depend only on the text)
+    """
+
+    latency_ms: float = 50.0
+    latency_dist: str = "fixed"
+    embed_dim: int = 1024
+
+    def _vector(self, text: str) -> List[float]:
+        rnd = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+        return [rnd.uniform(-1.0, 1.0) for _ in range(self.embed_dim)]
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        # one remote call: latency_ms, whatever the size of the batch
+        time.sleep(sample_latency_ms(self.latency_ms, self.latency_dist) / 1000.0)
+        return [self._vector(text) for text in texts]
+
+
+class FakeOracleVS4APM(OracleVS4APM):
+    """
+    OracleVS4APM with no DB: returns k fixed documents after latency_ms
+    (drawn from latency_dist)
+    """
+
+    # pylint: disable=super-init-not-called
+    def __init__(
+        self, embedding_function, latency_ms: float = 20.0, latency_dist: str = "fixed"
+    ):
+        self._pool = None
+        self._local = threading.local()
+        self._client = None
+
+        self.embedding_function = embedding_function
+        self.table_name = "FAKE_BOOKS"
+        self.distance_strategy = DistanceStrategy.COSINE
+        self.params = None
+        self.latency_ms = latency_ms
+        self.latency_dist = latency_dist
+
+    def _latency_sec(self) -> float:
+        return sample_latency_ms(self.latency_ms, self.latency_dist) / 1000.0
+
+    def _results(self, k: int) -> List[Tuple[Document, float]]:
+        return [
+            (
+                Document(
+                    page_content=f"Fake chunk n. {i} from the fake collection.",
+                    metadata={"source": "fake_book.pdf", "page": i},
+                ),
+                0.1 * i,
+            )
+            for i in range(k)
+        ]
+
+    def similarity_search_by_vector_returning_embeddings(
+        self, embedding, k, filter=None, **kwargs
+    ):
+        time.sleep(self._latency_sec())
+        # near the query, every doc in a different direction
+        rng = np.random.default_rng(0)
+        query = np.asarray(embedding, dtype=np.float32)
+        return [
+            (doc, distance, query + rng.standard_normal(len(query)).astype(np.float32))
+            for doc, distance in self._results(k)
+        ]
+
+    def get_collection_version(self):
+        # the fake collection never changes
+        return 0
+
+    def similarity_search_by_vector_with_relevance_scores(
+        self, embedding, k=4, filter=None, **kwargs
+    ):
+        time.sleep(self._latency_sec())
+        return self._results(k)
+
+    async def asimilarity_search_by_vector_with_relevance_scores(
+        self, embedding, k=4, filter=None, **kwargs
+    ):
+        await asyncio.sleep(self._latency_sec())
+        return self._results(k)
+
+
+def build_fake_rag_chain(
+    llm_latency_ms: float = 1000.0,
+    embed_latency_ms: float = 50.0,
+    db_latency_ms: float = 20.0,
+    latency_dist: str = "fixed",
+):
+    """
+    build the RAG chain (same as in factory) with fake models and vector store
+
+    latency_dist: distribution of the latencies (see: LATENCY_DISTRIBUTIONS)
+    """
+    chain, _ = build_fake_rag_chain_with_embeddings(
+        llm_latency_ms, embed_latency_ms, db_latency_ms, latency_dist
+    )
+    return chain
+
+
+def build_fake_rag_chain_with_embeddings(
+    llm_latency_ms: float = 1000.0,
+    embed_latency_ms: float = 50.0,
+    db_latency_ms: float = 20.0,
+    latency_dist: str = "fixed",
+):
+    """
+    the fake RAG chain and its embed model (a builder for ChainRegistry)
+    """
+    # the batcher as configured, as in factory.get_embed_model
+    embed_model = FakeOCIGenAIEmbeddings4APM(
+        client=object(),
+        model_id="fake.embed",
+        latency_ms=embed_latency_ms,
+        latency_dist=latency_dist,
+        embed_batcher=get_embed_batcher(),
+    )
+    v_store = FakeOracleVS4APM(
+        embed_model, latency_ms=db_latency_ms, latency_dist=latency_dist
+    )
+    chat_model = FakeChatOCIGenAI4APM(
+        client=object(),
+        model_id="fake.chat",
+        latency_ms=llm_latency_ms,
+        latency_dist=latency_dist,
+    )
+
+    return build_rag_chain(v_store=v_store, chat_model=chat_model), embed_model
@@ -0,0 +1,237 @@
+"""
+Hybrid Retriever
+
+    retrieval in stages, to send to the LLM few chunks without losing recall:
+    * dense: fetch_k candidates from the vector store (with their embeddings)
+    * lexical: BM25 score of the candidates (the words of the question)
+    * fusion: reciprocal rank fusion of the dense and the lexical ranking
+    * MMR: the final k chunks, relevant but not redundant (vectorized)
+
+    Every stage has its own span, child of HybridRetriever.retrieve.
+"""
+
+import re
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents.base import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables.config import run_in_executor
+from opentelemetry import trace
+
+from tracer_singleton import TracerSingleton
+
+TRACER = TracerSingleton.get_instance()
+
+# a candidate from the vector store: (document, distance, embedding)
+Candidate = Tuple[Document, float, np.ndarray]
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    the words of the text, lowercase
+    """
+    return _WORD_RE.findall(text.lower())
+
+
+def bm25_scores(
+    query: str, texts: List[str], k1: float = 1.5, b: float = 0.75
+) -> np.ndarray:
+    """
+    BM25 score of every text for the query
+
+    the statistics (idf, avg. length) are those of the texts given:
+    the candidates are a sample of the collection about the question
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms or not texts:
+        return np.zeros(len(texts))
+
+    counts = [Counter(tokenize(text)) for text in texts]
+    # term frequencies: one row per text, one column per term of the query
+    tf = np.array([[count[term] for term in terms] for count in counts], float)
+    lengths = np.array([sum(count.values()) for count in counts], float)
+
+    n_texts = len(texts)
+    df = np.count_nonzero(tf, axis=0)
+    idf = np.log(1.0 + (n_texts - df + 0.5) / (df + 0.5))
+
+    norm = k1 * (1.0 - b + b * lengths / max(lengths.mean(), 1.0))
+    return (idf * tf * (k1 + 1.0) / (tf + norm[:, None])).sum(axis=1)
+
+
+def ranks(scores: np.ndarray) -> np.ndarray:
+    """
+    rank (0 = best) of every score, higher is better
+    """
+    order = np.argsort(-scores, kind="stable")
+    result = np.empty(len(scores), dtype=np.int64)
+    result[order] = np.arange(len(scores))
+    return result
+
+
+def rrf_fusion(
+    dense_scores: np.ndarray,
+    lexical_scores: np.ndarray,
+    lexical_weight: float = 0.5,
+    rrf_k: int = 60,
+) -> np.ndarray:
+    """
+    reciprocal rank fusion: sum of 1 / (rrf_k + rank) for every ranking
+
+    texts with no word of the query get nothing from the lexical ranking
+    """
+    fused = 1.0 / (rrf_k + 1 + ranks(dense_scores))
+    lexical = lexical_weight / (rrf_k + 1 + ranks(lexical_scores))
+
+    return fused + np.where(lexical_scores > 0, lexical, 0.0)
+
+
+def mmr_select(
+    embeddings: np.ndarray, relevance: np.ndarray, k: int, lambda_mult: float = 0.7
+) -> List[int]:
+    """
+    maximal marginal relevance: pick k rows, each one maximizing
+    lambda * relevance - (1 - lambda) * max similarity to the rows picked
+
+    relevance is rescaled to [0, 1], as the cosine similarities
+    """
+    n_rows = len(relevance)
+    if n_rows == 0:
+        return []
+
+    vectors = embeddings / np.maximum(
+        np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12
+    )
+    similarity = vectors @ vectors.T
+
+    span = relevance.max() - relevance.min()
+    relevance = (relevance - relevance.min()) / span if span > 0 else relevance * 0.0
+
+    selected = []
+    max_similarity = np.full(n_rows, -np.inf)
+    available = np.ones(n_rows, dtype=bool)
+
+    for _ in range(min(k, n_rows)):
+        if selected:
+            scores = lambda_mult * relevance - (1.0 - lambda_mult) * max_similarity
+        else:
+            scores = relevance.copy()
+        scores[~available] = -np.inf
+
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_similarity = np.maximum(max_similarity, similarity[best])
+
+    return selected
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever: dense over-fetch, BM25, fusion, MMR
+
+    the vector store must have similarity_search_by_vector_returning_embeddings
+    (OracleVS4APM, LocalVS4APM)
+    """
+
+    vector_store: Any
+    # num. of docs returned
+    k: int = 6
+    # num. of candidates from the vector store
+    fetch_k: int = 30
+    # weight of the lexical ranking in the fusion (the dense one has 1)
+    lexical_weight: float = 0.5
+    rrf_k: int = 60
+    # 1: only relevance, 0: only diversity
+    mmr_lambda: float = 0.7
+    filter: Optional[Dict[str, Any]] = None
+
+    @TRACER.start_as_current_span("retrieve.dense")
+    def _dense(self, embedding: List[float]) -> List[Candidate]:
+        current_span = trace.get_current_span()
+        current_span.set_attribute("fetch_k", self.fetch_k)
+
+        candidates = self.vector_store.similarity_search_by_vector_returning_embeddings(
+            embedding, self.fetch_k, filter=self.filter
+        )
+        current_span.set_attribute("retrieve_candidates", len(candidates))
+
+        return candidates
+
+    def _rerank(self, query: str, candidates: List[Candidate]) -> List[Document]:
+        """
+        lexical score, fusion and MMR of the candidates
+        """
+        if not candidates:
+            return []
+
+        docs = [doc for doc, _, _ in candidates]
+
+        with TRACER.start_as_current_span("retrieve.lexical") as span:
+            lexical_scores = bm25_scores(query, [doc.page_content for doc in docs])
+            span.set_attribute(
+                "retrieve_lexical_matches", int(np.count_nonzero(lexical_scores))
+            )
+
+        with TRACER.start_as_current_span("retrieve.fusion") as span:
+            # distances: lower is better
+            dense_scores = -np.array([distance for _, distance, _ in candidates])
+            fused = rrf_fusion(
+                dense_scores, lexical_scores, self.lexical_weight, self.rrf_k
+            )
+            # how much the fusion changed the dense top k
+            top_fused = set(np.argsort(-fused)[: self.k].tolist())
+            span.set_attribute(
+                "retrieve_fusion_new_in_top_k", len(top_fused - set(range(self.k)))
+            )
+
+        with TRACER.start_as_current_span("retrieve.mmr") as span:
+            embeddings = [embedding for _, _, embedding in candidates]
+
+            if all(len(embedding) for embedding in embeddings):
+                selected = mmr_select(
+                    np.stack(embeddings), fused, self.k, self.mmr_lambda
+                )
+            else:
+                # embeddings not returned by the DB: only the fusion
+                selected = np.argsort(-fused)[: self.k].tolist()
+            span.set_attribute("top_k", len(selected))
+
+        return [docs[i] for i in selected]
+
+    def _set_attributes(self, span):
+        span.set_attribute("fetch_k", self.fetch_k)
+        span.set_attribute("top_k", self.k)
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        with TRACER.start_as_current_span("HybridRetriever.retrieve") as span:
+            self._set_attributes(span)
+
+            with TRACER.start_as_current_span("retrieve.embed_query"):
+                embedding = self.vector_store.embeddings.embed_query(query)
+
+            return self._rerank(query, self._dense(embedding))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        with TRACER.start_as_current_span("HybridRetriever.retrieve") as span:
+            self._set_attributes(span)
+
+            with TRACER.start_as_current_span("retrieve.embed_query"):
+                embedding = await self.vector_store.embeddings.aembed_query(query)
+
+            # the query on the DB (blocking driver) runs in the executor
+            candidates = await run_in_executor(None, self._dense, embedding)
+
+            return self._rerank(query, candidates)
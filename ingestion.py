@@ -0,0 +1,582 @@
+"""
+Ingestion
+
+    to load documents in the collection used by the RAG chain (collection_name)
+
+    the pipeline is streaming: the files are read lazily and chunked,
+    the chunks are embedded in parallel batches (through the instrumented
+    OCIGenAIEmbeddings4APM) and inserted in bulk, with executemany.
+
+    * chunks already in the collection (same content hash) are skipped
+    * a checkpoint file records the files completed, to resume after a stop
+    * every stage has a span, to see in APM where the time goes
+
+    Sinks: Oracle DB (as OracleVS), SQLite, in memory (for local tests)
+
+Usage:
+    python ingestion.py --path ./books --sink oracle
+    python ingestion.py --path ./books --sink sqlite --fake
+"""
+
+import argparse
+import array
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Set, Tuple
+
+import numpy as np
+from opentelemetry import context as otel_context
+from opentelemetry import trace
+
+from tracer_singleton import TracerSingleton
+from config_reader import get_config
+from utils import get_console_logger
+
+config = get_config()
+logger = get_console_logger()
+
+TRACER = TracerSingleton.get_instance()
+
+TEXT_EXTENSIONS = (".txt", ".md")
+PDF_EXTENSIONS = (".pdf",)
+
+# a chunk to insert: (id, text, metadata)
+Chunk = Tuple[str, str, Dict]
+
+
+def chunk_id(source: str, text: str) -> str:
+    """
+    the id of a chunk, from its content: the same chunk gets the same id
+
+    16 hex chars, as the ids generated by OracleVS (RAW(16))
+    """
+    digest = hashlib.sha256(f"{source}\x00{text}".encode("utf-8"))
+    return digest.hexdigest()[:16].upper()
+
+
+#
+# reading and chunking
+#
+def iter_files(path: str) -> Iterator[str]:
+    """
+    the files to load under path (or path itself), in a stable order
+    """
+    if os.path.isfile(path):
+        yield path
+        return
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(TEXT_EXTENSIONS + PDF_EXTENSIONS):
+                yield os.path.join(root, name)
+
+
+def read_paragraphs(file_path: str) -> Iterator[Tuple[str, int]]:
+    """
+    the paragraphs of the file, read lazily, with the page (0 if no pages)
+    """
+    if file_path.lower().endswith(PDF_EXTENSIONS):
+        # optional: needs pypdf
+        # pylint: disable=import-outside-toplevel
+        from langchain_community.document_loaders import PyPDFLoader
+
+        for page in PyPDFLoader(file_path).lazy_load():
+            for paragraph in page.page_content.split("\n\n"):
+                yield paragraph, page.metadata.get("page", 0)
+        return
+
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        lines = []
+        for line in f:
+            if line.strip():
+                lines.append(line)
+            elif lines:
+                yield "".join(lines), 0
+                lines = []
+        if lines:
+            yield "".join(lines), 0
+
+
+def check_chunk_params(chunk_size: int, chunk_overlap: int):
+    """
+    every chunk must add new text: chunk_overlap < chunk_size
+    """
+    if chunk_overlap >= chunk_size:
+        raise ValueError(
+            f"chunk_overlap ({chunk_overlap}) must be less than "
+            f"chunk_size ({chunk_size})"
+        )
+
+
+def chunk_paragraphs(
+    paragraphs: Iterator[Tuple[str, int]], chunk_size: int, chunk_overlap: int
+) -> Iterator[Tuple[str, int]]:
+    """
+    group the paragraphs in chunks of about chunk_size chars,
+    every chunk starts with the last chunk_overlap chars of the previous one
+
+    long paragraphs are split
+    """
+    check_chunk_params(chunk_size, chunk_overlap)
+
+    buffer = ""
+    page = 0
+    # len of the start of buffer already in the previous chunk
+    carried = 0
+
+    for paragraph, paragraph_page in paragraphs:
+        paragraph = " ".join(paragraph.split())
+        if not paragraph:
+            continue
+        if not buffer:
+            page = paragraph_page
+
+        buffer = f"{buffer}\n{paragraph}" if buffer else paragraph
+
+        while len(buffer) >= chunk_size:
+            yield buffer[:chunk_size], page
+            buffer = buffer[chunk_size - chunk_overlap :]
+            carried = chunk_overlap
+            page = paragraph_page
+
+    # only the overlap left: already in the last chunk
+    if len(buffer) > carried and buffer.strip():
+        yield buffer, page
+
+
+#
+# sinks
+#
+class IngestionSink(ABC):
+    """
+    where the chunks are written
+    """
+
+    @abstractmethod
+    def existing_ids(self, ids: List[str]) -> Set[str]:
+        """the ids already in the collection"""
+
+    @abstractmethod
+    def insert(self, chunks: List[Chunk], embeddings: List[List[float]]):
+        """insert the chunks, in bulk"""
+
+    def close(self):
+        """release the resources"""
+
+
+class MemorySink(IngestionSink):
+    """
+    in memory, for local tests
+    """
+
+    def __init__(self):
+        self.rows: Dict[str, Tuple[str, Dict, np.ndarray]] = {}
+
+    def existing_ids(self, ids):
+        return {id_ for id_ in ids if id_ in self.rows}
+
+    def insert(self, chunks, embeddings):
+        for (id_, text, metadata), embedding in zip(chunks, embeddings):
+            self.rows[id_] = (text, metadata, np.asarray(embedding, dtype=np.float32))
+
+
+class SQLiteSink(IngestionSink):
+    """
+    a SQLite table with the same columns as the OracleVS table,
+    the embeddings as float32 blobs
+    """
+
+    def __init__(self, db_path: str, table_name: str):
+        self.table_name = table_name
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table_name} "
+            "(id TEXT PRIMARY KEY, text TEXT, metadata TEXT, embedding BLOB)"
+        )
+
+    def existing_ids(self, ids):
+        placeholders = ", ".join("?" for _ in ids)
+        rows = self._conn.execute(
+            f"SELECT id FROM {self.table_name} WHERE id IN ({placeholders})", ids
+        )
+        return {row[0] for row in rows}
+
+    def insert(self, chunks, embeddings):
+        with self._conn:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table_name} "
+                "(id, text, metadata, embedding) VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        id_,
+                        text,
+                        json.dumps(metadata),
+                        np.asarray(embedding, dtype=np.float32).tobytes(),
+                    )
+                    for (id_, text, metadata), embedding in zip(chunks, embeddings)
+                ],
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+class OracleSink(IngestionSink):
+    """
+    the table of the collection in Oracle DB, as created by OracleVS
+    """
+
+    def __init__(self, connection, table_name: str, embed_dim: int):
+        # pylint: disable=import-outside-toplevel
+        import oracledb
+
+        self._oracledb = oracledb
+        self.table_name = table_name
+        self._conn = connection
+
+        with self._conn.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {table_name} "
+                "(id RAW(16) DEFAULT SYS_GUID() PRIMARY KEY, text CLOB, "
+                f"metadata JSON, embedding VECTOR({embed_dim}, FLOAT32))"
+            )
+
+    def existing_ids(self, ids):
+        # max 1000 values in a IN list
+        found = set()
+
+        with self._conn.cursor() as cursor:
+            for i in range(0, len(ids), 1000):
+                batch = ids[i : i + 1000]
+                placeholders = ", ".join(f":{n + 1}" for n in range(len(batch)))
+                cursor.execute(
+                    f"SELECT RAWTOHEX(id) FROM {self.table_name} "
+                    f"WHERE id IN ({placeholders})",
+                    batch,
+                )
+                found.update(row[0] for row in cursor)
+
+        return found
+
+    def insert(self, chunks, embeddings):
+        oracledb = self._oracledb
+
+        with self._conn.cursor() as cursor:
+            # array binding: the types are set once for all the rows
+            cursor.setinputsizes(
+                None,
+                oracledb.DB_TYPE_VECTOR,
+                oracledb.DB_TYPE_JSON,
+                oracledb.DB_TYPE_CLOB,
+            )
+            cursor.executemany(
+                f"INSERT INTO {self.table_name} (id, embedding, metadata, text) "
+                "VALUES (:1, :2, :3, :4)",
+                [
+                    (id_, array.array("f", embedding), metadata, text)
+                    for (id_, text, metadata), embedding in zip(chunks, embeddings)
+                ],
+            )
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+#
+# checkpoint
+#
+class Checkpoint:
+    """
+    the files completely loaded, with size and mtime (to see if changed)
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.done: Dict[str, List] = {}
+
+        if file_path and os.path.exists(file_path):
+            with open(file_path, "r", encoding="utf-8") as f:
+                self.done = json.load(f)
+
+    @staticmethod
+    def _signature(path: str) -> List:
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+
+    def is_done(self, path: str) -> bool:
+        """
+        true if the file has been loaded and not changed since then
+        """
+        return self.done.get(path) == self._signature(path)
+
+    def mark_done(self, path: str):
+        """
+        record the file as loaded (written on disk at once)
+        """
+        self.done[path] = self._signature(path)
+
+        if self.file_path:
+            tmp_path = f"{self.file_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.done, f)
+            os.replace(tmp_path, self.file_path)
+
+
+#
+# pipeline
+#
+class IngestionPipeline:
+    """
+    read -> chunk -> skip existing -> embed (parallel) -> insert (bulk)
+    """
+
+    def __init__(
+        self,
+        embed_model,
+        sink: IngestionSink,
+        checkpoint: Checkpoint,
+        chunk_size: int = 1500,
+        chunk_overlap: int = 150,
+        batch_size: int = 256,
+        workers: int = 4,
+    ):
+        check_chunk_params(chunk_size, chunk_overlap)
+
+        self.embed_model = embed_model
+        self.sink = sink
+        self.checkpoint = checkpoint
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.batch_size = batch_size
+        self.workers = workers
+
+        self.stats = {
+            "files": 0,
+            "files_skipped": 0,
+            "chunks": 0,
+            "chunks_skipped": 0,
+            "chunks_inserted": 0,
+        }
+        # file -> [chunks not yet inserted, all chunks read]
+        self._pending_files: Dict[str, List] = {}
+
+    def iter_chunks(self, path: str) -> Iterator[Tuple[str, Chunk]]:
+        """
+        the chunks of all the files not yet loaded: (file, chunk)
+        """
+        for file_path in iter_files(path):
+            if self.checkpoint.is_done(file_path):
+                self.stats["files_skipped"] += 1
+                continue
+
+            self.stats["files"] += 1
+            self._pending_files[file_path] = [0, False]
+
+            with TRACER.start_as_current_span("ingest.file") as span:
+                span.set_attribute("ingest_file", file_path)
+                n_chunks = 0
+
+                chunks = chunk_paragraphs(
+                    read_paragraphs(file_path), self.chunk_size, self.chunk_overlap
+                )
+                for text, page in chunks:
+                    metadata = {"source": file_path, "page": page, "chunk": n_chunks}
+                    n_chunks += 1
+                    self._pending_files[file_path][0] += 1
+
+                    yield file_path, (chunk_id(file_path, text), text, metadata)
+
+                span.set_attribute("ingest_chunks", n_chunks)
+
+            # all the chunks of the file have been produced
+            self._pending_files[file_path][1] = True
+            self._complete(file_path, 0)
+
+    def _complete(self, file_path: str, n_inserted: int):
+        """
+        update the count of chunks to insert, checkpoint the completed file
+        """
+        pending = self._pending_files[file_path]
+        pending[0] -= n_inserted
+
+        if pending[0] == 0 and pending[1]:
+            del self._pending_files[file_path]
+
+            with TRACER.start_as_current_span("ingest.checkpoint"):
+                self.checkpoint.mark_done(file_path)
+
+    def _iter_batches(self, path: str) -> Iterator[List[Tuple[str, Chunk]]]:
+        batch = []
+        for item in self.iter_chunks(path):
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @TRACER.start_as_current_span("ingest.dedup")
+    def _skip_existing(self, batch):
+        """
+        remove from the batch the chunks already in the collection
+        """
+        ids = [chunk[0] for _, chunk in batch]
+        existing = self.sink.existing_ids(ids)
+
+        trace.get_current_span().set_attribute("ingest_existing", len(existing))
+
+        return [item for item in batch if item[1][0] not in existing], len(existing)
+
+    def _embed(self, texts: List[str], parent_context):
+        """
+        in a worker: the embeddings of a batch (in the trace of the run)
+        """
+        with TRACER.start_as_current_span("ingest.embed", context=parent_context):
+            trace.get_current_span().set_attribute("ingest_batch_size", len(texts))
+
+            return self.embed_model.embed_documents(texts)
+
+    @TRACER.start_as_current_span("ingest.insert")
+    def _insert(self, batch, embeddings):
+        trace.get_current_span().set_attribute("ingest_rows", len(batch))
+
+        self.sink.insert([chunk for _, chunk in batch], embeddings)
+
+    def _done(self, batch, n_inserted_files: Dict[str, int]):
+        for file_path, n_chunks in n_inserted_files.items():
+            self._complete(file_path, n_chunks)
+
+        self.stats["chunks_inserted"] += len(batch)
+
+    @staticmethod
+    def _count_by_file(batch) -> Dict[str, int]:
+        counts = {}
+        for file_path, _ in batch:
+            counts[file_path] = counts.get(file_path, 0) + 1
+        return counts
+
+    def run(self, path: str) -> Dict:
+        """
+        load all the files under path, return the stats
+        """
+        time_start = time.perf_counter()
+
+        with TRACER.start_as_current_span("ingest.run") as span, ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="ingest"
+        ) as executor:
+            parent_context = otel_context.get_current()
+            # batches being embedded, inserted in order (bounded, backpressure)
+            in_flight = deque()
+
+            for batch in self._iter_batches(path):
+                self.stats["chunks"] += len(batch)
+                counts = self._count_by_file(batch)
+
+                batch, n_existing = self._skip_existing(batch)
+                self.stats["chunks_skipped"] += n_existing
+
+                if n_existing:
+                    # skipped chunks count as done for the checkpoint
+                    kept = self._count_by_file(batch)
+                    for file_path, n_chunks in counts.items():
+                        self._complete(file_path, n_chunks - kept.get(file_path, 0))
+                    counts = kept
+
+                if not batch:
+                    continue
+
+                future = executor.submit(
+                    self._embed, [chunk[1] for _, chunk in batch], parent_context
+                )
+                in_flight.append((batch, counts, future))
+
+                while len(in_flight) > self.workers:
+                    done_batch, done_counts, done_future = in_flight.popleft()
+                    self._insert(done_batch, done_future.result())
+                    self._done(done_batch, done_counts)
+
+            while in_flight:
+                done_batch, done_counts, done_future = in_flight.popleft()
+                self._insert(done_batch, done_future.result())
+                self._done(done_batch, done_counts)
+
+            self.stats["elapsed_sec"] = round(time.perf_counter() - time_start, 2)
+            for key, value in self.stats.items():
+                span.set_attribute(f"ingest_{key}", value)
+
+        return self.stats
+
+
+def get_sink(sink_type: str, embed_dim: int) -> IngestionSink:
+    """
+    the sink, as requested: oracle (the collection), sqlite, memory
+    """
+    table_name = config.get("vector_store.collection_name")
+
+    if sink_type == "oracle":
+        # pylint: disable=import-outside-toplevel
+        from factory_vector_store import get_db_connection
+
+        return OracleSink(get_db_connection(), table_name, embed_dim)
+    if sink_type == "sqlite":
+        return SQLiteSink(config.get("ingestion.ingest_sqlite_path"), table_name)
+    return MemorySink()
+
+
+def main():
+    """
+    load the documents in the collection
+    """
+    parser = argparse.ArgumentParser(description="load documents in the collection")
+    parser.add_argument("--path", required=True, help="file or directory")
+    parser.add_argument(
+        "--sink", choices=("oracle", "sqlite", "memory"), default="oracle"
+    )
+    parser.add_argument(
+        "--fake", action="store_true", help="local fake embeddings, no OCI calls"
+    )
+    args = parser.parse_args()
+
+    # pylint: disable=import-outside-toplevel
+    if args.fake:
+        from fake_backends import FakeOCIGenAIEmbeddings4APM
+        from factory import get_embed_batcher
+
+        embed_model = FakeOCIGenAIEmbeddings4APM(
+            client=object(), model_id="fake.embed", embed_batcher=get_embed_batcher()
+        )
+    else:
+        from factory import get_embed_model
+
+        embed_model = get_embed_model()
+
+    embed_dim = len(embed_model.embed_query("dimension"))
+    sink = get_sink(args.sink, embed_dim)
+
+    pipeline = IngestionPipeline(
+        embed_model,
+        sink,
+        Checkpoint(config.get("ingestion.ingest_checkpoint_file")),
+        chunk_size=config.get("ingestion.ingest_chunk_size"),
+        chunk_overlap=config.get("ingestion.ingest_chunk_overlap"),
+        batch_size=config.get("ingestion.ingest_batch_size"),
+        workers=config.get("ingestion.ingest_workers"),
+    )
+
+    try:
+        print(pipeline.run(args.path))
+    finally:
+        sink.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,642 @@
+"""
+LLM Router
+
+    a chat model in front of an ordered list of LLMs (ChatOCIGenAI4APM),
+    to keep answering when a model is slow, throttled or down:
+    * a deadline for the whole call, a timeout for every attempt
+    * retries with exponential backoff and jitter (only for errors
+      that can be retried: timeouts, throttling, 5xx)
+    * hedged requests: if the answer doesn't arrive within the p95 latency
+      of the model, the request is sent also to the next model in the list,
+      the first answer wins
+    * a circuit breaker per model: after repeated failures the model
+      is skipped for a while
+    * fallback: the next model in the list, when a model fails
+
+    Every attempt has its own span, child of LLMRouter.invoke (or .stream)
+    Streams are retried (and fall back) only before the first token.
+    An attempt timed out counts once as a failure of the model, whatever
+    its (late) outcome.
+
+    See bench_llm_router.py for the checks of the behaviour (fake models).
+"""
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+from opentelemetry import trace
+from opentelemetry.trace import Status, StatusCode
+from pydantic import PrivateAttr
+
+from tracer_singleton import TracerSingleton
+
+TRACER = TracerSingleton.get_instance()
+
+# sync calls: attempts run here (the context is copied, for the spans)
+_EXECUTOR = ContextThreadPoolExecutor(max_workers=32, thread_name_prefix="llm")
+
+
+class NoModelAvailableError(Exception):
+    """
+    all the models are failing (circuits open)
+    """
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    true for errors that can go away by retrying:
+    timeouts, connection errors, throttling (429) and server errors (5xx)
+    """
+    # as in oci.exceptions.ServiceError
+    status = getattr(error, "status", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+
+    return isinstance(error, (TimeoutError, ConnectionError))
+
+
+def backoff_sec(retry: int, base_ms: float, max_ms: float) -> float:
+    """
+    exponential backoff with full jitter, before the retry n. retry (1, 2, ...)
+    """
+    return random.uniform(0.0, min(max_ms, base_ms * 2 ** (retry - 1))) / 1000.0
+
+
+class CircuitBreaker:
+    """
+    closed: calls allowed; open (after failure_threshold consecutive
+    failures): no calls for open_sec; then half open: one call allowed,
+    if it succeeds the circuit closes
+    """
+
+    def __init__(self, failure_threshold: int = 5, open_sec: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.open_sec = open_sec
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        """
+        closed, open or half_open
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.open_sec:
+                return "open"
+            return "half_open"
+
+    def allow(self) -> bool:
+        """
+        true if a call can be made now (in half open, only one at a time)
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.open_sec or self._probing:
+                return False
+
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class LatencyWindow:
+    """
+    the latencies of the last calls to a model, for the p95
+    """
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=size)
+
+    def add(self, latency_ms: float):
+        self._latencies.append(latency_ms)
+
+    def p95(self) -> Optional[float]:
+        """
+        None until min_samples latencies are known
+        """
+        latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+
+@dataclass
+class _Attempt:
+    model: Any
+    number: int
+    retry: int
+    hedged: bool
+    time_start: float = 0.0
+    # abandoned after attempt_timeout_sec (already counted as a failure)
+    timed_out: bool = False
+
+
+class _RoutedCall:
+    """
+    the state of a call through the router: decides the next attempt
+    """
+
+    def __init__(self, router: "LLMRouter"):
+        self.router = router
+        self.deadline = time.monotonic() + router.deadline_sec
+        # position, in the list, of the last model tried
+        self.index = -1
+        self.n_attempts = 0
+        self.hedged = False
+        # no more hedging: done, or no model to send it to
+        self._hedge_done = False
+        self.errors: List[BaseException] = []
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def _attempt(self, index: int, retry: int, hedged: bool) -> _Attempt:
+        self.index = max(self.index, index)
+        self.n_attempts += 1
+        return _Attempt(
+            self.router.models[index],
+            self.n_attempts,
+            retry,
+            hedged,
+            time.monotonic(),
+        )
+
+    def _next_model(self, running: List[_Attempt]) -> Optional[int]:
+        """
+        the position of the next model in the list that can be called
+        """
+        running_models = [attempt.model for attempt in running]
+
+        for index in range(self.index + 1, len(self.router.models)):
+            model = self.router.models[index]
+            if model not in running_models and self.router.breaker(model).allow():
+                return index
+        return None
+
+    def first(self) -> _Attempt:
+        """
+        the first attempt: the first model with the circuit closed
+        """
+        index = self._next_model([])
+        if index is None:
+            raise NoModelAvailableError("all the models have the circuit open")
+        return self._attempt(index, 0, False)
+
+    def wait_timeout(self, running: List[_Attempt]) -> float:
+        """
+        how long to wait for the attempts running: until the deadline,
+        the first attempt timeout or the time to send a hedged request
+        """
+        now = time.monotonic()
+        timeouts = [self.deadline - now] + [
+            attempt.time_start + self.router.attempt_timeout_sec - now
+            for attempt in running
+        ]
+        if self.can_hedge(running):
+            timeouts.append(
+                running[0].time_start + self.hedge_delay_sec(running[0]) - now
+            )
+
+        return max(0.0, min(timeouts))
+
+    def can_hedge(self, running: List[_Attempt]) -> bool:
+        return self.router.hedge_enable and not self._hedge_done and len(running) == 1
+
+    def hedge_delay_sec(self, attempt: _Attempt) -> float:
+        """
+        the p95 latency of the model of the attempt (hedge_after_ms
+        until it is known)
+        """
+        p95 = self.router.latencies(attempt.model).p95()
+        return (p95 if p95 is not None else self.router.hedge_after_ms) / 1000.0
+
+    def timed_out(self, running: List[_Attempt]) -> List[_Attempt]:
+        """
+        the attempts running for more than attempt_timeout_sec
+        """
+        now = time.monotonic()
+        return [
+            attempt
+            for attempt in running
+            if now - attempt.time_start >= self.router.attempt_timeout_sec
+        ]
+
+    def hedge(self, running: List[_Attempt]) -> Optional[_Attempt]:
+        """
+        the hedged attempt, if it's time and a model is available
+        """
+        if not self.can_hedge(running):
+            return None
+        if time.monotonic() - running[0].time_start < self.hedge_delay_sec(running[0]):
+            return None
+
+        self._hedge_done = True
+        index = self._next_model(running)
+        if index is None:
+            return None
+
+        self.hedged = True
+        return self._attempt(index, 0, True)
+
+    def after_failure(self, failed: _Attempt, error: BaseException):
+        """
+        after an attempt failed (no other attempt running):
+        the delay (backoff) and the next attempt, a retry or the next model
+
+        raises the error if nothing else can be tried
+        """
+        self.errors.append(error)
+
+        if self.remaining() <= 0:
+            raise error
+
+        if (
+            is_retryable(error)
+            and failed.retry < self.router.max_retries
+            and self.router.breaker(failed.model).allow()
+        ):
+            retry = failed.retry + 1
+            delay = backoff_sec(
+                retry, self.router.backoff_base_ms, self.router.backoff_max_ms
+            )
+            index = self.router.models.index(failed.model)
+            return min(delay, self.remaining()), self._attempt(index, retry, False)
+
+        index = self._next_model([])
+        if index is None:
+            raise error
+        return 0.0, self._attempt(index, 0, False)
+
+    def deadline_error(self) -> TimeoutError:
+        return TimeoutError(
+            f"LLM call not completed in {self.router.deadline_sec} sec., "
+            f"{self.n_attempts} attempts"
+        )
+
+
+class LLMRouter(BaseChatModel):
+    """
+    Chat model routing every call to a list of models,
+    with timeouts, retries, hedging, circuit breakers and fallback
+
+    models: the models, in order of preference (ChatOCIGenAI4APM)
+    """
+
+    models: List[Any]
+    # for the whole call, retries and fallback included
+    deadline_sec: float = 60.0
+    attempt_timeout_sec: float = 30.0
+    # retries of a model, before the next one
+    max_retries: int = 2
+    backoff_base_ms: float = 200.0
+    backoff_max_ms: float = 5000.0
+    hedge_enable: bool = True
+    # hedge delay, until the p95 of the model is known
+    hedge_after_ms: float = 5000.0
+    breaker_failures: int = 5
+    breaker_open_sec: float = 30.0
+
+    _breakers: Dict[str, CircuitBreaker] = PrivateAttr(default_factory=dict)
+    _latencies: Dict[str, LatencyWindow] = PrivateAttr(default_factory=dict)
+
+    def model_post_init(self, __context: Any):
+        super().model_post_init(__context)
+        for model in self.models:
+            self._breakers[model.model_id] = CircuitBreaker(
+                self.breaker_failures, self.breaker_open_sec
+            )
+            self._latencies[model.model_id] = LatencyWindow()
+
+    @property
+    def _llm_type(self) -> str:
+        return "llm_router"
+
+    @property
+    def model_id(self) -> str:
+        """
+        the preferred model
+        """
+        return self.models[0].model_id
+
+    def breaker(self, model) -> CircuitBreaker:
+        """
+        the circuit breaker of a model
+        """
+        return self._breakers[model.model_id]
+
+    def latencies(self, model) -> LatencyWindow:
+        """
+        the latencies of a model
+        """
+        return self._latencies[model.model_id]
+
+    #
+    # attempts
+    #
+    def _start_attempt_span(self, attempt: _Attempt):
+        span = TRACER.start_span("LLMRouter.attempt")
+        span.set_attribute("llm_model", attempt.model.model_id)
+        span.set_attribute("llm_router_attempt", attempt.number)
+        span.set_attribute("llm_router_retry", attempt.retry)
+        span.set_attribute("llm_router_hedged", attempt.hedged)
+        span.set_attribute("llm_router_breaker", self.breaker(attempt.model).state)
+        return span
+
+    def _end_attempt(self, span, attempt: _Attempt, error: BaseException = None):
+        """
+        record the result of an attempt (in breaker, latencies and span)
+        """
+        if attempt.timed_out:
+            # the outcome arrived too late: counted when it timed out
+            span.set_attribute("llm_router_outcome", "timed_out")
+        elif error is None:
+            latency_ms = (time.monotonic() - attempt.time_start) * 1000.0
+            self.breaker(attempt.model).record_success()
+            self.latencies(attempt.model).add(latency_ms)
+            span.set_attribute("llm_router_outcome", "ok")
+        elif isinstance(error, asyncio.CancelledError):
+            # lost the race with a hedged attempt
+            span.set_attribute("llm_router_outcome", "cancelled")
+        else:
+            self.breaker(attempt.model).record_failure()
+            span.set_attribute("llm_router_outcome", type(error).__name__)
+            span.record_exception(error)
+            span.set_status(Status(StatusCode.ERROR))
+        span.end()
+
+    def _time_out(self, attempt: _Attempt) -> TimeoutError:
+        """
+        abandon an attempt running for more than attempt_timeout_sec
+        """
+        attempt.timed_out = True
+        self.breaker(attempt.model).record_failure()
+        return TimeoutError(f"{attempt.model.model_id} timed out")
+
+    def _run_attempt(self, attempt: _Attempt, messages, stop, kwargs) -> BaseMessage:
+        span = self._start_attempt_span(attempt)
+
+        with trace.use_span(span, end_on_exit=False):
+            try:
+                output = attempt.model.invoke(messages, stop=stop, **kwargs)
+            except Exception as e:
+                self._end_attempt(span, attempt, e)
+                raise
+
+        self._end_attempt(span, attempt)
+        return output
+
+    async def _arun_attempt(
+        self, attempt: _Attempt, messages, stop, kwargs
+    ) -> BaseMessage:
+        span = self._start_attempt_span(attempt)
+
+        with trace.use_span(span, end_on_exit=False):
+            try:
+                output = await attempt.model.ainvoke(messages, stop=stop, **kwargs)
+            except BaseException as e:
+                self._end_attempt(span, attempt, e)
+                raise
+
+        self._end_attempt(span, attempt)
+        return output
+
+    @staticmethod
+    def _set_call_attributes(call: _RoutedCall, winner: _Attempt):
+        current_span = trace.get_current_span()
+        current_span.set_attribute("llm_router_attempts", call.n_attempts)
+        current_span.set_attribute("llm_router_errors", len(call.errors))
+        current_span.set_attribute("llm_router_hedged", call.hedged)
+        current_span.set_attribute("llm_model", winner.model.model_id)
+        current_span.set_attribute(
+            "llm_router_fallback", winner.model is not call.router.models[0]
+        )
+
+    @staticmethod
+    def _result(message: BaseMessage) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    #
+    # invoke
+    #
+    @TRACER.start_as_current_span("LLMRouter.invoke")
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        call = _RoutedCall(self)
+        running: Dict[Any, _Attempt] = {}
+
+        def _submit(attempt: _Attempt):
+            future = _EXECUTOR.submit(
+                self._run_attempt, attempt, messages, stop, kwargs
+            )
+            running[future] = attempt
+
+        _submit(call.first())
+
+        while True:
+            done, _ = wait(
+                list(running),
+                timeout=call.wait_timeout(list(running.values())),
+                return_when=FIRST_COMPLETED,
+            )
+
+            failed = None
+            for future in done:
+                attempt = running.pop(future)
+                try:
+                    output = future.result()
+                except Exception as e:
+                    failed = (attempt, e)
+                    continue
+                # the others are abandoned (a thread can't be interrupted)
+                self._set_call_attributes(call, attempt)
+                return self._result(output)
+
+            for attempt in call.timed_out(list(running.values())):
+                # abandoned, counted as a failure
+                running.pop(next(f for f, a in running.items() if a is attempt))
+                failed = (attempt, self._time_out(attempt))
+
+            if call.remaining() <= 0:
+                raise call.deadline_error()
+
+            hedge = call.hedge(list(running.values()))
+            if hedge is not None:
+                _submit(hedge)
+
+            if failed is not None and not running:
+                delay, attempt = call.after_failure(*failed)
+                time.sleep(delay)
+                _submit(attempt)
+
+    @TRACER.start_as_current_span("LLMRouter.invoke")
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        call = _RoutedCall(self)
+        running: Dict[asyncio.Task, _Attempt] = {}
+
+        def _submit(attempt: _Attempt):
+            task = asyncio.create_task(
+                self._arun_attempt(attempt, messages, stop, kwargs)
+            )
+            running[task] = attempt
+
+        _submit(call.first())
+
+        try:
+            while True:
+                done, _ = await asyncio.wait(
+                    list(running),
+                    timeout=call.wait_timeout(list(running.values())),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+
+                failed = None
+                for task in done:
+                    attempt = running.pop(task)
+                    if task.exception() is not None:
+                        failed = (attempt, task.exception())
+                        continue
+                    self._set_call_attributes(call, attempt)
+                    return self._result(task.result())
+
+                for attempt in call.timed_out(list(running.values())):
+                    task = next(t for t, a in running.items() if a is attempt)
+                    running.pop(task)
+                    failed = (attempt, self._time_out(attempt))
+                    task.cancel()
+
+                if call.remaining() <= 0:
+                    raise call.deadline_error()
+
+                hedge = call.hedge(list(running.values()))
+                if hedge is not None:
+                    _submit(hedge)
+
+                if failed is not None and not running:
+                    delay, attempt = call.after_failure(*failed)
+                    await asyncio.sleep(delay)
+                    _submit(attempt)
+        finally:
+            # the attempts still running lost the race (or the deadline passed)
+            for task in running:
+                task.cancel()
+
+    #
+    # stream: retries and fallback only until the first token
+    #
+    def _first_chunk(self, call: _RoutedCall, messages, stop, kwargs):
+        """
+        the attempt that gave the first token, the token, the rest of the stream
+
+        the first token is awaited in a thread, for at most attempt_timeout_sec
+        """
+        attempt = call.first()
+
+        while True:
+            span = self._start_attempt_span(attempt)
+            try:
+                with trace.use_span(span, end_on_exit=False):
+                    generator = attempt.model.stream(messages, stop=stop, **kwargs)
+                    future = _EXECUTOR.submit(next, generator)
+
+                done, _ = wait(
+                    [future], timeout=min(self.attempt_timeout_sec, call.remaining())
+                )
+                if not done:
+                    # the stream is abandoned (a thread can't be interrupted)
+                    raise TimeoutError(f"{attempt.model.model_id} timed out")
+                first = future.result()
+            except Exception as e:
+                self._end_attempt(span, attempt, e)
+                delay, attempt = call.after_failure(attempt, e)
+                time.sleep(delay)
+                continue
+
+            # the attempt span ends at the first token
+            self._end_attempt(span, attempt)
+            return attempt, first, generator
+
+    async def _afirst_chunk(self, call: _RoutedCall, messages, stop, kwargs):
+        """
+        async version of _first_chunk, with the attempt timeout
+        """
+        attempt = call.first()
+
+        while True:
+            span = self._start_attempt_span(attempt)
+            try:
+                with trace.use_span(span, end_on_exit=False):
+                    generator = attempt.model.astream(messages, stop=stop, **kwargs)
+                    first = await asyncio.wait_for(
+                        generator.__anext__(),
+                        timeout=min(self.attempt_timeout_sec, call.remaining()),
+                    )
+            except Exception as e:
+                self._end_attempt(span, attempt, e)
+                delay, attempt = call.after_failure(attempt, e)
+                await asyncio.sleep(delay)
+                continue
+
+            self._end_attempt(span, attempt)
+            return attempt, first, generator
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        span = TRACER.start_span("LLMRouter.stream")
+        call = _RoutedCall(self)
+
+        try:
+            with trace.use_span(span, end_on_exit=False):
+                attempt, first, generator = self._first_chunk(
+                    call, messages, stop, kwargs
+                )
+                self._set_call_attributes(call, attempt)
+
+            yield ChatGenerationChunk(message=first)
+            for chunk in generator:
+                yield ChatGenerationChunk(message=chunk)
+        finally:
+            span.end()
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        span = TRACER.start_span("LLMRouter.stream")
+        call = _RoutedCall(self)
+
+        try:
+            with trace.use_span(span, end_on_exit=False):
+                attempt, first, generator = await self._afirst_chunk(
+                    call, messages, stop, kwargs
+                )
+                self._set_call_attributes(call, attempt)
+
+            yield ChatGenerationChunk(message=first)
+            async for chunk in generator:
+                yield ChatGenerationChunk(message=chunk)
+        finally:
+            span.end()
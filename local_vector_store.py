@@ -0,0 +1,756 @@
+"""
+Local Vector Store
+
+    an alternative to OracleVS4APM for collections that fit in RAM:
+    the embeddings of the collection are copied in a local float32 matrix
+    (a memory-mapped file, normalized rows) and the top-k is computed
+    in process, with NumPy, without a round trip to the DB.
+
+    * exact search: cosine similarity with all the rows (a matrix product)
+    * IVF index (optional, for larger collections): rows clustered with
+      k-means, only the n_probes nearest clusters are scanned; below
+      ivf_min_rows the search is exact (fast enough, and the recall of
+      IVF on small collections is low)
+    * incremental refresh: only the rows added/removed in the DB
+      are fetched/deleted (the DB remains the source of truth)
+
+    The spans and metrics are the same as in OracleVS4APM.
+"""
+
+import copy
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents.base import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from opentelemetry import trace
+
+from config_schema import LOCAL_VS_INDEX_TYPES
+from instrumentation import traced
+from tracer_singleton import TracerSingleton
+from app_metrics import VECTOR_SEARCH_LATENCY, timed
+from utils import get_console_logger
+
+TRACER = TracerSingleton.get_instance()
+
+logger = get_console_logger()
+
+# a row of the collection: (id, text, metadata, embedding)
+Row = Tuple[str, str, Dict, Any]
+
+# rows scored together, to bound the memory of the temporaries
+SCORE_CHUNK_ROWS = 65536
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    rows with norm 1 (cosine similarity becomes a dot product)
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    positions of the k highest scores, in descending order
+    """
+    if k >= len(scores):
+        return np.argsort(-scores)
+
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+#
+# sources: where the rows of the collection are read
+#
+class OracleSource:
+    """
+    the table of the collection in Oracle DB (as written by OracleVS)
+
+    get_connection/release_connection: to use a pool or a single connection
+    """
+
+    def __init__(self, table_name: str, get_connection, release_connection=None):
+        self.table_name = table_name
+        self._get_connection = get_connection
+        self._release_connection = release_connection
+
+    def _query(self, sql: str, params=None) -> List:
+        connection = self._get_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params or [])
+                return cursor.fetchall()
+        finally:
+            if self._release_connection is not None:
+                self._release_connection(connection)
+
+    def ids(self) -> List[str]:
+        """
+        the ids of all the rows
+        """
+        rows = self._query(f"SELECT RAWTOHEX(id) FROM {self.table_name}")
+        return [row[0] for row in rows]
+
+    def rows(self, ids: List[str]) -> Iterable[Row]:
+        """
+        the rows with the given ids (max 1000 values in a IN list)
+        """
+        for i in range(0, len(ids), 1000):
+            batch = ids[i : i + 1000]
+            placeholders = ", ".join(f"HEXTORAW(:{n + 1})" for n in range(len(batch)))
+
+            for id_, text, metadata, embedding in self._query(
+                f"SELECT RAWTOHEX(id), text, metadata, embedding "
+                f"FROM {self.table_name} WHERE id IN ({placeholders})",
+                batch,
+            ):
+                if hasattr(text, "read"):
+                    # CLOB
+                    text = text.read()
+                if isinstance(metadata, str):
+                    metadata = json.loads(metadata)
+                yield id_, text, metadata, embedding
+
+
+class SQLiteSource:
+    """
+    a table written by ingestion.SQLiteSink (for local tests)
+    """
+
+    def __init__(self, db_path: str, table_name: str):
+        # pylint: disable=import-outside-toplevel
+        import sqlite3
+
+        self.table_name = table_name
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+
+    def ids(self) -> List[str]:
+        """
+        the ids of all the rows
+        """
+        rows = self._conn.execute(f"SELECT id FROM {self.table_name}")
+        return [row[0] for row in rows]
+
+    def rows(self, ids: List[str]) -> Iterable[Row]:
+        """
+        the rows with the given ids
+        """
+        for i in range(0, len(ids), 900):
+            batch = ids[i : i + 900]
+            placeholders = ", ".join("?" for _ in batch)
+
+            for id_, text, metadata, embedding in self._conn.execute(
+                f"SELECT id, text, metadata, embedding FROM {self.table_name} "
+                f"WHERE id IN ({placeholders})",
+                batch,
+            ):
+                yield id_, text, json.loads(metadata), np.frombuffer(
+                    embedding, dtype=np.float32
+                )
+
+
+#
+# index
+#
+class IVFIndex:
+    """
+    Inverted file index: rows grouped by nearest centroid (spherical k-means)
+
+    a query scans only the rows of the n_probes nearest centroids
+    """
+
+    def __init__(self, matrix: np.ndarray, n_lists: int, n_iter: int = 10):
+        n_rows = len(matrix)
+        self.n_lists = max(1, min(n_lists, n_rows))
+        self.n_rows_built = n_rows
+
+        rng = np.random.default_rng(0)
+        sample_size = min(n_rows, 256 * self.n_lists)
+        sample = np.asarray(matrix[rng.choice(n_rows, sample_size, replace=False)])
+
+        centroids = sample[rng.choice(sample_size, self.n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            counts = np.bincount(assignments, minlength=self.n_lists)
+            # sum of the rows of every cluster (rows sorted by cluster)
+            sorted_sample = sample[np.argsort(assignments, kind="stable")]
+            bounds = np.concatenate([[0], np.cumsum(counts)])
+            sums = np.stack(
+                [
+                    sorted_sample[bounds[i] : bounds[i + 1]].sum(axis=0)
+                    for i in range(self.n_lists)
+                ]
+            )
+            # empty clusters keep their centroid
+            centroids = np.where(counts[:, None] > 0, normalize(sums), centroids)
+
+        self.centroids = centroids
+        self.lists: List[np.ndarray] = [
+            np.empty(0, dtype=np.int64) for _ in range(self.n_lists)
+        ]
+        self.add(matrix, 0)
+
+    def add(self, matrix: np.ndarray, start_row: int):
+        """
+        assign the rows from start_row to the nearest centroid
+        """
+        new_lists = [[] for _ in range(self.n_lists)]
+
+        for start in range(start_row, len(matrix), SCORE_CHUNK_ROWS):
+            chunk = np.asarray(matrix[start : start + SCORE_CHUNK_ROWS])
+            assignments = np.argmax(chunk @ self.centroids.T, axis=1)
+            order = np.argsort(assignments, kind="stable")
+            bounds = np.searchsorted(assignments[order], np.arange(self.n_lists + 1))
+            for i in range(self.n_lists):
+                rows = order[bounds[i] : bounds[i + 1]]
+                if len(rows):
+                    new_lists[i].append(rows + start)
+
+        self.lists = [
+            np.concatenate([self.lists[i], *new_lists[i]]) if new_lists[i] else rows
+            for i, rows in enumerate(self.lists)
+        ]
+
+    def candidates(self, query: np.ndarray, n_probes: int) -> np.ndarray:
+        """
+        the rows in the n_probes lists nearest to the query
+        """
+        probes = top_k_rows(self.centroids @ query, min(n_probes, self.n_lists))
+        return np.concatenate([self.lists[i] for i in probes])
+
+
+@dataclass(frozen=True)
+class _Snapshot:
+    """
+    the content of the index at a given time (replaced, never modified,
+    so searches don't need locks)
+    """
+
+    matrix: np.ndarray
+    ids: List[str]
+    texts: List[str]
+    metadatas: List[Dict]
+    ivf: Optional[IVFIndex]
+
+
+class LocalVectorIndex:
+    """
+    The rows of a collection in local files, searched in memory
+
+    files in index_dir:
+        {name}.f32    the normalized embeddings (memory-mapped)
+        {name}.jsonl  id, text and metadata of every row
+        {name}.json   the manifest (num. of rows, dim, sizes), written last
+    """
+
+    def __init__(
+        self,
+        index_dir: str,
+        name: str,
+        index_type: str = "exact",
+        ivf_lists: int = 0,
+        ivf_probes: int = 32,
+        ivf_min_rows: int = 50000,
+    ):
+        """
+        ivf_lists: num. of clusters of the IVF index (0: sqrt of num. of rows)
+        ivf_min_rows: with fewer rows, no IVF index (exact search)
+        """
+        if index_type not in LOCAL_VS_INDEX_TYPES:
+            raise ValueError(f"index_type must be one of {LOCAL_VS_INDEX_TYPES}")
+
+        self.index_type = index_type
+        self.ivf_lists = ivf_lists
+        self.ivf_probes = ivf_probes
+        self.ivf_min_rows = ivf_min_rows
+
+        os.makedirs(index_dir, exist_ok=True)
+        self._matrix_path = os.path.join(index_dir, f"{name}.f32")
+        self._docs_path = os.path.join(index_dir, f"{name}.jsonl")
+        self._manifest_path = os.path.join(index_dir, f"{name}.json")
+
+        # only one refresh at a time
+        self._refresh_lock = threading.Lock()
+        self._manifest = {"n_rows": 0, "dim": 0, "docs_bytes": 0}
+        self._snapshot = _Snapshot(np.empty((0, 0), np.float32), [], [], [], None)
+        self.version = 0
+
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._snapshot.ids)
+
+    #
+    # files
+    #
+    def _load(self):
+        if not os.path.exists(self._manifest_path):
+            return
+
+        with open(self._manifest_path, "r", encoding="utf-8") as f:
+            self._manifest = json.load(f)
+
+        ids, texts, metadatas = [], [], []
+        with open(self._docs_path, "rb") as f:
+            # what's after docs_bytes was written by an interrupted refresh
+            for line in f.read(self._manifest["docs_bytes"]).splitlines():
+                doc = json.loads(line)
+                ids.append(doc["id"])
+                texts.append(doc["text"])
+                metadatas.append(doc["metadata"])
+
+        self._set_snapshot(self._open_matrix(), ids, texts, metadatas)
+
+    def _open_matrix(self) -> np.ndarray:
+        n_rows, dim = self._manifest["n_rows"], self._manifest["dim"]
+
+        if n_rows == 0:
+            return np.empty((0, dim), np.float32)
+        return np.memmap(self._matrix_path, np.float32, "r", shape=(n_rows, dim))
+
+    def _write_manifest(self):
+        tmp_path = f"{self._manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp_path, self._manifest_path)
+
+    def _append(self, rows: List[Row]):
+        """
+        add rows at the end of the files, then update the manifest
+        """
+        vectors = normalize(np.stack([np.asarray(row[3]) for row in rows]))
+        docs = b"".join(
+            json.dumps({"id": id_, "text": text, "metadata": metadata}).encode("utf-8")
+            + b"\n"
+            for id_, text, metadata, _ in rows
+        )
+        n_rows = self._manifest["n_rows"]
+
+        for path, offset, data in (
+            (self._matrix_path, n_rows * vectors.shape[1] * 4, vectors.tobytes()),
+            (self._docs_path, self._manifest["docs_bytes"], docs),
+        ):
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                f.seek(offset)
+                f.write(data)
+                f.truncate()
+
+        self._manifest = {
+            "n_rows": n_rows + len(rows),
+            "dim": vectors.shape[1],
+            "docs_bytes": self._manifest["docs_bytes"] + len(docs),
+        }
+        self._write_manifest()
+
+    def _rewrite(self, keep: np.ndarray):
+        """
+        rewrite the files with only the rows in keep (after deletes)
+        """
+        snapshot = self._snapshot
+        self._manifest = {"n_rows": 0, "dim": 0, "docs_bytes": 0}
+
+        for path in (self._matrix_path, self._docs_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+        if len(keep):
+            self._append(
+                [
+                    (
+                        snapshot.ids[i],
+                        snapshot.texts[i],
+                        snapshot.metadatas[i],
+                        snapshot.matrix[i],
+                    )
+                    for i in keep
+                ]
+            )
+        else:
+            self._write_manifest()
+
+    def _set_snapshot(self, matrix, ids, texts, metadatas, rebuild_ivf=True):
+        ivf = None
+
+        if self.index_type == "ivf" and len(ids) >= max(self.ivf_min_rows, 1):
+            ivf = self._snapshot.ivf
+            if rebuild_ivf or ivf is None or len(ids) > 2 * ivf.n_rows_built:
+                n_lists = self.ivf_lists or int(np.sqrt(len(ids)))
+                ivf = IVFIndex(matrix, n_lists)
+            else:
+                # the new rows in the existing clusters
+                # (in a copy: the current snapshot may be in use)
+                ivf = copy.copy(ivf)
+                ivf.add(matrix, len(self._snapshot.ids))
+
+        self._snapshot = _Snapshot(matrix, ids, texts, metadatas, ivf)
+        self.version += 1
+
+    #
+    # refresh
+    #
+    @TRACER.start_as_current_span("LocalVS.refresh")
+    def refresh(self, source) -> Dict:
+        """
+        align the index with the source: fetch only new rows, drop deleted ones
+
+        source: an object with ids() and rows(ids) (OracleSource, SQLiteSource)
+        """
+        with self._refresh_lock:
+            time_start = time.perf_counter()
+            snapshot = self._snapshot
+
+            source_ids = source.ids()
+            source_set = set(source_ids)
+            local_set = set(snapshot.ids)
+
+            added = [id_ for id_ in source_ids if id_ not in local_set]
+            removed = local_set - source_set
+
+            if removed:
+                keep = np.array(
+                    [i for i, id_ in enumerate(snapshot.ids) if id_ not in removed],
+                    dtype=np.int64,
+                )
+                self._rewrite(keep)
+
+            if added:
+                rows = list(source.rows(added))
+                if rows:
+                    self._append(rows)
+
+            if removed or added:
+                ids, texts, metadatas = (
+                    list(snapshot.ids),
+                    list(snapshot.texts),
+                    list(snapshot.metadatas),
+                )
+                if removed:
+                    ids, texts, metadatas = [
+                        [values[i] for i in keep] for values in (ids, texts, metadatas)
+                    ]
+                for id_, text, metadata, _ in rows if added else []:
+                    ids.append(id_)
+                    texts.append(text)
+                    metadatas.append(metadata)
+
+                self._set_snapshot(
+                    self._open_matrix(),
+                    ids,
+                    texts,
+                    metadatas,
+                    rebuild_ivf=bool(removed),
+                )
+
+            stats = {
+                "added": len(added),
+                "removed": len(removed),
+                "rows": len(self),
+                "refresh_ms": round((time.perf_counter() - time_start) * 1000.0, 1),
+            }
+            current_span = trace.get_current_span()
+            for key, value in stats.items():
+                current_span.set_attribute(f"local_vs_{key}", value)
+
+            return stats
+
+    #
+    # search
+    #
+    def search(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Dict[str, Any] | None = None,
+        exact: bool = False,
+    ) -> List[Tuple[int, float]]:
+        """
+        the k rows most similar to embedding: (row, cosine similarity)
+
+        filter: metadata values the rows must have (equality)
+        exact: scan all the rows, even with the IVF index
+        """
+        # pylint: disable=redefined-builtin
+        snapshot = self._snapshot
+        if not snapshot.ids:
+            return []
+
+        query = normalize(embedding)
+
+        if snapshot.ivf is not None and not exact:
+            rows = snapshot.ivf.candidates(query, self.ivf_probes)
+            rows.sort()
+            scores = np.asarray(snapshot.matrix[rows]) @ query
+        else:
+            rows = None
+            scores = np.concatenate(
+                [
+                    np.asarray(snapshot.matrix[start : start + SCORE_CHUNK_ROWS])
+                    @ query
+                    for start in range(0, len(snapshot.ids), SCORE_CHUNK_ROWS)
+                ]
+            )
+
+        trace.get_current_span().set_attribute("local_vs_candidates", len(scores))
+
+        if filter:
+            positions = rows if rows is not None else range(len(scores))
+            mask = np.fromiter(
+                (
+                    all(
+                        snapshot.metadatas[i].get(key) == value
+                        for key, value in filter.items()
+                    )
+                    for i in positions
+                ),
+                dtype=bool,
+                count=len(scores),
+            )
+            scores = np.where(mask, scores, -np.inf)
+
+        top = top_k_rows(scores, k)
+        top = top[np.isfinite(scores[top])]
+
+        if rows is not None:
+            return [(int(rows[i]), float(scores[i])) for i in top]
+        return [(int(i), float(scores[i])) for i in top]
+
+    def document(self, row: int) -> Document:
+        """
+        the document of a row
+        """
+        snapshot = self._snapshot
+        return Document(
+            page_content=snapshot.texts[row], metadata=snapshot.metadatas[row]
+        )
+
+    def embedding(self, row: int) -> np.ndarray:
+        """
+        the (normalized) embedding of a row
+        """
+        return np.array(self._snapshot.matrix[row])
+
+
+class LocalVS4APM(VectorStore):
+    """
+    Vector store on a LocalVectorIndex, with the tracing of OracleVS4APM
+    (the same span names: the APM queries work with both stores)
+
+    scores are cosine distances, as OracleVS with DistanceStrategy.COSINE
+
+    read-only: the DB is the source of truth, the rows are added there
+    (see ingestion.py) and loaded with refresh()
+    """
+
+    def __init__(
+        self,
+        index: LocalVectorIndex,
+        embedding_function: Embeddings,
+        table_name: str,
+        source=None,
+    ):
+        """
+        source: where the index is refreshed from (see LocalVectorIndex.refresh)
+        """
+        self.index = index
+        self.embedding_function = embedding_function
+        self.table_name = table_name
+        self.source = source
+
+        self._refresher = None
+        self._stop_refresh = None
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def refresh(self) -> Dict:
+        """
+        align the local index with the source
+        """
+        return self.index.refresh(self.source)
+
+    def start_refresh(self, interval_sec: float):
+        """
+        refresh the index every interval_sec, in a daemon thread
+        """
+        if self._refresher is not None or not interval_sec or self.source is None:
+            return
+
+        stop = threading.Event()
+
+        def _loop():
+            while not stop.wait(interval_sec):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    # the index remains as it is, until the next refresh
+                    logger.error("Refresh of the local index failed: %s", str(e))
+
+        self._stop_refresh = stop
+        self._refresher = threading.Thread(
+            target=_loop, name="local-vs-refresh", daemon=True
+        )
+        self._refresher.start()
+
+    def stop_refresh(self):
+        """
+        stop the refresh thread (when the store is replaced)
+        """
+        if self._refresher is None:
+            return
+
+        self._stop_refresh.set()
+        self._refresher = None
+        self._stop_refresh = None
+
+    def get_collection_version(self) -> Any:
+        """
+        a value that changes when the content of the index changes
+        """
+        return self.index.version
+
+    @traced("OracleVS.similarity_search")
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Dict[str, Any] | None = None, **kwargs
+    ) -> List[Document]:
+        """
+        Perform a similarity search with APM tracing (as OracleVS4APM).
+        """
+        # pylint: disable=redefined-builtin
+        current_span = trace.get_current_span()
+        # the num. of docs actually requested
+        current_span.set_attribute("top_k", k)
+        current_span.set_attribute("local_vs_index", self.index.index_type)
+
+        with timed(VECTOR_SEARCH_LATENCY, {"collection": self.table_name}):
+            embedding = self.embedding_function.embed_query(query)
+
+            docs_and_scores = self.similarity_search_by_vector_with_relevance_scores(
+                embedding, k=k, filter=filter
+            )
+        return [doc for doc, _ in docs_and_scores]
+
+    @traced("OracleVS.similarity_search")
+    async def asimilarity_search(
+        self, query: str, k: int = 4, filter: Dict[str, Any] | None = None, **kwargs
+    ) -> List[Document]:
+        """
+        Async version of similarity_search, with the same APM tracing.
+
+        the search in memory is not offloaded: it takes less than a thread switch
+        """
+        # pylint: disable=redefined-builtin
+        current_span = trace.get_current_span()
+        # the num. of docs actually requested
+        current_span.set_attribute("top_k", k)
+        current_span.set_attribute("local_vs_index", self.index.index_type)
+
+        with timed(VECTOR_SEARCH_LATENCY, {"collection": self.table_name}):
+            embedding = await self.embedding_function.aembed_query(query)
+
+            docs_and_scores = self.similarity_search_by_vector_with_relevance_scores(
+                embedding, k=k, filter=filter
+            )
+        return [doc for doc, _ in docs_and_scores]
+
+    def similarity_search_by_vector_with_relevance_scores(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """
+        the search in the local index
+        """
+        # pylint: disable=redefined-builtin
+        return [
+            (self.index.document(row), 1.0 - similarity)
+            for row, similarity in self.index.search(embedding, k=k, filter=filter)
+        ]
+
+    def similarity_search_by_vector_returning_embeddings(
+        self,
+        embedding: List[float],
+        k: int,
+        filter: Dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float, np.ndarray]]:
+        """
+        the search in the local index, returning also the (normalized)
+        embeddings of the docs
+        """
+        # pylint: disable=redefined-builtin
+        with timed(VECTOR_SEARCH_LATENCY, {"collection": self.table_name}):
+            return [
+                (
+                    self.index.document(row),
+                    1.0 - similarity,
+                    self.index.embedding(row),
+                )
+                for row, similarity in self.index.search(embedding, k=k, filter=filter)
+            ]
+
+    async def asimilarity_search_by_vector_with_relevance_scores(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """
+        async version of the search in the local index
+        """
+        # pylint: disable=redefined-builtin
+        return self.similarity_search_by_vector_with_relevance_scores(
+            embedding, k=k, filter=filter
+        )
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Dict[str, Any] | None = None, **kwargs
+    ) -> List[Tuple[Document, float]]:
+        # pylint: disable=redefined-builtin
+        return self.similarity_search_by_vector_with_relevance_scores(
+            self.embedding_function.embed_query(query), k=k, filter=filter
+        )
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[Dict]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        """
+        not supported: the rows are added in the DB (see ingestion.py)
+        and then loaded with refresh()
+        """
+        raise TypeError(
+            "LocalVS4APM is read-only: add the texts to the DB "
+            "(see ingestion.py), then call refresh()"
+        )
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[Dict]] = None,
+        **kwargs: Any,
+    ):
+        """
+        not supported: the store is built on a LocalVectorIndex,
+        loaded from the DB (see factory_vector_store)
+        """
+        raise TypeError(
+            "LocalVS4APM is read-only: build a LocalVectorIndex "
+            "and refresh it from the DB"
+        )
@@ -4,45 +4,183 @@ RAG REST API
 to test APM integration
 """
 
+import asyncio
+import json
+import time
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 # APM integration
 from opentelemetry import trace
+from opentelemetry.trace import Status, StatusCode
 
 from langchain_core.messages import HumanMessage, AIMessage
 
+from admission import Admission, AdmissionController, AdmissionRejected
+from batch_runner import BatchRunner
 from conversation_manager import ConversationManager
-from tracer_singleton import TracerSingleton
-from factory import build_rag_chain
-from config_reader import ConfigReader
+from conversation_backends import InMemoryBackend, SQLiteBackend, OracleBackend
+from tracer_singleton import TracerSingleton, set_detailed_attribute
+from stream_tracing import StreamStats, atraced_iter
+from chain_registry import ChainRegistry
+from app_metrics import CHAIN_LATENCY
+from token_budget import HistoryTrimmer, count_messages_tokens
+from config_reader import get_config
 from utils import get_console_logger, sanitize_parameter
 
 # constants
 MEDIA_TYPE_TEXT = "text/plain"
 MEDIA_TYPE_JSON = "application/json"
+MEDIA_TYPE_SSE = "text/event-stream"
+MEDIA_TYPE_NDJSON = "application/x-ndjson"
 
 #
 # Main
 #
-app = FastAPI()
-
-config = ConfigReader("./config.toml")
-VERBOSE = config.find_key("verbose")
+config = get_config()
 # max msgs in conversation
-CONV_MAX_MSGS = config.find_key("conv_max_msgs")
+CONV_MAX_MSGS = config.get("general.conv_max_msgs")
+# max num. of conversations kept, and time to live if idle
+CONV_MAX_CONVERSATIONS = config.get("general.conv_max_conversations")
+CONV_TTL_SEC = config.get("general.conv_ttl_sec")
+# threads used for blocking calls (OCI SDK, DB driver) from the async API
+IO_WORKERS = config.get("general.io_workers")
+# how often config.toml is checked for changes (0: never)
+CONFIG_RELOAD_SEC = config.get("general.config_reload_sec", 0)
 
 logger = get_console_logger()
 
+
+def get_conversation_backend():
+    """
+    the store of the conversations, as configured (conv_backend)
+
+    with more than one worker (or node) use sqlite (or oracle)
+    """
+    backend_type = config.get("general.conv_backend")
+    limits = (CONV_MAX_MSGS, CONV_MAX_CONVERSATIONS, CONV_TTL_SEC)
+
+    if backend_type == "sqlite":
+        return SQLiteBackend(config.get("general.conv_sqlite_path"), *limits)
+    if backend_type == "oracle":
+        # imported here: the pool is needed only for this backend
+        # pylint: disable=import-outside-toplevel
+        from factory_vector_store import get_db_pool
+
+        return OracleBackend(
+            get_db_pool(),
+            *limits,
+            batch_size=config.get("general.conv_oracle_batch_size"),
+            flush_interval_sec=config.get("general.conv_oracle_flush_sec"),
+        )
+    return InMemoryBackend(*limits)
+
+
+def get_history_trimmer():
+    """
+    to trim the history to a budget of tokens (and summarize older turns)
+    """
+    summarize_chain = None
+
+    if config.get("general.history_summary_enable"):
+        # pylint: disable=import-outside-toplevel
+        from langchain_core.output_parsers import StrOutputParser
+        from factory import get_llm
+        from prompts_library import SUMMARY_PROMPT
+
+        summarize_chain = SUMMARY_PROMPT | get_llm() | StrOutputParser()
+
+    return HistoryTrimmer(
+        max_tokens=config.get("general.history_max_tokens"),
+        summarize_chain=summarize_chain,
+        max_summaries=CONV_MAX_CONVERSATIONS,
+    )
+
+
+def get_admission_controller():
+    """
+    the limits on the requests served at the same time (see: admission)
+    """
+    return AdmissionController(
+        enable=config.get("admission.admission_enable"),
+        max_concurrent=config.get("admission.admission_max_concurrent"),
+        max_queue=config.get("admission.admission_max_queue"),
+        queue_timeout_sec=config.get("admission.admission_queue_timeout_sec"),
+        rate_per_sec=config.get("admission.admission_rate_per_sec"),
+        burst=config.get("admission.admission_burst"),
+        max_conversations=CONV_MAX_CONVERSATIONS,
+    )
+
+
 # Global object to handle conversation history
-conversation_manager = ConversationManager(CONV_MAX_MSGS)
+conversation_manager = ConversationManager(backend=get_conversation_backend())
+history_trimmer = get_history_trimmer()
+admission_controller = get_admission_controller()
+
+
+def apply_config(new_config):
+    """
+    send the reloaded limits to the live conversation store and trimmer
+    """
+    backend = conversation_manager.backend
+    backend.set_max_messages(new_config.get("general.conv_max_msgs"))
+    backend.max_conversations = new_config.get("general.conv_max_conversations")
+    backend.ttl_sec = new_config.get("general.conv_ttl_sec")
+
+    history_trimmer.max_tokens = new_config.get("general.history_max_tokens")
+
+    # a larger max_concurrent is used at the next release
+    admission_controller.enable = new_config.get("admission.admission_enable")
+    admission_controller.max_concurrent = new_config.get(
+        "admission.admission_max_concurrent"
+    )
+    admission_controller.max_queue = new_config.get("admission.admission_max_queue")
+    admission_controller.queue_timeout_sec = new_config.get(
+        "admission.admission_queue_timeout_sec"
+    )
+    admission_controller.rate_per_sec = new_config.get(
+        "admission.admission_rate_per_sec"
+    )
+    admission_controller.burst = new_config.get("admission.admission_burst")
+
+
+config.subscribe(apply_config)
 
 # to integrate with OCI APM
 TRACER = TracerSingleton.get_instance()
 
+# Global object holding the RAG chain, built once and reused
+chain_registry = ChainRegistry()
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """
+    build the RAG chain at startup
+    """
+    # the blocking calls in the async path run in this bounded executor
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+    )
+
+    # changes to config.toml are applied without a restart
+    config.watch(CONFIG_RELOAD_SEC)
+
+    chain_registry.warm_up()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -62,33 +200,249 @@ class InvokeInput(BaseModel):
     query: str
 
 
+class BatchInput(BaseModel):
+    """
+    class for the body of a batch request
+
+    queries: the questions, independent (no chat history)
+    max_concurrency: questions running at the same time
+        (default, and max: batch_max_concurrency)
+    """
+
+    queries: List[str]
+    max_concurrency: Optional[int] = None
+
+
+def update_conversation(conv_id: str, query: str, answer: str):
+    """
+    add the question and the answer to the conversation history
+    """
+    conversation_manager.add_messages(
+        conv_id, [HumanMessage(content=query), AIMessage(content=answer)]
+    )
+    set_store_attributes()
+
+
+async def aupdate_conversation(conv_id: str, query: str, answer: str):
+    """
+    async version of update_conversation
+    """
+    await conversation_manager.aadd_messages(
+        conv_id, [HumanMessage(content=query), AIMessage(content=answer)]
+    )
+    set_store_attributes()
+
+
+def set_store_attributes():
+    """
+    send to APM the size of the conversation store
+
+    the gauges are computed periodically by the backend, not here
+    """
+    current_span = trace.get_current_span()
+    current_span.set_attribute("conv_count", conversation_manager.num_conversations)
+    current_span.set_attribute("conv_store_bytes", conversation_manager.approx_bytes)
+
+
+def set_history_attributes(chat_history):
+    """
+    send to APM the size of the history sent to the LLM
+    """
+    current_span = trace.get_current_span()
+    current_span.set_attribute("history_msgs", len(chat_history))
+    current_span.set_attribute("history_tokens", count_messages_tokens(chat_history))
+
+
+def get_chat_history(conv_id: str):
+    """
+    the conversation history, trimmed to the budget of tokens
+    """
+    chat_history = history_trimmer.trim(
+        conversation_manager.get_conversation(conv_id), conv_id
+    )
+    set_history_attributes(chat_history)
+
+    return chat_history
+
+
+async def aget_chat_history(conv_id: str):
+    """
+    async version of get_chat_history
+    """
+    chat_history = await history_trimmer.atrim(
+        await conversation_manager.aget_conversation(conv_id), conv_id
+    )
+    set_history_attributes(chat_history)
+
+    return chat_history
+
+
 def handle_request(request: InvokeInput, conv_id: str):
     """
     handle the request from invoke
     """
-    # build_rag_chain mark a span (see: factory)
-    chain = build_rag_chain()
+    # the chain is built only once and reused (see: chain_registry)
+    chain = chain_registry.get_chain()
 
     # get the chat history
-    conversation = conversation_manager.get_conversation(conv_id)
+    conversation = get_chat_history(conv_id)
     #
     # call the RAG chain
     #
-    ai_msg = chain.invoke({"input": request.query, "chat_history": conversation})
+    ai_msg = chain.invoke(
+        {"input": request.query, "chat_history": conversation, "conv_id": conv_id}
+    )
 
     # update the conversation
-    conversation_manager.add_message(conv_id, HumanMessage(content=request.query))
-    conversation_manager.add_message(conv_id, AIMessage(content=ai_msg["answer"]))
+    update_conversation(conv_id, request.query, ai_msg["answer"])
 
     return ai_msg
 
 
+async def ahandle_request(request: InvokeInput, conv_id: str):
+    """
+    handle the request from invoke, async version
+    """
+    # the chain is built only once and reused (see: chain_registry)
+    chain = await chain_registry.aget_chain()
+
+    # get the chat history
+    conversation = await aget_chat_history(conv_id)
+    #
+    # call the RAG chain, without holding a thread while waiting
+    #
+    ai_msg = await chain.ainvoke(
+        {"input": request.query, "chat_history": conversation, "conv_id": conv_id}
+    )
+
+    # update the conversation
+    await aupdate_conversation(conv_id, request.query, ai_msg["answer"])
+
+    return ai_msg
+
+
+def rejected_response(error: AdmissionRejected) -> Response:
+    """
+    the fast answer when the request is not admitted (429 or 503)
+    """
+    current_span = trace.get_current_span()
+    current_span.set_attribute("admission_rejected", error.reason)
+
+    logger.warning("%s", error)
+
+    return Response(
+        content=str(error),
+        status_code=error.status_code,
+        headers=error.headers,
+        media_type=MEDIA_TYPE_TEXT,
+    )
+
+
+def format_sse(data, event: str = None) -> str:
+    """
+    format a server-sent event, data is sent as JSON
+    """
+    msg = f"data: {json.dumps(data)}\n\n"
+    if event is not None:
+        msg = f"event: {event}\n" + msg
+    return msg
+
+
+async def astream_request(request: InvokeInput, conv_id: str, admission: Admission):
+    """
+    handle the request from stream: generator of server-sent events
+
+    the span is open until the last token has been sent,
+    the admission is released at the end of the stream
+    """
+    span = TRACER.start_span("api.stream")
+    span.set_attribute("conv_id", conv_id)
+    admission.set_attributes(span)
+    set_detailed_attribute(span, "genai-chat-input", request.query)
+    stats = StreamStats()
+    status = "ok"
+
+    try:
+        with trace.use_span(span, end_on_exit=False):
+            # the chain is built only once and reused (see: chain_registry)
+            chain = await chain_registry.aget_chain()
+            conversation = await aget_chat_history(conv_id)
+
+        generator = chain.astream(
+            {"input": request.query, "chat_history": conversation, "conv_id": conv_id}
+        )
+
+        answer = []
+        async for chunk in atraced_iter(span, generator):
+            token = chunk.get("answer")
+
+            if token:
+                stats.add_token(token)
+                answer.append(token)
+
+                yield format_sse(token)
+
+        # the conversation is updated only when the stream is complete
+        with trace.use_span(span, end_on_exit=False):
+            await aupdate_conversation(conv_id, request.query, "".join(answer))
+
+        yield format_sse({}, event="end")
+
+    except Exception as e:
+        # the chain is rebuilt at the next request, if a rebuild can fix it
+        chain_registry.report_error("rag_chain", e)
+        # the trace is kept by the tail sampler
+        span.set_status(Status(StatusCode.ERROR, str(e)))
+        status = "error"
+
+        # to signal error
+        yield format_sse(f"Error: {str(e)}", event="error")
+    finally:
+        admission_controller.release(admission)
+
+        stats.set_attributes(span)
+        span.end()
+
+        CHAIN_LATENCY.record(
+            stats.elapsed_ms(), {"endpoint": "stream", "status": status}
+        )
+
+
+async def abatch_request(request: BatchInput, admission: Admission):
+    """
+    handle the request from batch: generator of NDJSON lines,
+    one for every question, in order of completion
+    """
+    max_concurrency = config.get("batch.batch_max_concurrency")
+    if request.max_concurrency:
+        max_concurrency = min(request.max_concurrency, max_concurrency)
+
+    try:
+        # the questions are embedded with the embed model of the chain
+        chain, embed_model = await chain_registry.aget_chain_with_embeddings()
+        if not config.get("batch.batch_group_embeddings"):
+            embed_model = None
+
+        runner = BatchRunner(chain, embed_model, max_concurrency)
+        async for result in runner.arun(request.queries):
+            yield json.dumps(result) + "\n"
+
+    except Exception as e:
+        # the errors of the questions are in their results: the chain is not
+        # marked unhealthy for a batch
+        logger.error("Error in batch: %s", e)
+
+        yield json.dumps({"error": str(e)}) + "\n"
+    finally:
+        admission_controller.release(admission)
+
+
 #
 # HTTP API methods
 #
 @app.post("/invoke/", tags=["V1"])
 @TRACER.start_as_current_span("api.invoke")
-def invoke(request: InvokeInput, conv_id: str):
+async def invoke(request: InvokeInput, conv_id: str):
     """
     This function handle the HTTP request
 
@@ -105,23 +459,113 @@ def invoke(request: InvokeInput, conv_id: str):
 
     # here we show how to send to APM a value
     current_span.set_attribute("conv_id", conv_id)
-    current_span.set_attribute("genai-chat-input", request.query)
+    set_detailed_attribute(current_span, "genai-chat-input", request.query)
 
     logger.info("Conversation id: %s", conv_id)
 
+    # wait for the turn (in the queue), or a fast 429/503
+    try:
+        admission = await admission_controller.acquire(conv_id)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    admission.set_attributes(current_span)
+
+    time_start = time.perf_counter()
+    status = "ok"
+
     try:
-        response = handle_request(request, conv_id)
+        response = await ahandle_request(request, conv_id)
 
         # only the text of the response
         answer = response["answer"]
 
     except Exception as e:
+        # the chain is rebuilt at the next request, if a rebuild can fix it
+        chain_registry.report_error("rag_chain", e)
+        # the trace is kept by the tail sampler
+        current_span.set_status(Status(StatusCode.ERROR, str(e)))
+        status = "error"
+
         # to signal error
         answer = f"Error: {str(e)}"
+    finally:
+        admission_controller.release(admission)
+
+    CHAIN_LATENCY.record(
+        (time.perf_counter() - time_start) * 1000.0,
+        {"endpoint": "invoke", "status": status},
+    )
 
     return Response(content=answer, media_type=MEDIA_TYPE_TEXT)
 
 
+@app.post("/stream/", tags=["V1"])
+async def stream(request: InvokeInput, conv_id: str):
+    """
+    This function handle the HTTP request, streaming the answer
+    as server-sent events (one event for every token)
+
+    conv_id: the id of the conversation, to handle chat_history
+    """
+
+    # remove eventually any dangerous char
+    conv_id = sanitize_parameter(conv_id)
+
+    logger.info("Conversation id: %s", conv_id)
+
+    try:
+        admission = await admission_controller.acquire(conv_id)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+
+    return StreamingResponse(
+        astream_request(request, conv_id, admission),
+        media_type=MEDIA_TYPE_SSE,
+        # in case the stream is never started (client gone)
+        background=BackgroundTask(admission_controller.release, admission),
+    )
+
+
+@app.post("/batch/", tags=["V1"])
+async def batch(request: BatchInput, conv_id: str):
+    """
+    This function handle the HTTP request with many questions,
+    streaming the results as NDJSON (one line for every question)
+
+    conv_id: the id of the caller (for admission, rate limits)
+    """
+    conv_id = sanitize_parameter(conv_id)
+
+    logger.info("Batch of %d queries, conv_id: %s", len(request.queries), conv_id)
+
+    if len(request.queries) > config.get("batch.batch_max_queries"):
+        return Response(
+            content=f"Too many queries, max: {config.get('batch.batch_max_queries')}",
+            status_code=413,
+            media_type=MEDIA_TYPE_TEXT,
+        )
+
+    # the whole batch is admitted as one request
+    try:
+        admission = await admission_controller.acquire(conv_id)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+
+    return StreamingResponse(
+        abatch_request(request, admission),
+        media_type=MEDIA_TYPE_NDJSON,
+        background=BackgroundTask(admission_controller.release, admission),
+    )
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """
+    the metrics (latencies, tokens...) for scraping by Prometheus
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 # to clean up a conversation
 @app.delete("/delete/", tags=["V1"])
 def delete(conv_id: str):
@@ -133,13 +577,14 @@ def delete(conv_id: str):
     logger.info("Called delete, conv_id: %s...", conv_id)
 
     conversation_manager.clear_conversation(conv_id)
+    history_trimmer.clear(conv_id)
 
     return {"conv_id": conv_id, "messages": []}
 
 
 if __name__ == "__main__":
 
-    API_HOST = config.find_key("api_host")
-    API_PORT = config.find_key("api_port")
+    API_HOST = config.get("general.api_host")
+    API_PORT = config.get("general.api_port")
 
     uvicorn.run(host=API_HOST, port=API_PORT, app=app)
@@ -9,10 +9,15 @@ Python Version: 3.11
 License: MIT
 """
 
+import asyncio
+from typing import Any, List
+
+from langchain_core.runnables.config import run_in_executor
 from langchain_community.embeddings import OCIGenAIEmbeddings
-from tracer_singleton import TracerSingleton
+from opentelemetry import trace
 
-TRACER = TracerSingleton.get_instance()
+from instrumentation import traced
+from app_metrics import EMBED_LATENCY, timed
 
 
 #
@@ -21,14 +26,120 @@ TRACER = TracerSingleton.get_instance()
 class OCIGenAIEmbeddings4APM(OCIGenAIEmbeddings):
     """
     Subclass to enable addition of annotation
+
+    If embed_cache is set (see: embedding_cache) only the texts not
+    in the cache are sent to the remote endpoint.
+    If embed_batcher is set (see: embedding_batcher) the batches are sent
+    concurrently and single queries are coalesced.
     """
 
+    embed_cache: Any = None
+    embed_batcher: Any = None
+
     # instrumented for integration with APM
-    @TRACER.start_as_current_span("OCIGenAIEmbeddings.embed_documents")
+    @traced("OCIGenAIEmbeddings.embed_documents")
     def embed_documents(self, texts):
         """
-        call the superclass method
+        call the remote endpoint (only for the texts not in the cache)
+        """
+        with timed(EMBED_LATENCY, {"model": self.model_id}):
+            if self.embed_cache is None:
+                return self._embed_remote(texts)
+
+            embeddings, missing = self.embed_cache.lookup(self.model_id, texts)
+
+            if missing:
+                missing_texts = [texts[i] for i in missing]
+                new_embeddings = self._embed_remote(missing_texts)
+                self._fill_missing(missing_texts, embeddings, missing, new_embeddings)
+
+            self._set_cache_attributes(len(texts), len(missing))
+
+            return embeddings
+
+    @traced("OCIGenAIEmbeddings.embed_documents")
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        async version of embed_documents, with the same span
         """
-        embeddings = super().embed_documents(texts)
+        with timed(EMBED_LATENCY, {"model": self.model_id}):
+            if self.embed_cache is None:
+                return await self._aembed_remote(texts)
+
+            embeddings, missing = self.embed_cache.lookup(self.model_id, texts)
+
+            if missing:
+                missing_texts = [texts[i] for i in missing]
+                new_embeddings = await self._aembed_remote(missing_texts)
+                self._fill_missing(missing_texts, embeddings, missing, new_embeddings)
+
+            self._set_cache_attributes(len(texts), len(missing))
+
+            return embeddings
+
+    def _fill_missing(self, missing_texts, embeddings, missing, new_embeddings):
+        """
+        put the embeddings computed remotely in place, and in the cache
+        """
+        for i, embedding in zip(missing, new_embeddings):
+            embeddings[i] = embedding
+
+        self.embed_cache.store(self.model_id, missing_texts, new_embeddings)
+
+    def _set_cache_attributes(self, n_texts: int, n_missing: int):
+        """
+        send to APM the stats of the cache
+        """
+        current_span = trace.get_current_span()
+        if not current_span.is_recording():
+            return
+
+        current_span.set_attribute("embed_cache_hits", n_texts - n_missing)
+        current_span.set_attribute("embed_cache_misses", n_missing)
+        current_span.set_attribute("embed_cache_evictions", self.embed_cache.evictions)
+        current_span.set_attribute("embed_cache_size", len(self.embed_cache))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """
+        async version of embed_query (goes through aembed_documents)
+        """
+        embeddings = await self.aembed_documents([text])
+
+        return embeddings[0]
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        the remote call to the OCI GenAI embeddings endpoint
+        """
+        return super().embed_documents(texts)
+
+    def _embed_remote(self, texts: List[str]) -> List[List[float]]:
+        """
+        the embeddings computed remotely, in concurrent batches if possible
+        """
+        if self.embed_batcher is None:
+            return self._embed_batch(texts)
+
+        return self.embed_batcher.embed(self._embed_batch, texts, self.model_id)
+
+    async def _aembed_remote(self, texts: List[str]) -> List[List[float]]:
+        """
+        the OCI SDK is blocking: the remote calls run in the pool of the
+        batcher (or in the executor), the event loop only waits
+        """
+        if self.embed_batcher is None:
+            return await run_in_executor(None, self._embed_batch, texts)
+
+        if len(texts) == 1 and self.embed_batcher.coalesce_ms > 0:
+            future = self.embed_batcher.submit_query(
+                self._embed_batch, texts[0], self.model_id
+            )
+            return [await asyncio.wrap_future(future)]
 
-        return embeddings
+        batches = await asyncio.gather(
+            *(
+                asyncio.wrap_future(future)
+                for future in self.embed_batcher.submit(self._embed_batch, texts)
+            )
+        )
+        return [embedding for batch in batches for embedding in batch]
@@ -2,25 +2,90 @@
 OracleVS + extension for APM integration
 """
 
-from typing import Dict, List, Any
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Any, Tuple
 
 from langchain_core.documents.base import Document
+from langchain_core.runnables.config import run_in_executor
 from langchain_community.vectorstores.oraclevs import OracleVS
 from opentelemetry import trace
 
-from tracer_singleton import TracerSingleton
-from config_reader import ConfigReader
-
-app_config = ConfigReader("./config.toml")
-TRACER = TracerSingleton.get_instance()
+from instrumentation import traced
+from app_metrics import VECTOR_SEARCH_LATENCY, timed
 
 
 class OracleVS4APM(OracleVS):
     """
     Subclass with extension to add tracing for APM
+
+    If a pool is given, a connection is borrowed from the pool for every
+    DB operation and returned to the pool afterward.
     """
 
-    @TRACER.start_as_current_span("OracleVS.similarity_search")
+    def __init__(self, client: Any = None, *args, pool: Any = None, **kwargs):
+        """
+        client: a connection to the DB (not used if pool is given)
+        pool: a pool of connections (oracledb.create_pool)
+        """
+        self._pool = pool
+        # the connection borrowed by the current thread
+        self._local = threading.local()
+
+        if pool is None:
+            super().__init__(client, *args, **kwargs)
+        else:
+            with self._borrow_connection() as connection:
+                super().__init__(connection, *args, **kwargs)
+
+    @property
+    def client(self) -> Any:
+        """
+        the connection to use: the borrowed one, if any
+        """
+        connection = getattr(self._local, "connection", None)
+
+        if connection is not None:
+            return connection
+        if self._pool is not None:
+            return self._pool
+        return self._client
+
+    @client.setter
+    def client(self, value: Any):
+        self._client = value
+
+    @contextmanager
+    def _borrow_connection(self):
+        """
+        borrow a connection from the pool and release it at the end
+
+        pool wait time and busy/open counts are sent to APM
+        """
+        if self._pool is None or getattr(self._local, "connection", None) is not None:
+            # no pool, or connection already borrowed by this thread
+            yield self.client
+            return
+
+        time_start = time.perf_counter()
+        connection = self._pool.acquire()
+        acquire_wait_ms = (time.perf_counter() - time_start) * 1000.0
+
+        current_span = trace.get_current_span()
+        if current_span.is_recording():
+            current_span.set_attribute("db_pool_acquire_wait_ms", acquire_wait_ms)
+            current_span.set_attribute("db_pool_busy", self._pool.busy)
+            current_span.set_attribute("db_pool_opened", self._pool.opened)
+
+        self._local.connection = connection
+        try:
+            yield connection
+        finally:
+            self._local.connection = None
+            self._pool.release(connection)
+
+    @traced("OracleVS.similarity_search")
     def similarity_search(
         self, query: str, k: int = 4, filter: Dict[str, Any] | None = None, **kwargs
     ) -> List[Document]:
@@ -37,7 +102,114 @@ class OracleVS4APM(OracleVS):
             List[Document]: A list of documents that match the search criteria.
         """
         current_span = trace.get_current_span()
-        top_k = app_config.find_key("top_k")
-        current_span.set_attribute("top_k", top_k)
+        if current_span.is_recording():
+            # the num. of docs actually requested
+            current_span.set_attribute("top_k", k)
+
+        with timed(VECTOR_SEARCH_LATENCY, {"collection": self.table_name}):
+            return super().similarity_search(query, k=k, filter=filter, **kwargs)
+
+    @traced("OracleVS.similarity_search")
+    async def asimilarity_search(
+        self, query: str, k: int = 4, filter: Dict[str, Any] | None = None, **kwargs
+    ) -> List[Document]:
+        """
+        Async version of similarity_search, with the same APM tracing.
 
-        return super().similarity_search(query, k=k, filter=filter, **kwargs)
+        The embedding is computed with the async API of the embed model,
+        the query on the DB (blocking driver) runs in the executor.
+        """
+        current_span = trace.get_current_span()
+        if current_span.is_recording():
+            # the num. of docs actually requested
+            current_span.set_attribute("top_k", k)
+
+        with timed(VECTOR_SEARCH_LATENCY, {"collection": self.table_name}):
+            embedding = await self.embedding_function.aembed_query(query)
+
+            docs_and_scores = (
+                await self.asimilarity_search_by_vector_with_relevance_scores(
+                    embedding, k=k, filter=filter, **kwargs
+                )
+            )
+        return [doc for doc, _ in docs_and_scores]
+
+    def similarity_search_by_vector_with_relevance_scores(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """
+        the query on the DB, done with a connection borrowed from the pool
+        """
+        with self._borrow_connection():
+            return super().similarity_search_by_vector_with_relevance_scores(
+                embedding, k=k, filter=filter, **kwargs
+            )
+
+    def similarity_search_by_vector_returning_embeddings(
+        self,
+        embedding: List[float],
+        k: int,
+        filter: Dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float, Any]]:
+        """
+        the query on the DB, returning also the embeddings of the docs
+        (used by HybridRetriever for MMR)
+        """
+        with timed(VECTOR_SEARCH_LATENCY, {"collection": self.table_name}):
+            with self._borrow_connection():
+                return super().similarity_search_by_vector_returning_embeddings(
+                    embedding, k, filter=filter, **kwargs
+                )
+
+    async def asimilarity_search_by_vector_with_relevance_scores(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """
+        async version of the query on the DB
+        """
+        return await run_in_executor(
+            None,
+            self.similarity_search_by_vector_with_relevance_scores,
+            embedding,
+            k,
+            filter,
+            **kwargs,
+        )
+
+    def get_collection_version(self) -> Any:
+        """
+        a value that changes when the content of the collection changes
+
+        (num. of rows, max SCN of the rows): an insert or an update
+        raises the SCN (also a delete, in the blocks still holding rows),
+        a delete changes the count. Any writer is seen (ingestion too).
+        """
+        with self._borrow_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT COUNT(*), MAX(ORA_ROWSCN) FROM {self.table_name}"
+                )
+                return tuple(cursor.fetchone())
+
+    def add_texts(self, *args, **kwargs) -> List[str]:
+        """
+        insert with a connection borrowed from the pool
+        """
+        with self._borrow_connection():
+            return super().add_texts(*args, **kwargs)
+
+    def delete(self, *args, **kwargs) -> None:
+        """
+        delete with a connection borrowed from the pool
+        """
+        with self._borrow_connection():
+            return super().delete(*args, **kwargs)
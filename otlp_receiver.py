@@ -0,0 +1,235 @@
+"""
+OTLP Receiver
+
+    a local stand-in for the APM collector, to test the export of the spans
+    without APM: it accepts OTLP traces (http/protobuf, optionally gzip,
+    or grpc), counts requests and spans and can simulate a slow or
+    failing collector.
+
+Usage:
+    python otlp_receiver.py --port 4318 --delay_ms 200 --failure_rate 0.1
+
+    then set apm_endpoint = "http://localhost:4318/v1/traces"
+    in config_tracing.toml
+"""
+
+import argparse
+import gzip
+import random
+import threading
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import (
+    ExportTraceServiceRequest,
+    ExportTraceServiceResponse,
+)
+
+TRACES_PATH = "/v1/traces"
+
+
+def count_spans(request: ExportTraceServiceRequest) -> int:
+    """
+    num. of spans in an export request
+    """
+    return sum(
+        len(scope_spans.spans)
+        for resource_spans in request.resource_spans
+        for scope_spans in resource_spans.scope_spans
+    )
+
+
+class OTLPReceiver:
+    """
+    Receive OTLP traces and count them
+
+    delay_ms: time taken to answer every request (slow collector)
+    failure_rate: fraction of the requests answered with an error
+    """
+
+    def __init__(
+        self,
+        port: int = 4318,
+        delay_ms: float = 0.0,
+        failure_rate: float = 0.0,
+        protocol: str = "http",
+    ):
+        self.port = port
+        self.delay_ms = delay_ms
+        self.failure_rate = failure_rate
+        self.protocol = protocol
+
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+        self.requests = 0
+        self.spans = 0
+        self.bytes = 0
+        self.failures = 0
+
+    @property
+    def endpoint(self) -> str:
+        """
+        the endpoint to use in the exporter
+        """
+        if self.protocol == "grpc":
+            # http: an insecure channel
+            return f"http://localhost:{self.port}"
+        return f"http://localhost:{self.port}{TRACES_PATH}"
+
+    def handle(self, body: bytes, n_bytes: int) -> bool:
+        """
+        count a request, return False if it must fail
+
+        n_bytes: size of the request as received (with http, compressed)
+        """
+        request = ExportTraceServiceRequest()
+        request.ParseFromString(body)
+
+        if self.delay_ms:
+            time.sleep(self.delay_ms / 1000.0)
+
+        failed = random.random() < self.failure_rate
+
+        with self._lock:
+            self.requests += 1
+            self.bytes += n_bytes
+            if failed:
+                self.failures += 1
+            else:
+                self.spans += count_spans(request)
+
+        return not failed
+
+    def stats(self) -> Dict:
+        """
+        the counters of the receiver
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "spans": self.spans,
+                "bytes": self.bytes,
+                "failures": self.failures,
+            }
+
+    def _http_handler(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+            OTLP over http/protobuf
+            """
+
+            def do_POST(self):
+                """
+                an export request
+                """
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                n_bytes = len(body)
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+
+                if self.path != TRACES_PATH:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                # 503 is retried by the exporter, as a real collector under load
+                status = 200 if receiver.handle(body, n_bytes) else 503
+                response = ExportTraceServiceResponse().SerializeToString()
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/x-protobuf")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _start_grpc(self):
+        # imported here: grpc is needed only for this protocol
+        # pylint: disable=import-outside-toplevel
+        import grpc
+        from opentelemetry.proto.collector.trace.v1 import trace_service_pb2_grpc
+
+        receiver = self
+
+        class Servicer(trace_service_pb2_grpc.TraceServiceServicer):
+            """
+            OTLP over grpc
+            """
+
+            def Export(self, request, context):
+                body = request.SerializeToString()
+                if not receiver.handle(body, len(body)):
+                    context.abort(grpc.StatusCode.UNAVAILABLE, "simulated failure")
+                return ExportTraceServiceResponse()
+
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+        trace_service_pb2_grpc.add_TraceServiceServicer_to_server(
+            Servicer(), self._server
+        )
+        self._server.add_insecure_port(f"localhost:{self.port}")
+        self._server.start()
+
+    def start(self):
+        """
+        start to receive, in background
+        """
+        if self.protocol == "grpc":
+            self._start_grpc()
+            return self
+
+        self._server = ThreadingHTTPServer(
+            ("localhost", self.port), self._http_handler()
+        )
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="otlp-receiver", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        stop the server
+        """
+        if self.protocol == "grpc":
+            self._server.stop(grace=None)
+        else:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def main():
+    """
+    run the receiver, print the counters every few seconds
+    """
+    parser = argparse.ArgumentParser(description="local OTLP receiver")
+    parser.add_argument("--port", type=int, default=4318)
+    parser.add_argument("--delay_ms", type=float, default=0.0)
+    parser.add_argument("--failure_rate", type=float, default=0.0)
+    parser.add_argument("--protocol", choices=("http", "grpc"), default="http")
+    args = parser.parse_args()
+
+    receiver = OTLPReceiver(
+        args.port, args.delay_ms, args.failure_rate, args.protocol
+    ).start()
+    print(f"Receiving OTLP traces on {receiver.endpoint}")
+
+    try:
+        while True:
+            time.sleep(5)
+            print(receiver.stats())
+    except KeyboardInterrupt:
+        receiver.stop()
+
+
+if __name__ == "__main__":
+    main()
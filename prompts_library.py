@@ -38,3 +38,19 @@ QA_PROMPT = ChatPromptTemplate.from_messages(
         ("human", "{input}"),
     ]
 )
+
+#
+# The prompt to compress the older turns of the conversation in a summary
+#
+SUMMARY_SYSTEM_PROMPT = """Progressively summarize the lines of conversation provided, \
+adding onto the previous summary and returning a new summary. \
+Keep names, facts and numbers. Be concise. Return only the summary."""
+
+SUMMARY_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", SUMMARY_SYSTEM_PROMPT),
+        ("human", "Previous summary:\n{summary}\n\nNew lines of conversation:"),
+        MessagesPlaceholder("messages"),
+        ("human", "New summary:"),
+    ]
+)
@@ -0,0 +1,283 @@
+"""
+Semantic Cache
+
+    cache of the answers of the RAG chain, in front of retrieval and answer
+
+    * the key is the embedding of the standalone question, in the scope
+      of the chat history: the answer depends also on it, an entry is
+      a hit only for the same history (no history: a global scope)
+    * a hit needs cosine similarity >= threshold
+    * entries expire after ttl_sec
+    * the cache is bounded: when full, expired and then least recently
+      used entries are evicted
+    * the cache is invalidated when the content of the collection changes
+"""
+
+import hashlib
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+from langchain_core.runnables import RunnableLambda
+from langchain_core.runnables.config import run_in_executor
+from opentelemetry import trace
+
+from utils import get_console_logger
+
+logger = get_console_logger()
+
+# the scope of the questions without chat history
+GLOBAL_SCOPE = 0
+
+
+def history_scope(chat_history) -> int:
+    """
+    the scope of a cache entry: a hash of the chat history
+    """
+    if not chat_history:
+        return GLOBAL_SCOPE
+
+    digest = hashlib.sha256()
+    for message in chat_history:
+        digest.update(f"{message.type}\x00{message.content}\x00".encode("utf-8"))
+    return int.from_bytes(digest.digest()[:8], "big", signed=True)
+
+
+class SemanticCache:
+    """
+    Answers indexed by the (normalized) embedding of the question,
+    looked up with a vectorized nearest-neighbour search
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.95,
+        ttl_sec: float = 3600,
+        max_entries: int = 5000,
+        check_sec: float = 60,
+    ):
+        """
+        threshold: min cosine similarity for a hit
+        ttl_sec: time to live of an entry
+        max_entries: max num. of entries
+        check_sec: how often check if the collection has changed
+        """
+        self.threshold = threshold
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self.check_sec = check_sec
+
+        self._lock = threading.Lock()
+        # allocated at the first insert (we need the dimension)
+        self._keys: Optional[np.ndarray] = None
+        self._created = np.zeros(max_entries, dtype=np.float64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._scopes = np.zeros(max_entries, dtype=np.int64)
+        self._values: list = []
+        self._size = 0
+
+        # to detect changes in the collection
+        self._collection_version = None
+        self._last_check = 0.0
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _remove(self, idx: int):
+        """
+        remove entry idx, moving the last entry in its place
+        """
+        last = self._size - 1
+        if idx != last:
+            self._keys[idx] = self._keys[last]
+            self._created[idx] = self._created[last]
+            self._last_used[idx] = self._last_used[last]
+            self._scopes[idx] = self._scopes[last]
+            self._values[idx] = self._values[last]
+        self._values.pop()
+        self._size -= 1
+
+    def _evict(self, now: float):
+        """
+        make room for a new entry: remove expired entries, then the LRU
+        """
+        expired = np.nonzero(now - self._created[: self._size] > self.ttl_sec)[0]
+        # from the end, to keep the indexes valid while removing
+        for idx in sorted(expired, reverse=True):
+            self._remove(int(idx))
+            self.evictions += 1
+
+        if self._size >= self.max_entries:
+            self._remove(int(np.argmin(self._last_used[: self._size])))
+            self.evictions += 1
+
+    def lookup(
+        self, embedding, scope: int = GLOBAL_SCOPE
+    ) -> Tuple[Optional[Any], float]:
+        """
+        look for the nearest question in the cache, in the same scope
+
+        return: the cached value (None if no hit), the similarity
+        """
+        query = self._normalize(embedding)
+        now = time.time()
+
+        with self._lock:
+            if self._size == 0:
+                self.misses += 1
+                return None, 0.0
+
+            similarities = self._keys[: self._size] @ query
+            # expired entries can't be a hit
+            similarities[now - self._created[: self._size] > self.ttl_sec] = -1.0
+            # nor entries of another scope
+            similarities[self._scopes[: self._size] != scope] = -1.0
+
+            idx = int(np.argmax(similarities))
+            similarity = float(similarities[idx])
+
+            if similarity < self.threshold:
+                self.misses += 1
+                return None, similarity
+
+            self._last_used[idx] = now
+            self.hits += 1
+            return self._values[idx], similarity
+
+    def store(self, embedding, value: Any, scope: int = GLOBAL_SCOPE):
+        """
+        add an entry to the cache
+        """
+        key = self._normalize(embedding)
+        now = time.time()
+
+        with self._lock:
+            if self._keys is None:
+                self._keys = np.zeros(
+                    (self.max_entries, key.shape[0]), dtype=np.float32
+                )
+
+            if self._size >= self.max_entries:
+                self._evict(now)
+
+            idx = self._size
+            self._keys[idx] = key
+            self._created[idx] = now
+            self._last_used[idx] = now
+            self._scopes[idx] = scope
+            self._values.append(value)
+            self._size += 1
+
+    def invalidate(self):
+        """
+        remove all the entries
+        """
+        with self._lock:
+            self._values = []
+            self._size = 0
+
+        logger.info("Semantic cache invalidated")
+
+    def check_due(self) -> bool:
+        """
+        true if it is time to check if the collection has changed
+        """
+        return time.time() - self._last_check >= self.check_sec
+
+    def check_collection(self, version_fn: Callable[[], Any]):
+        """
+        invalidate the cache if the content of the collection has changed
+
+        version_fn is called at most every check_sec seconds
+        """
+        if not self.check_due():
+            return
+        self._last_check = time.time()
+
+        version = version_fn()
+        if self._collection_version is not None and version != self._collection_version:
+            self.invalidate()
+        self._collection_version = version
+
+    def wrap(
+        self,
+        chain,
+        embed_model,
+        version_fn: Callable[[], Any],
+        on_hit: Optional[Callable[[Dict], Dict]] = None,
+    ):
+        """
+        put the cache in front of chain
+
+        chain input must contain standalone_question (and chat_history,
+        for the scope), output is a dict with context and answer.
+        On a hit chain is not called, on_hit is called with the input
+        (for example, to cancel work started for the chain) and returns
+        the input to put in the output.
+        """
+
+        def _cached_output(inputs: Dict, cached: Dict) -> Dict:
+            if on_hit is not None:
+                inputs = on_hit(inputs)
+            return {**inputs, "context": cached["context"], "answer": cached["answer"]}
+
+        def _set_attributes(hit: bool, similarity: float):
+            # here we send to APM the result of the lookup
+            current_span = trace.get_current_span()
+            current_span.set_attribute("semantic_cache_hit", hit)
+            current_span.set_attribute("semantic_cache_similarity", similarity)
+            current_span.set_attribute("semantic_cache_size", self._size)
+
+        def _on_miss(embedding, scope: int):
+            def _store(run):
+                outputs = run.outputs or {}
+                if "answer" in outputs:
+                    value = {
+                        "context": outputs.get("context", []),
+                        "answer": outputs["answer"],
+                    }
+                    self.store(embedding, value, scope)
+
+            # the output is stored when the chain ends (also when streamed)
+            return chain.with_listeners(on_end=_store)
+
+        def _lookup(inputs: Dict):
+            self.check_collection(version_fn)
+
+            embedding = embed_model.embed_query(inputs["standalone_question"])
+            scope = history_scope(inputs.get("chat_history"))
+            cached, similarity = self.lookup(embedding, scope)
+            _set_attributes(cached is not None, similarity)
+
+            if cached is not None:
+                return _cached_output(inputs, cached)
+            return _on_miss(embedding, scope)
+
+        async def _alookup(inputs: Dict):
+            if self.check_due():
+                # the query on the DB is blocking
+                await run_in_executor(None, self.check_collection, version_fn)
+
+            embedding = await embed_model.aembed_query(inputs["standalone_question"])
+            scope = history_scope(inputs.get("chat_history"))
+            cached, similarity = self.lookup(embedding, scope)
+            _set_attributes(cached is not None, similarity)
+
+            if cached is not None:
+                return _cached_output(inputs, cached)
+            return _on_miss(embedding, scope)
+
+        # returning a Runnable, the Runnable is called with the same input
+        return RunnableLambda(_lookup, afunc=_alookup, name="semantic_cache")
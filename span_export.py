@@ -0,0 +1,179 @@
+"""
+Span Export
+
+    the pipeline sending the spans to APM, with its own metrics:
+    * queue depth (spans waiting to be exported)
+    * spans dropped because the queue was full
+    * export latency, spans exported, failed exports
+
+    The metrics are sent with the OpenTelemetry metrics API: they're
+    recorded only when a MeterProvider is configured.
+    They're also available, for local tests, in MeteredBatchSpanProcessor.stats
+"""
+
+import threading
+import time
+from typing import Dict, Sequence
+
+from opentelemetry import metrics
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor,
+    SpanExporter,
+    SpanExportResult,
+)
+
+meter = metrics.get_meter("span_export")
+
+
+class ExportStats:
+    """
+    the counters of the export pipeline, shared by processor and exporter
+    """
+
+    def __init__(self, max_queue_size: int):
+        self.max_queue_size = max_queue_size
+
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+        self.exported = 0
+        self.failures = 0
+        self.export_ms_total = 0.0
+        self.n_exports = 0
+
+        # only to be read by a MeterProvider
+        meter.create_observable_gauge(
+            "otel_export_queue_depth",
+            callbacks=[self._observe_queue_depth],
+            description="spans waiting to be exported",
+        )
+        self._dropped_counter = meter.create_counter(
+            "otel_export_dropped_spans", description="spans dropped, queue full"
+        )
+        self._exported_counter = meter.create_counter(
+            "otel_export_spans", description="spans sent to the exporter"
+        )
+        self._failures_counter = meter.create_counter(
+            "otel_export_failures", description="failed exports"
+        )
+        self._latency_histogram = meter.create_histogram(
+            "otel_export_latency", unit="ms", description="time spent in export"
+        )
+
+    def _observe_queue_depth(self, _options):
+        yield metrics.Observation(self.queued)
+
+    def span_queued(self):
+        """
+        a span added to the queue, if full the oldest is dropped
+        """
+        with self._lock:
+            if self.queued >= self.max_queue_size:
+                self.dropped += 1
+                dropped = True
+            else:
+                self.queued += 1
+                dropped = False
+
+        if dropped:
+            self._dropped_counter.add(1)
+
+    def batch_dequeued(self, n_spans: int):
+        """
+        a batch taken from the queue, to be exported
+        """
+        with self._lock:
+            self.queued = max(0, self.queued - n_spans)
+
+    def batch_exported(self, n_spans: int, export_ms: float, success: bool):
+        """
+        a batch sent to the collector
+        """
+        with self._lock:
+            self.exported += n_spans
+            self.export_ms_total += export_ms
+            self.n_exports += 1
+            if not success:
+                self.failures += 1
+
+        self._exported_counter.add(n_spans)
+        self._latency_histogram.record(export_ms)
+        if not success:
+            self._failures_counter.add(1)
+
+    def as_dict(self) -> Dict:
+        """
+        the current values
+        """
+        with self._lock:
+            return {
+                "queue_depth": self.queued,
+                "dropped_spans": self.dropped,
+                "exported_spans": self.exported,
+                "export_failures": self.failures,
+                "avg_export_ms": (
+                    self.export_ms_total / self.n_exports if self.n_exports else 0.0
+                ),
+            }
+
+
+class MeteredSpanExporter(SpanExporter):
+    """
+    Wrap an exporter, to measure every export
+    """
+
+    def __init__(self, exporter: SpanExporter, stats: ExportStats):
+        self.exporter = exporter
+        self.stats = stats
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        self.stats.batch_dequeued(len(spans))
+        time_start = time.perf_counter()
+        result = SpanExportResult.FAILURE
+
+        try:
+            result = self.exporter.export(spans)
+            return result
+        finally:
+            export_ms = (time.perf_counter() - time_start) * 1000.0
+            self.stats.batch_exported(
+                len(spans), export_ms, result == SpanExportResult.SUCCESS
+            )
+
+    def shutdown(self):
+        self.exporter.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.exporter.force_flush(timeout_millis)
+
+
+class MeteredBatchSpanProcessor(BatchSpanProcessor):
+    """
+    BatchSpanProcessor reporting queue depth, dropped spans
+    and the metrics of the exporter
+    """
+
+    def __init__(
+        self,
+        span_exporter: SpanExporter,
+        max_queue_size: int = 2048,
+        schedule_delay_millis: float = 5000,
+        max_export_batch_size: int = 512,
+        export_timeout_millis: float = 30000,
+    ):
+        self.stats = ExportStats(max_queue_size)
+
+        super().__init__(
+            MeteredSpanExporter(span_exporter, self.stats),
+            max_queue_size=max_queue_size,
+            schedule_delay_millis=schedule_delay_millis,
+            max_export_batch_size=max_export_batch_size,
+            export_timeout_millis=export_timeout_millis,
+        )
+
+    def on_end(self, span: ReadableSpan):
+        if span.context and span.context.trace_flags.sampled:
+            self.stats.span_queued()
+
+        super().on_end(span)
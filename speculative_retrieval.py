@@ -0,0 +1,302 @@
+"""
+Speculative Retrieval
+
+    the standalone question is produced by an LLM call (condense),
+    the retrieval can start only after it. Here the retrieval starts at once,
+    on the question as asked, while the condense runs:
+    * if the standalone question is the same, or very similar
+      (cosine of the embeddings >= min_similarity), the docs are used
+    * otherwise the retrieval is done again, with the standalone question
+
+    The docs are awaited only when needed (docs_runnable, after the
+    semantic cache): on a cache hit the retrieval is cancelled (cancel).
+    The retrieval not awaited is removed from the output of the chain.
+
+    The spans of condense and of the speculative retrieval overlap;
+    if the speculation was used and the latency saved are sent to APM.
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from langchain_core.documents.base import Document
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+from opentelemetry import trace
+
+from tracer_singleton import TracerSingleton
+
+TRACER = TracerSingleton.get_instance()
+
+
+# the key, in the output of the condense, of the retrieval not yet awaited
+PENDING_KEY = "speculative_retrieval"
+
+# sync API: the speculative retrievals run here, shared by all the chains
+# (the context is copied: their spans are children of the request)
+_EXECUTOR = ContextThreadPoolExecutor(max_workers=8, thread_name_prefix="speculative")
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+@dataclass
+class PendingRetrieval:
+    """
+    the retrieval started on the question, while the question was condensed
+
+    future: a concurrent Future (sync API) or an asyncio Task
+    """
+
+    question: str
+    future: Any
+    time_start: float
+    condense_ms: float
+
+    def cancel(self):
+        """
+        the docs are not needed (for example, a hit in the semantic cache)
+        """
+        self.future.cancel()
+
+
+class SpeculativeRetrieval:
+    """
+    Condense the question and retrieve the docs concurrently
+
+    min_similarity: min cosine similarity between the question and the
+        standalone question, to use the docs retrieved for the question
+    """
+
+    def __init__(self, embed_model, min_similarity: float = 0.9):
+        self.embed_model = embed_model
+        self.min_similarity = min_similarity
+
+    @staticmethod
+    def _cosine(a, b) -> float:
+        a = np.asarray(a, dtype=np.float32)
+        b = np.asarray(b, dtype=np.float32)
+        return float(a @ b / max(np.linalg.norm(a) * np.linalg.norm(b), 1e-12))
+
+    def _decide(self, question: str, standalone_question: str) -> float:
+        """
+        the similarity of the two questions (1.0 if the same)
+
+        both embeddings are in the cache: the question has been embedded
+        by the retrieval, the standalone one is needed by the semantic cache
+        """
+        if _normalize(question) == _normalize(standalone_question):
+            return 1.0
+
+        return self._cosine(
+            self.embed_model.embed_query(question),
+            self.embed_model.embed_query(standalone_question),
+        )
+
+    async def _adecide(self, question: str, standalone_question: str) -> float:
+        if _normalize(question) == _normalize(standalone_question):
+            return 1.0
+
+        return self._cosine(
+            await self.embed_model.aembed_query(question),
+            await self.embed_model.aembed_query(standalone_question),
+        )
+
+    @staticmethod
+    def _set_attributes(
+        used: bool,
+        similarity: float,
+        condense_ms: float,
+        retrieval_ms: float,
+        time_start: float,
+    ):
+        """
+        saved_ms: time of the sequential steps (condense + retrieval)
+        minus the actual time (negative if the retrieval was done again)
+        """
+        elapsed_ms = (time.perf_counter() - time_start) * 1000.0
+
+        current_span = trace.get_current_span()
+        current_span.set_attribute("speculative_used", used)
+        current_span.set_attribute("speculative_similarity", similarity)
+        current_span.set_attribute("speculative_condense_ms", condense_ms)
+        current_span.set_attribute("speculative_retrieval_ms", retrieval_ms)
+        current_span.set_attribute(
+            "speculative_saved_ms", condense_ms + retrieval_ms - elapsed_ms
+        )
+
+    @staticmethod
+    def _retrieve(retriever, question: str, config) -> Tuple[List[Document], float]:
+        time_start = time.perf_counter()
+        with TRACER.start_as_current_span("speculative.retrieve"):
+            docs = retriever.invoke(question, config)
+        return docs, (time.perf_counter() - time_start) * 1000.0
+
+    @staticmethod
+    async def _aretrieve(
+        retriever, question: str, config
+    ) -> Tuple[List[Document], float]:
+        time_start = time.perf_counter()
+        with TRACER.start_as_current_span("speculative.retrieve"):
+            docs = await retriever.ainvoke(question, config)
+        return docs, (time.perf_counter() - time_start) * 1000.0
+
+    @staticmethod
+    def without_pending(inputs: Dict) -> Dict:
+        """
+        the inputs without the retrieval (not to be returned by the chain)
+        """
+        return {key: value for key, value in inputs.items() if key != PENDING_KEY}
+
+    @staticmethod
+    def cancel(inputs: Dict) -> Dict:
+        """
+        cancel the retrieval started for inputs (the docs are not needed)
+
+        return: the inputs without the retrieval
+        """
+        pending = inputs.get(PENDING_KEY)
+        if pending is not None:
+            pending.cancel()
+        return SpeculativeRetrieval.without_pending(inputs)
+
+    def as_runnable(self, condense_chain, retriever):
+        """
+        a runnable doing condense and starting the retrieval
+
+        input: input, chat_history (as condense_chain)
+        output: the input + standalone_question, speculative_retrieval
+            (the retrieval, to be awaited with docs_runnable)
+        """
+
+        def _output(inputs: Dict, standalone_question: str, pending) -> Dict:
+            return {
+                **inputs,
+                "standalone_question": standalone_question,
+                PENDING_KEY: pending,
+            }
+
+        @TRACER.start_as_current_span("SpeculativeRetrieval")
+        def _run(inputs: Dict, config) -> Dict:
+            time_start = time.perf_counter()
+            question = inputs["input"]
+
+            # the retrieval on the question, in another thread
+            speculative = _EXECUTOR.submit(self._retrieve, retriever, question, config)
+
+            try:
+                with TRACER.start_as_current_span("speculative.condense"):
+                    standalone_question = condense_chain.invoke(inputs, config)
+            except BaseException:
+                speculative.cancel()
+                raise
+            condense_ms = (time.perf_counter() - time_start) * 1000.0
+
+            pending = PendingRetrieval(question, speculative, time_start, condense_ms)
+            return _output(inputs, standalone_question, pending)
+
+        @TRACER.start_as_current_span("SpeculativeRetrieval")
+        async def _arun(inputs: Dict, config) -> Dict:
+            time_start = time.perf_counter()
+            question = inputs["input"]
+
+            # the task has a copy of the context: its spans are children of this one
+            speculative = asyncio.create_task(
+                self._aretrieve(retriever, question, config)
+            )
+            # if never awaited (the chain fails later), its error is not logged
+            speculative.add_done_callback(
+                lambda task: task.cancelled() or task.exception()
+            )
+
+            try:
+                with TRACER.start_as_current_span("speculative.condense"):
+                    standalone_question = await condense_chain.ainvoke(inputs, config)
+            except BaseException:
+                speculative.cancel()
+                raise
+            condense_ms = (time.perf_counter() - time_start) * 1000.0
+
+            pending = PendingRetrieval(question, speculative, time_start, condense_ms)
+            return _output(inputs, standalone_question, pending)
+
+        return RunnableLambda(_run, afunc=_arun, name="condense_and_retrieve")
+
+    def docs_runnable(self, retriever):
+        """
+        a runnable giving the docs: the ones of the speculative retrieval,
+        if the standalone question is similar enough, otherwise retrieved
+        again with the standalone question
+
+        input: the output of as_runnable
+        """
+
+        @TRACER.start_as_current_span("SpeculativeRetrieval.docs")
+        def _docs(inputs: Dict, config) -> List[Document]:
+            pending = inputs[PENDING_KEY]
+            standalone_question = inputs["standalone_question"]
+
+            try:
+                similarity = self._decide(pending.question, standalone_question)
+            except BaseException:
+                pending.cancel()
+                raise
+            used = similarity >= self.min_similarity
+
+            if used:
+                docs, retrieval_ms = pending.future.result()
+            else:
+                # the speculative result is not awaited
+                pending.cancel()
+                docs, retrieval_ms = self._retrieve(
+                    retriever, standalone_question, config
+                )
+
+            self._set_attributes(
+                used, similarity, pending.condense_ms, retrieval_ms, pending.time_start
+            )
+            return docs
+
+        @TRACER.start_as_current_span("SpeculativeRetrieval.docs")
+        async def _adocs(inputs: Dict, config) -> List[Document]:
+            pending = inputs[PENDING_KEY]
+            standalone_question = inputs["standalone_question"]
+
+            try:
+                similarity = await self._adecide(pending.question, standalone_question)
+            except BaseException:
+                pending.cancel()
+                raise
+            used = similarity >= self.min_similarity
+
+            if used:
+                docs, retrieval_ms = await pending.future
+            else:
+                pending.cancel()
+                docs, retrieval_ms = await self._aretrieve(
+                    retriever, standalone_question, config
+                )
+
+            self._set_attributes(
+                used, similarity, pending.condense_ms, retrieval_ms, pending.time_start
+            )
+            return docs
+
+        return RunnableLambda(_docs, afunc=_adocs, name="speculative_docs")
+
+    def answer_runnable(self, retriever, question_answer_chain):
+        """
+        as create_retrieval_chain, with the docs of docs_runnable
+
+        input: the output of as_runnable
+        output: the input (without the retrieval) + context, answer
+        """
+        return (
+            RunnablePassthrough.assign(context=self.docs_runnable(retriever))
+            | RunnableLambda(self.without_pending, name="without_pending")
+            | RunnablePassthrough.assign(answer=question_answer_chain)
+        ).with_config(run_name="retrieval_chain")
@@ -0,0 +1,106 @@
+"""
+Stream tracing
+
+    helpers to trace a stream of tokens with a span that stays open
+    for the whole stream, and to send to APM its timings:
+    time-to-first-token, inter-token latency percentiles, tokens and chars
+"""
+
+import statistics
+import time
+
+from opentelemetry import trace
+
+
+class StreamStats:
+    """
+    Collect the timings of a stream of tokens
+    """
+
+    def __init__(self):
+        self._time_start = time.perf_counter()
+        self._time_last = None
+        self._inter_token_ms = []
+
+        self.time_to_first_token_ms = None
+        self.n_tokens = 0
+        self.n_chars = 0
+
+    def add_token(self, token: str):
+        """
+        to be called for every token received
+        """
+        now = time.perf_counter()
+
+        if self._time_last is None:
+            self.time_to_first_token_ms = (now - self._time_start) * 1000.0
+        else:
+            self._inter_token_ms.append((now - self._time_last) * 1000.0)
+
+        self._time_last = now
+        self.n_tokens += 1
+        self.n_chars += len(token)
+
+    def elapsed_ms(self) -> float:
+        """
+        time since the start of the stream (ms)
+        """
+        return (time.perf_counter() - self._time_start) * 1000.0
+
+    def inter_token_percentiles(self) -> dict:
+        """
+        p50, p95, p99 of the latency between two tokens (ms)
+        """
+        if not self._inter_token_ms:
+            return {}
+        if len(self._inter_token_ms) == 1:
+            value = self._inter_token_ms[0]
+            return {"p50": value, "p95": value, "p99": value}
+
+        cuts = statistics.quantiles(self._inter_token_ms, n=100, method="inclusive")
+        return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+    def set_attributes(self, span):
+        """
+        send the stats to APM, as attributes of the span
+        """
+        if not span.is_recording():
+            return
+
+        span.set_attribute("stream_tokens", self.n_tokens)
+        span.set_attribute("stream_output_len", self.n_chars)
+
+        if self.time_to_first_token_ms is not None:
+            span.set_attribute("time_to_first_token_ms", self.time_to_first_token_ms)
+
+        for name, value in self.inter_token_percentiles().items():
+            span.set_attribute(f"inter_token_ms_{name}", value)
+
+
+def traced_iter(span, generator):
+    """
+    iterate over a generator, with span as current span while it runs
+
+    the span is not current while the consumer has the item, so
+    the context is never left attached between two yields
+    """
+    while True:
+        with trace.use_span(span, end_on_exit=False):
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+        yield item
+
+
+async def atraced_iter(span, generator):
+    """
+    async version of traced_iter
+    """
+    while True:
+        with trace.use_span(span, end_on_exit=False):
+            try:
+                item = await generator.__anext__()
+            except StopAsyncIteration:
+                return
+        yield item
@@ -2,12 +2,15 @@
 Streamlit client for RAG API integrated with APM
 """
 
+import json
+
 import streamlit as st
 import requests
 from langchain_core.messages import HumanMessage, AIMessage
 
 # Configure API endpoint
 INVOKE_URL = "http://localhost:8888/invoke/"
+STREAM_URL = "http://localhost:8888/stream/"
 DELETE_URL = "http://localhost:8888/delete/"
 
 # Constant
@@ -53,6 +56,33 @@ def invoke_api(_conv_id, query):
     return response.text
 
 
+def stream_api(_conv_id, query):
+    """
+    invoke the API (RAG) in streaming mode
+
+    return a generator of the tokens, read from the server-sent events
+    """
+    with requests.post(
+        STREAM_URL,
+        params={"conv_id": _conv_id},
+        json={"query": query},
+        stream=True,
+        timeout=60,
+    ) as response:
+        event = None
+
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: ") :]
+            elif line.startswith("data: "):
+                if event == "end":
+                    break
+
+                # tokens (and errors) are sent as JSON strings
+                yield json.loads(line[len("data: ") :])
+                event = None
+
+
 def delete_conversation(_conv_id):
     """
     delete a conversation
@@ -84,10 +114,9 @@ if question := st.chat_input("Hello, how can I help you?"):
     # Add user message to chat history
     st.session_state.chat_history.append(HumanMessage(content=question))
 
-    ai_response = invoke_api(conv_id, question)
-
     with st.chat_message(ASSISTANT):
-        st.markdown(ai_response)
+        # tokens are displayed as soon as they arrive
+        ai_response = st.write_stream(stream_api(conv_id, question))
 
         # Add assistant response to chat history
         st.session_state.chat_history.append(AIMessage(content=ai_response))
@@ -0,0 +1,209 @@
+"""
+Tail Sampling
+
+    a span processor that decides which traces are exported only when
+    the trace is complete (when its local root span ends):
+    * traces with errors are always kept
+    * slow traces (root span longer than slow_ms) are always kept
+    * the others are kept with probability sample_rate
+
+    The spans of a trace are buffered until the decision, the kept ones
+    are sent to the delegate processor (for example: a BatchSpanProcessor).
+    Works on the traces recorded by the head sampler (see: tracer_singleton);
+    the decision is independent of the head one (a salted hash of the
+    trace_id, not its bits): sample_rate of the recorded traces are kept.
+    See bench_tail_sampling.py for the checks of the decisions.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor
+from opentelemetry.trace import StatusCode
+
+# the head sampler (TraceIdRatioBased) decides on the lower 64 bits
+# of the trace_id: the tail decision on a hash, uncorrelated
+SAMPLING_SALT = b"tail_sampling"
+
+
+class _PendingTrace:
+    """
+    the spans of a trace waiting for the decision
+    """
+
+    __slots__ = ("spans", "has_error", "first_seen")
+
+    def __init__(self):
+        self.spans: List[ReadableSpan] = []
+        self.has_error = False
+        self.first_seen = time.monotonic()
+
+
+class TailSamplingSpanProcessor(SpanProcessor):
+    """
+    Keep slow and error traces, sample the others
+    """
+
+    def __init__(
+        self,
+        delegate: SpanProcessor,
+        slow_ms: float = 5000.0,
+        sample_rate: float = 1.0,
+        max_traces: int = 10000,
+        trace_timeout_sec: float = 60.0,
+    ):
+        """
+        delegate: where the spans of the kept traces are sent
+        sample_rate: fraction (0..1) of the normal traces kept
+        max_traces: max num. of traces waiting for the decision
+        trace_timeout_sec: a trace without the root span ending is decided
+            after this time
+        """
+        self.delegate = delegate
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.max_traces = max_traces
+        self.trace_timeout_sec = trace_timeout_sec
+
+        self._lock = threading.Lock()
+        self._pending: OrderedDict[int, _PendingTrace] = OrderedDict()
+        # decisions already taken, for the spans ending after the root
+        self._decided: OrderedDict[int, bool] = OrderedDict()
+
+        # stats
+        self.kept_error = 0
+        self.kept_slow = 0
+        self.kept_sampled = 0
+        self.dropped = 0
+
+    @staticmethod
+    def _is_local_root(span: ReadableSpan) -> bool:
+        return span.parent is None or span.parent.is_remote
+
+    def _sampled(self, trace_id: int) -> bool:
+        """
+        deterministic on the trace_id, independent of the head sampler
+        """
+        digest = hashlib.blake2b(
+            trace_id.to_bytes(16, "big"), digest_size=8, salt=SAMPLING_SALT
+        ).digest()
+        return int.from_bytes(digest, "big") < self.sample_rate * (1 << 64)
+
+    def _decide(self, trace_id: int, pending: _PendingTrace, root: ReadableSpan):
+        """
+        keep or drop the trace, update the stats
+
+        root: the local root span, None if the trace has been evicted
+        """
+        if pending.has_error:
+            self.kept_error += 1
+            return True
+
+        if root is not None and root.end_time is not None:
+            duration_ms = (root.end_time - root.start_time) / 1e6
+            if duration_ms >= self.slow_ms:
+                self.kept_slow += 1
+                return True
+
+        if self._sampled(trace_id):
+            self.kept_sampled += 1
+            return True
+
+        self.dropped += 1
+        return False
+
+    def _remember(self, trace_id: int, keep: bool):
+        self._decided[trace_id] = keep
+        while len(self._decided) > self.max_traces:
+            self._decided.popitem(last=False)
+
+    def _pop_expired(self) -> List[ReadableSpan]:
+        """
+        decide the traces waiting for too long (or too many)
+
+        return: the spans to export
+        """
+        to_export = []
+        now = time.monotonic()
+
+        while self._pending:
+            trace_id, pending = next(iter(self._pending.items()))
+
+            if (
+                len(self._pending) <= self.max_traces
+                and now - pending.first_seen < self.trace_timeout_sec
+            ):
+                break
+
+            self._pending.popitem(last=False)
+            keep = self._decide(trace_id, pending, None)
+            self._remember(trace_id, keep)
+
+            if keep:
+                to_export.extend(pending.spans)
+
+        return to_export
+
+    def on_start(self, span, parent_context=None):
+        # the delegate gets the spans only after the decision
+        pass
+
+    def on_end(self, span: ReadableSpan):
+        trace_id = span.context.trace_id
+        to_export = []
+
+        with self._lock:
+            keep = self._decided.get(trace_id)
+
+            if keep is not None:
+                # a span ending after its root
+                if keep:
+                    to_export.append(span)
+            else:
+                pending = self._pending.get(trace_id)
+                if pending is None:
+                    pending = self._pending[trace_id] = _PendingTrace()
+
+                pending.spans.append(span)
+                if span.status.status_code == StatusCode.ERROR:
+                    pending.has_error = True
+
+                if self._is_local_root(span):
+                    del self._pending[trace_id]
+                    keep = self._decide(trace_id, pending, span)
+                    self._remember(trace_id, keep)
+
+                    if keep:
+                        to_export.extend(pending.spans)
+
+            to_export.extend(self._pop_expired())
+
+        # outside the lock, the delegate can block (queue full)
+        for kept_span in to_export:
+            self.delegate.on_end(kept_span)
+
+    def _flush_pending(self):
+        """
+        decide all the traces still waiting
+        """
+        with self._lock:
+            pending_traces = list(self._pending.items())
+            self._pending.clear()
+
+            to_export = []
+            for trace_id, pending in pending_traces:
+                if self._decide(trace_id, pending, None):
+                    to_export.extend(pending.spans)
+
+        for kept_span in to_export:
+            self.delegate.on_end(kept_span)
+
+    def shutdown(self):
+        self._flush_pending()
+        self.delegate.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.delegate.force_flush(timeout_millis)
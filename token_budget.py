@@ -0,0 +1,184 @@
+"""
+Token Budget
+
+    to trim the chat history to a budget of tokens, instead of
+    a fixed number of messages.
+
+    Tokens are estimated locally (no tokenizer), counts are cached
+    per message content (only short texts: a whole prompt or answer
+    is rarely counted twice).
+    Optionally the older turns are compressed in a running summary.
+"""
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict, deque
+from functools import lru_cache
+from typing import List, Tuple
+
+from langchain_core.messages import BaseMessage, SystemMessage
+
+# words and single punctuation chars
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+# long words are split in more tokens
+CHARS_PER_SUBWORD = 8
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+# texts up to this len (chars) are cached: the memory is bounded
+# (max. COUNT_CACHE_MAX_ENTRIES * COUNT_CACHE_MAX_CHARS)
+COUNT_CACHE_MAX_CHARS = 1000
+COUNT_CACHE_MAX_ENTRIES = 10000
+
+
+def _count_tokens(text: str) -> int:
+    return sum(
+        1 + len(match) // CHARS_PER_SUBWORD for match in TOKEN_PATTERN.findall(text)
+    )
+
+
+_count_tokens_cached = lru_cache(maxsize=COUNT_CACHE_MAX_ENTRIES)(_count_tokens)
+
+
+def count_tokens(text: str) -> int:
+    """
+    fast estimate of the num. of tokens of a text
+    """
+    if len(text) > COUNT_CACHE_MAX_CHARS:
+        return _count_tokens(text)
+    return _count_tokens_cached(text)
+
+
+def count_messages_tokens(messages: List[BaseMessage]) -> int:
+    """
+    estimate of the num. of tokens of a list of messages
+    """
+    # + 4 for the role and the separators of every message
+    return sum(count_tokens(str(msg.content)) + 4 for msg in messages)
+
+
+def _msg_hash(message: BaseMessage) -> str:
+    return hashlib.sha256(f"{message.type}\x00{message.content}".encode()).hexdigest()
+
+
+class HistoryTrimmer:
+    """
+    Trim the chat history to max_tokens, keeping the most recent turns
+
+    if summarize_chain is given, the turns removed are compressed
+    in a running summary (one for every conversation)
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 2000,
+        summarize_chain=None,
+        max_summaries: int = 10000,
+    ):
+        """
+        summarize_chain: runnable, input {summary, messages}, output the new summary
+        """
+        self.max_tokens = max_tokens
+        self.summarize_chain = summarize_chain
+        self.max_summaries = max_summaries
+
+        self._lock = threading.Lock()
+        # conv_id -> (summary, hashes of the messages already summarized)
+        self._summaries: OrderedDict[str, Tuple[str, deque]] = OrderedDict()
+
+    def split(
+        self, messages: List[BaseMessage]
+    ) -> Tuple[List[BaseMessage], List[BaseMessage]]:
+        """
+        split the history in: messages removed, messages kept (within budget)
+
+        the kept history always starts with a question
+        """
+        n_tokens = 0
+        start = len(messages)
+
+        for i in range(len(messages) - 1, -1, -1):
+            n_tokens += count_messages_tokens([messages[i]])
+            if n_tokens > self.max_tokens:
+                break
+            start = i
+
+        # don't start with an answer without its question
+        while start < len(messages) and messages[start].type != "human":
+            start += 1
+
+        return messages[:start], messages[start:]
+
+    def _new_dropped(self, conv_id: str, dropped: List[BaseMessage]):
+        """
+        the removed messages not yet in the summary, and the current summary
+        """
+        with self._lock:
+            summary, covered = self._summaries.get(conv_id, ("", deque(maxlen=1000)))
+
+        hashes = [_msg_hash(msg) for msg in dropped]
+        new_msgs = [msg for msg, h in zip(dropped, hashes) if h not in covered]
+
+        return summary, covered, new_msgs, hashes
+
+    def _save_summary(self, conv_id: str, summary: str, covered: deque, hashes):
+        covered.extend(h for h in hashes if h not in covered)
+
+        with self._lock:
+            self._summaries[conv_id] = (summary, covered)
+            self._summaries.move_to_end(conv_id)
+
+            while len(self._summaries) > self.max_summaries:
+                self._summaries.popitem(last=False)
+
+    @staticmethod
+    def _with_summary(summary: str, kept: List[BaseMessage]) -> List[BaseMessage]:
+        if not summary:
+            return kept
+        return [SystemMessage(content=SUMMARY_PREFIX + summary)] + kept
+
+    def trim(self, messages: List[BaseMessage], conv_id: str = "") -> List[BaseMessage]:
+        """
+        the history within the budget (with the summary, if enabled)
+        """
+        dropped, kept = self.split(messages)
+
+        if self.summarize_chain is None or not dropped:
+            return kept
+
+        summary, covered, new_msgs, hashes = self._new_dropped(conv_id, dropped)
+        if new_msgs:
+            summary = self.summarize_chain.invoke(
+                {"summary": summary, "messages": new_msgs}
+            )
+            self._save_summary(conv_id, summary, covered, hashes)
+
+        return self._with_summary(summary, kept)
+
+    async def atrim(
+        self, messages: List[BaseMessage], conv_id: str = ""
+    ) -> List[BaseMessage]:
+        """
+        async version of trim
+        """
+        dropped, kept = self.split(messages)
+
+        if self.summarize_chain is None or not dropped:
+            return kept
+
+        summary, covered, new_msgs, hashes = self._new_dropped(conv_id, dropped)
+        if new_msgs:
+            summary = await self.summarize_chain.ainvoke(
+                {"summary": summary, "messages": new_msgs}
+            )
+            self._save_summary(conv_id, summary, covered, hashes)
+
+        return self._with_summary(summary, kept)
+
+    def clear(self, conv_id: str):
+        """
+        remove the summary of a conversation
+        """
+        with self._lock:
+            self._summaries.pop(conv_id, None)
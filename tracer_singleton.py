@@ -2,19 +2,28 @@
 Tracer Singleton
 
     to support integration with OCI APM
+
+    the export can be tuned in config_tracing.toml (see: EXPORT_DEFAULTS):
+    export_protocol, export_compression, export_max_queue_size,
+    export_max_batch_size, export_schedule_delay_ms, export_timeout_ms
 """
 
-from opentelemetry import trace
+from opentelemetry import metrics, trace
+from opentelemetry.exporter.prometheus import PrometheusMetricReader
+from opentelemetry.sdk.metrics import MeterProvider
 from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.exporter.otlp.proto.http import Compression
 from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 from opentelemetry.sdk.trace.export import (
     SpanExporter,
     SpanExportResult,
 )
 from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
 
-from config_reader import ConfigReader
+from config_reader import get_config
+from span_export import MeteredBatchSpanProcessor
+from tail_sampling import TailSamplingSpanProcessor
 from config_private import APM_PUBLIC_KEY
 from utils import get_console_logger
 
@@ -32,12 +41,143 @@ class NoopSpanExporter(SpanExporter):
         pass
 
 
-config_tracing = ConfigReader("./config_tracing.toml")
+config_tracing = get_config("./config_tracing.toml")
+# sampling and level of detail are in config.toml, [apm_tracing]
+config = get_config()
+
+# the settings of the export, in config_tracing.toml (these if not set)
+EXPORT_DEFAULTS = {
+    # http or grpc
+    "export_protocol": "http",
+    # gzip or none
+    "export_compression": "gzip",
+    "export_max_queue_size": 2048,
+    "export_max_batch_size": 512,
+    "export_schedule_delay_ms": 5000,
+    "export_timeout_ms": 10000,
+}
+
+
+def get_export_setting(name: str):
+    """
+    a setting of the export, from config_tracing.toml or the default
+    """
+    value = config_tracing.find_key(name)
+
+    return EXPORT_DEFAULTS[name] if value is None else value
+
+
+def get_span_exporter(endpoint: str, protocol: str = None, compression: str = None):
+    """
+    the OTLP exporter, over http (default) or grpc
+
+    protocol and compression, if not given, are read from config_tracing.toml
+    """
+    protocol = protocol or get_export_setting("export_protocol")
+    compression = compression or get_export_setting("export_compression")
+
+    headers = {"authorization": f"dataKey {APM_PUBLIC_KEY}"}
+    gzip = compression == "gzip"
+    timeout = get_export_setting("export_timeout_ms") / 1000.0
+
+    if protocol == "grpc":
+        # optional: needs opentelemetry-exporter-otlp-proto-grpc
+        # pylint: disable=import-outside-toplevel
+        import grpc
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
+            OTLPSpanExporter as GrpcSpanExporter,
+        )
+
+        return GrpcSpanExporter(
+            endpoint=endpoint,
+            headers=headers,
+            timeout=timeout,
+            compression=(
+                grpc.Compression.Gzip if gzip else grpc.Compression.NoCompression
+            ),
+        )
+
+    return OTLPSpanExporter(
+        endpoint=endpoint,
+        headers=headers,
+        timeout=timeout,
+        compression=Compression.Gzip if gzip else Compression.NoCompression,
+    )
+
+
+def get_batch_span_processor(exporter):
+    """
+    the processor sending the spans in batches, with queue and batch
+    sizes from config_tracing.toml, it reports its own metrics
+    """
+    return MeteredBatchSpanProcessor(
+        exporter,
+        max_queue_size=get_export_setting("export_max_queue_size"),
+        schedule_delay_millis=get_export_setting("export_schedule_delay_ms"),
+        max_export_batch_size=get_export_setting("export_max_batch_size"),
+        export_timeout_millis=get_export_setting("export_timeout_ms"),
+    )
+
+
+def get_sampler():
+    """
+    head sampling: sample_rate (%) of the new traces is recorded,
+    the children follow the decision of the parent
+    """
+    sample_rate = config.get("apm_tracing.sample_rate", 100) / 100.0
+
+    return ParentBased(root=TraceIdRatioBased(sample_rate))
+
+
+def get_span_processor(exporter):
+    """
+    the processor sending the spans to the exporter, in batches
+
+    with tail sampling the slow and error traces are always kept,
+    the others only for tail_sample_rate (%)
+    """
+    span_processor = get_batch_span_processor(exporter)
+
+    if config.get("apm_tracing.tail_sampling_enable"):
+        span_processor = TailSamplingSpanProcessor(
+            span_processor,
+            slow_ms=config.get("apm_tracing.tail_slow_ms"),
+            sample_rate=config.get("apm_tracing.tail_sample_rate") / 100.0,
+            max_traces=config.get("apm_tracing.tail_max_traces"),
+        )
+
+    return span_processor
+
+
+def set_detailed_attribute(span, key: str, value):
+    """
+    set an attribute with a large payload (for example: the text of
+    the request), only if detailed_tracing is enabled
+    """
+    if span.is_recording() and config.get("apm_tracing.detailed_tracing"):
+        span.set_attribute(key, value)
+
+
+def init_meter_provider(resource):
+    """
+    the MeterProvider for the metrics (see: app_metrics, span_export)
+
+    if enabled, the metrics can be scraped by Prometheus (see: /metrics)
+    """
+    metric_readers = []
+    if config.get("metrics.metrics_enable"):
+        metric_readers.append(PrometheusMetricReader())
+
+    metrics.set_meter_provider(
+        MeterProvider(resource=resource, metric_readers=metric_readers)
+    )
 
 
 class TracerSingleton:
     """
     Singleton to handle tracing with OpenTelemetry to OCI APM
+
+    it sets up also the metrics
     """
 
     _instance = None
@@ -67,22 +207,24 @@ class TracerSingleton:
 
         # Configura il tracer
         resource = Resource(attributes={"service.name": service_name})
-        provider = TracerProvider(resource=resource)
-
-        if trace_enable:
-            # Configure OTLP if tracing is enabled
-            logger.info("Enabling APM tracing...")
-
-            exporter = OTLPSpanExporter(
-                endpoint=apm_endpoint,
-                headers={"authorization": f"dataKey {APM_PUBLIC_KEY}"},
-            )
-        else:
-            # Usa un NoOpSpanExporter per scartare le trace
-            exporter = NoopSpanExporter()
-
-        span_processor = BatchSpanProcessor(exporter)
-        provider.add_span_processor(span_processor)
+        # before the span processor, that records its own metrics
+        init_meter_provider(resource)
+
+        if not trace_enable:
+            # no spans at all (not even created and dropped):
+            # the instrumented functions are left as they are (see: instrumentation)
+            logger.info("APM tracing disabled")
+
+            return trace.NoOpTracer()
+
+        provider = TracerProvider(resource=resource, sampler=get_sampler())
+
+        # Configure OTLP if tracing is enabled
+        logger.info("Enabling APM tracing...")
+
+        exporter = get_span_exporter(apm_endpoint)
+
+        provider.add_span_processor(get_span_processor(exporter))
         trace.set_tracer_provider(provider)
 
         # Restituisce il tracer configurato